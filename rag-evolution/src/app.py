@@ -1,82 +1,153 @@
+import time
+
+# Time-to-ready in the startup report is measured from here
+STARTED_AT = time.perf_counter()
+
+import asyncio
 import uuid
 import gradio as gr
 from datetime import datetime
 from dotenv import load_dotenv
-# Import all RAG techniques
-from rag_techniques.standard_rag import StandardRAG
-from rag_techniques.conversational_rag import ConversationalRAG
-from rag_techniques.fusion_rag import FusionRAG
-from rag_techniques.hyde_rag import HydeRAG
-from rag_techniques.self_rag import SelfRAG
-from rag_techniques.adaptive_rag import AdaptiveRAG
-from rag_techniques.corrective_rag import CorrectiveRAG
-from rag_techniques.agentic_rag import AgenticRAG
-from rag_techniques.speculative_rag import SpeculativeRAG
+from pyprojroot import here
+from src.load_config import APPConfig
+from src.utils.answer_cache import SemanticAnswerCache
+from src.utils.async_runtime import run_on_runtime
+from src.utils.retrieval import DATASETS, get_retrieval_service
+from src.utils.technique_registry import TechniqueRegistry
+from src.utils.session_store import SessionStore
+from src.utils.tracing import JsonlExporter, add_exporter, start_metrics_server
 
 load_dotenv()
 
+APP_CONFIG = APPConfig.load()
+
+if APP_CONFIG.tracing.jsonl_path:
+    add_exporter(JsonlExporter(here(APP_CONFIG.tracing.jsonl_path)).export)
+
+
+# Every RAG technique, in menu order; each is imported and built the first time it is selected
+TECHNIQUES = {
+    "Standard (Naive) RAG": ("rag_techniques.standard_rag", "StandardRAG"),
+    "RAG with Memory (Conversational)": ("rag_techniques.conversational_rag", "ConversationalRAG"),
+    "Fusion RAG": ("rag_techniques.fusion_rag", "FusionRAG"),
+    "HyDE (Hypothetical Doc Embedding)": ("rag_techniques.hyde_rag", "HydeRAG"),
+    "Self-RAG": ("rag_techniques.self_rag", "SelfRAG"),
+    "Adaptive RAG": ("rag_techniques.adaptive_rag", "AdaptiveRAG"),
+    "Corrective RAG (CRAG)": ("rag_techniques.corrective_rag", "CorrectiveRAG"),
+    "Agentic RAG": ("rag_techniques.agentic_rag", "AgenticRAG"),
+    "Speculative RAG": ("rag_techniques.speculative_rag", "SpeculativeRAG"),
+}
+
 
 class RAGPlayground:
     def __init__(self):
-        # Initialize all RAG techniques
-        self.techniques = {
-            "Standard (Naive) RAG": StandardRAG(),
-            "RAG with Memory (Conversational)": ConversationalRAG(),
-            "Fusion RAG": FusionRAG(),
-            "HyDE (Hypothetical Doc Embedding)": HydeRAG(),
-            "Self-RAG": SelfRAG(),
-            "Adaptive RAG": AdaptiveRAG(),
-            "Corrective RAG (CRAG)": CorrectiveRAG(),
-            "Agentic RAG": AgenticRAG(),
-            "Speculative RAG": SpeculativeRAG()
-        }
-
-        self.current_logs = []
-        self.conversation_history = {}
-
-        self.rag_techniques = [
-            "Standard (Naive) RAG",
-            "RAG with Memory (Conversational)",
-            "Fusion RAG",
-            "HyDE (Hypothetical Doc Embedding)",
-            "Self-RAG",
-            "Adaptive RAG",
-            "Corrective RAG (CRAG)",
-            "Agentic RAG",
-            "Speculative RAG"
-        ]
-
-    def get_response(self, history, message, technique, dataset, session_id):
-        if not message.strip():
-            return "", history
+        # Techniques are constructed lazily; warm-up preloads the most used ones
+        self.techniques = TechniqueRegistry(TECHNIQUES, started_at=STARTED_AT)
+        if APP_CONFIG.playground.warm_up_techniques:
+            self.techniques.warm_up(
+                APP_CONFIG.playground.warm_up_techniques, DATASETS,
+                lambda dataset: get_retrieval_service().warm(dataset))
+
+        store_config = APP_CONFIG.session_store
+        self.sessions = SessionStore(
+            path=str(here(store_config.path)) if store_config.path else None,
+            max_sessions=store_config.max_sessions,
+            max_exchanges=store_config.max_exchanges,
+            history_token_budget=store_config.history_token_budget,
+            idle_ttl_seconds=store_config.idle_ttl_seconds
+        )
+
+        self.answer_cache = None
+        if APP_CONFIG.answer_cache.enabled:
+            self.answer_cache = SemanticAnswerCache(
+                max_entries=APP_CONFIG.answer_cache.max_entries,
+                similarity_threshold=APP_CONFIG.answer_cache.similarity_threshold
+            )
+
+        self.rag_techniques = self.techniques.names()
+
+    async def _atechnique(self, technique):
+        """The technique instance, constructed off the event loop on first use; None if unknown"""
+        if technique not in self.techniques:
+            return None
+        if self.techniques.is_loaded(technique):
+            return self.techniques.get(technique)
+        return await asyncio.to_thread(self.techniques.get, technique)
+
+    async def _answer_cache_key(self, message, technique, dataset, session_id):
+        """(technique, dataset, collection version, query embedding) for the answer cache.
+
+        None when the cache does not apply: it is disabled, the technique is
+        unknown, or a conversational turn depends on earlier exchanges.
+        """
+        if self.answer_cache is None or technique not in self.techniques:
+            return None
+        if technique == "RAG with Memory (Conversational)" and self.sessions.has_history(session_id):
+            return None
+
+        service = get_retrieval_service()
+        try:
+            version = await asyncio.to_thread(service.collection_version, dataset)
+            embedding, _ = await run_on_runtime(
+                service.embeddings.aembed_query_with_status(message))
+        except Exception as e:
+            print(f"Answer cache bypassed: {e}")  # Debug print
+            return None
+        return technique, dataset, version, embedding
+
+    def _cached_answer(self, cache_key, message, session_id):
+        """Return (response, logs) of a cached near-duplicate question, or None"""
+        if cache_key is None:
+            return None
+        hit = self.answer_cache.lookup(*cache_key)
+        if hit is None:
+            return None
+
+        technique = cache_key[0]
+        if technique == "RAG with Memory (Conversational)":
+            # Start the session's memory with this exchange as if it had run
+            self.sessions.reset(session_id, message, hit.response)
+
+        stats = self.answer_cache.stats()
+        logs = [
+            f"[{datetime.now().strftime('%H:%M:%S')}] ANSWER CACHE: hit for '{hit.query}' "
+            f"(similarity {hit.similarity:.3f}; {stats['hits']} hits / {stats['misses']} misses)"
+        ] + hit.logs
+        return hit.response, logs
+
+    def _store_answer(self, cache_key, message, response, logs):
+        if cache_key is None or response.startswith("Error"):
+            return
+        technique, dataset, version, embedding = cache_key
+        self.answer_cache.store(technique, dataset, version, message,
+                                embedding, response, logs)
+
+    async def aget_response(self, message, technique, dataset, session_id):
+        """Answer a message in one go and return (response, logs)"""
+        cache_key = await self._answer_cache_key(
+            message, technique, dataset, session_id)
+        cached = self._cached_answer(cache_key, message, session_id)
+        if cached is not None:
+            return cached
 
         try:
             # Check if technique is implemented
             if technique in self.techniques:
                 # Get the technique instance and process query
-                technique_instance = self.techniques[technique]
-
-                # Handle different method signatures for different techniques
-                if hasattr(technique_instance, 'process_query'):
-                    if technique == "RAG with Memory (Conversational)":
-                        # Conversational RAG needs session history
-                        session_history = self.conversation_history.get(
-                            session_id, [])
-                        response, logs = technique_instance.process_query(
-                            message, dataset, session_history)
-
-                        # Update conversation history
-                        session_history.append(
-                            {"user": message, "assistant": response})
-                        self.conversation_history[session_id] = session_history
-                    else:
-                        # Standard process_query method
-                        response, logs = technique_instance.process_query(
-                            message, dataset)
+                technique_instance = await self._atechnique(technique)
+
+                if technique == "RAG with Memory (Conversational)":
+                    # Conversational RAG needs session history
+                    memory = self.sessions.get(session_id)
+                    response, logs = await technique_instance.aprocess_query(
+                        message, dataset, memory.exchanges, memory.summary)
+
+                    # Update conversation history
+                    self.sessions.append(session_id, message, response)
                 else:
-                    # Fallback method name
-                    response, logs = technique_instance.generate_response(
+                    response, logs = await technique_instance.aprocess_query(
                         message, dataset)
+                self._store_answer(cache_key, message, response, logs)
 
             else:
                 # Technique not implemented yet
@@ -84,21 +155,87 @@ class RAGPlayground:
                 logs = [
                     f"[{datetime.now().strftime('%H:%M:%S')}] INFO: {technique} not implemented yet"]
 
-            self.current_logs = logs
-
         except Exception as e:
             response = f"Error: {str(e)}"
-            error_log = f"[{datetime.now().strftime('%H:%M:%S')}] ERROR: {str(e)}"
-            self.current_logs = [error_log]
+            logs = [f"[{datetime.now().strftime('%H:%M:%S')}] ERROR: {str(e)}"]
             print(f"Error in RAG processing: {e}")  # Debug print
 
-        history.append([message, response])
-        return "", history
+        return response, logs
+
+    async def stream_response(self, history, message, technique, dataset, session_id):
+        """Yield (history, logs) updates while the technique streams its answer.
+
+        Logs are scoped to this request, so concurrent sessions never see each
+        other's log lines.
+        """
+        if not message.strip():
+            yield history, []
+            return
+
+        try:
+            technique_instance = await self._atechnique(technique)
+        except Exception as e:
+            history.append([message, f"Error: {str(e)}"])
+            print(f"Error constructing {technique}: {e}")  # Debug print
+            yield history, [f"[{datetime.now().strftime('%H:%M:%S')}] ERROR: {str(e)}"]
+            return
+        if not hasattr(technique_instance, 'astream_query'):
+            # No streaming entry point: answer in one go
+            response, logs = await self.aget_response(
+                message, technique, dataset, session_id)
+            history.append([message, response])
+            yield history, logs
+            return
+
+        cache_key = await self._answer_cache_key(
+            message, technique, dataset, session_id)
+        cached = self._cached_answer(cache_key, message, session_id)
+        if cached is not None:
+            response, logs = cached
+            history.append([message, response])
+            yield history, logs
+            return
+
+        conversational = technique == "RAG with Memory (Conversational)"
+        if conversational:
+            # Conversational RAG needs session history
+            memory = self.sessions.get(session_id)
+            events = technique_instance.astream_query(
+                message, dataset, memory.exchanges, memory.summary)
+        else:
+            events = technique_instance.astream_query(message, dataset)
+
+        history.append([message, ""])
+        logs = []
+        response = None
+
+        async for event, payload in events:
+            if event == "log":
+                logs.append(payload)
+            elif event == "reset":
+                # A new generation attempt started; drop the partial answer
+                history[-1][1] = ""
+            elif event == "token":
+                history[-1][1] += payload
+            elif event == "answer":
+                response, logs = payload
+                history[-1][1] = response
+                self._store_answer(cache_key, message, response, logs)
+            elif event == "error":
+                history[-1][1] = f"Error: {str(payload)}"
+                logs = [
+                    f"[{datetime.now().strftime('%H:%M:%S')}] ERROR: {str(payload)}"]
+                print(f"Error in RAG processing: {payload}")  # Debug print
+
+            yield history, logs
+
+        if conversational and response is not None:
+            # Update conversation history
+            self.sessions.append(session_id, message, response)
 
     def clear_conversation_history(self, session_id):
         """Clear conversation history for a specific session"""
-        if session_id in self.conversation_history:
-            del self.conversation_history[session_id]
+        self.sessions.clear(session_id)
         return "<div class='logs-panel'>Logs will appear here after processing...</div>"
 
 
@@ -187,19 +324,19 @@ with gr.Blocks(css=custom_css, title="RAG Playground") as demo:
                     value="Clear Chat"
                 )
 
-            # Function to process query and update logs
-            def process_and_update_logs(history, message, technique, dataset, session_id):
-                new_message, new_history = rag_playground.get_response(
-                    history, message, technique, dataset, session_id)
+            # Function to process query and stream answer tokens + logs
+            async def process_and_update_logs(history, message, technique, dataset, session_id):
+                async for new_history, logs in rag_playground.stream_response(
+                        history, message, technique, dataset, session_id):
 
-                # Create simple text content for logs (no nested divs)
-                if rag_playground.current_logs:
-                    logs_text = "\n".join(rag_playground.current_logs)
-                    log_html = f'<div class="logs-panel">{logs_text}</div>'
-                else:
-                    log_html = '<div class="logs-panel">No logs available</div>'
+                    # Create simple text content for logs (no nested divs)
+                    if logs:
+                        logs_text = "\n".join(logs)
+                        log_html = f'<div class="logs-panel">{logs_text}</div>'
+                    else:
+                        log_html = '<div class="logs-panel">No logs available</div>'
 
-                return new_message, new_history, log_html
+                    yield "", new_history, log_html
 
             # Function to clear everything
             def clear_session_and_logs(session_id):
@@ -212,7 +349,8 @@ with gr.Blocks(css=custom_css, title="RAG Playground") as demo:
                 inputs=[chatbot, input_txt, technique_dropdown,
                         dataset_dropdown, session_id],
                 outputs=[input_txt, chatbot, logs_output],
-                queue=False
+                # Requests are async and keep their logs to themselves
+                concurrency_limit=None
             )
 
             input_txt.submit(
@@ -220,7 +358,8 @@ with gr.Blocks(css=custom_css, title="RAG Playground") as demo:
                 inputs=[chatbot, input_txt, technique_dropdown,
                         dataset_dropdown, session_id],
                 outputs=[input_txt, chatbot, logs_output],
-                queue=False
+                # Requests are async and keep their logs to themselves
+                concurrency_limit=None
             )
 
             clear_button.click(
@@ -230,10 +369,18 @@ with gr.Blocks(css=custom_css, title="RAG Playground") as demo:
             )
 
 if __name__ == "__main__":
+    if APP_CONFIG.tracing.metrics_port:
+        start_metrics_server(APP_CONFIG.tracing.metrics_port)
+        print(
+            f"Prometheus metrics at http://127.0.0.1:{APP_CONFIG.tracing.metrics_port}/metrics")
     demo.launch(
         server_name="127.0.0.1",
         server_port=7861,
         share=False,
         inbrowser=True,
-        show_error=True
+        show_error=True,
+        prevent_thread_lock=True
     )
+    rag_playground.techniques.mark_ready()
+    print("\n".join(rag_playground.techniques.startup_report()))
+    demo.block_thread()
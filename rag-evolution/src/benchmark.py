@@ -0,0 +1,323 @@
+"""Offline benchmark of the RAG techniques.
+
+Replays a query file against every technique and dataset with deterministic
+local stand-ins for the OpenAI models, over an in-memory Chroma built from
+DataPrep's datasets. No API key or network access is needed.
+
+    python src/benchmark.py --json results.json --csv results.csv
+    python src/benchmark.py --baseline results.json --max-regression 0.2
+"""
+import argparse
+import csv
+import importlib
+import json
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List
+
+SRC_DIR = Path(__file__).resolve().parent
+# Techniques import `src.*` while DataPrep imports its siblings directly
+sys.path[:0] = [str(SRC_DIR.parent), str(SRC_DIR)]
+
+import chromadb
+import numpy as np
+from chromadb.config import Settings
+from src.utils import model_factory
+from src.utils.embedding_cache import EmbeddingCache
+from src.utils.local_models import (RECORDER, LocalChatModel, LocalEmbeddings,
+                                    LocalEmbeddingsClient, LocalWebSearchClient)
+from src.utils.retrieval import BACKENDS, DATASETS, RetrievalService, set_retrieval_service
+from src.utils.tracing import JsonlExporter, add_exporter
+
+TECHNIQUES = {
+    "standard": ("src.rag_techniques.standard_rag", "StandardRAG"),
+    "conversational": ("src.rag_techniques.conversational_rag", "ConversationalRAG"),
+    "fusion": ("src.rag_techniques.fusion_rag", "FusionRAG"),
+    "hyde": ("src.rag_techniques.hyde_rag", "HydeRAG"),
+    "self": ("src.rag_techniques.self_rag", "SelfRAG"),
+    "adaptive": ("src.rag_techniques.adaptive_rag", "AdaptiveRAG"),
+    "corrective": ("src.rag_techniques.corrective_rag", "CorrectiveRAG"),
+    "agentic": ("src.rag_techniques.agentic_rag", "AgenticRAG"),
+    "speculative": ("src.rag_techniques.speculative_rag", "SpeculativeRAG"),
+}
+
+STAGES = ["llm", "embedding", "vector_search", "web_search", "other"]
+
+# Metrics checked by --baseline; lower is better for all of them
+REGRESSION_METRICS = {
+    "latency_p95": 0.005,  # absolute tolerance in seconds, absorbs timer noise
+    "llm_calls_mean": 0.0,
+    "embedding_calls_mean": 0.0,
+    "prompt_tokens_mean": 0.0,
+    "completion_tokens_mean": 0.0,
+}
+
+
+class TimedRetrievalService(RetrievalService):
+    """RetrievalService that reports time spent in Chroma queries to the recorder"""
+
+    def search(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().search(*args, **kwargs)
+        finally:
+            RECORDER.record("vector_search", time.perf_counter() - start)
+
+    def search_batch(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().search_batch(*args, **kwargs)
+        finally:
+            RECORDER.record("vector_search", time.perf_counter() - start)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_queries(path: Path) -> List[str]:
+    """One query per line; blank lines and lines starting with # are skipped"""
+    queries = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            queries.append(line)
+    return queries
+
+
+def build_service(embeddings: LocalEmbeddings, backend: str = "chroma",
+                  hybrid: bool = False) -> RetrievalService:
+    """Ingest DataPrep's datasets into an in-memory Chroma and serve it to the techniques"""
+    import data_processor
+
+    client = chromadb.EphemeralClient(
+        settings=Settings(anonymized_telemetry=False))
+    prep = data_processor.DataPrep(
+        embedding_client=LocalEmbeddingsClient(embeddings), client=client)
+    datasets = {
+        "tech_docs": prep._create_tech_docs_dataset(),
+        "faq_data": prep._create_faq_dataset(),
+        "news_articles": prep._create_news_dataset(),
+    }
+    for name, documents in datasets.items():
+        prep._populate_collection(name, documents)
+
+    workdir = Path(tempfile.mkdtemp(prefix="rag-benchmark-"))
+    service = TimedRetrievalService(
+        client=client, embeddings=embeddings, cache=EmbeddingCache(),
+        backend=backend, index_path=str(workdir / "vector_index"),
+        hybrid=hybrid, bm25_path=str(workdir / "bm25"))
+    set_retrieval_service(service)
+    return service
+
+
+def run_benchmark(args) -> Dict[str, Any]:
+    llm_latency = args.llm_latency_ms / 1000
+    embedding_latency = args.embedding_latency_ms / 1000
+    embeddings = LocalEmbeddings(latency_seconds=embedding_latency)
+    model_factory.override_models(
+        chat=lambda **kwargs: LocalChatModel(
+            latency_seconds=llm_latency, **kwargs),
+        embeddings=lambda **kwargs: embeddings,
+        web_search=lambda: LocalWebSearchClient(latency_seconds=llm_latency)
+    )
+    service = build_service(embeddings, args.backend, args.retrieval == "hybrid")
+    if args.traces:
+        add_exporter(JsonlExporter(args.traces).export)
+    queries = load_queries(Path(args.queries))
+
+    runs = []
+    for name in args.techniques:
+        module_name, class_name = TECHNIQUES[name]
+        technique = getattr(importlib.import_module(module_name), class_name)()
+
+        for _ in range(args.warmup):
+            technique.process_query(queries[0], args.datasets[0])
+        # Every technique starts from a cold query-embedding cache
+        service.embeddings.cache = EmbeddingCache()
+
+        for dataset in args.datasets:
+            for query in queries:
+                for repeat in range(args.repeat):
+                    random.seed(args.seed)
+                    RECORDER.reset()
+                    start = time.perf_counter()
+                    try:
+                        response, _ = technique.process_query(query, dataset)
+                        error = response.startswith("Error")
+                    except Exception as e:
+                        print(f"{name} failed on '{query}': {e}")
+                        error = True
+                    wall = time.perf_counter() - start
+
+                    calls = RECORDER.snapshot()
+                    stage_seconds = calls.pop("stage_seconds")
+                    # Concurrent calls overlap, so "other" is a lower bound
+                    stage_seconds["other"] = max(
+                        0.0, wall - sum(stage_seconds.values()))
+                    runs.append({
+                        "technique": name,
+                        "dataset": dataset,
+                        "query": query,
+                        "repeat": repeat,
+                        "error": error,
+                        "latency_seconds": wall,
+                        **calls,
+                        **{f"{stage}_seconds": stage_seconds.get(stage, 0.0) for stage in STAGES},
+                        "peak_rss_mb": peak_rss_mb(),
+                    })
+        print(f"Benchmarked {name}")
+
+    model_factory.override_models()
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "queries": len(queries),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "backend": args.backend,
+            "retrieval": args.retrieval,
+            "llm_latency_ms": args.llm_latency_ms,
+            "embedding_latency_ms": args.embedding_latency_ms,
+        },
+        "runs": runs,
+        "summary": summarize(runs),
+    }
+
+
+def summarize(runs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """p50/p95 latency and mean call counts per technique+dataset, plus an "all" row per technique"""
+    groups: Dict[tuple, List[Dict[str, Any]]] = {}
+    for run in runs:
+        groups.setdefault((run["technique"], run["dataset"]), []).append(run)
+        groups.setdefault((run["technique"], "all"), []).append(run)
+
+    summary = []
+    for (technique, dataset), group in groups.items():
+        latencies = np.array([run["latency_seconds"] for run in group])
+        row = {
+            "technique": technique,
+            "dataset": dataset,
+            "runs": len(group),
+            "errors": sum(run["error"] for run in group),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_mean": float(latencies.mean()),
+        }
+        for counter in ("llm_calls", "embedding_calls", "web_search_calls",
+                        "prompt_tokens", "completion_tokens"):
+            row[f"{counter}_mean"] = float(
+                np.mean([run[counter] for run in group]))
+        for stage in STAGES:
+            row[f"{stage}_seconds_mean"] = float(
+                np.mean([run[f"{stage}_seconds"] for run in group]))
+        row["peak_rss_mb"] = max(run["peak_rss_mb"] for run in group)
+        summary.append(row)
+    return summary
+
+
+def find_regressions(summary: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+                     max_regression: float) -> List[str]:
+    """Metrics that grew by more than max_regression (a fraction) over the baseline"""
+    previous = {(row["technique"], row["dataset"]): row for row in baseline}
+    regressions = []
+    for row in summary:
+        base = previous.get((row["technique"], row["dataset"]))
+        if base is None:
+            continue
+        for metric, tolerance in REGRESSION_METRICS.items():
+            limit = base[metric] * (1 + max_regression) + tolerance
+            if row[metric] > limit:
+                regressions.append(
+                    f"{row['technique']}/{row['dataset']} {metric}: "
+                    f"{row[metric]:.4f} > {limit:.4f} (baseline {base[metric]:.4f})")
+    return regressions
+
+
+def print_table(summary: List[Dict[str, Any]]):
+    print(f"\n{'technique':<15}{'p50 ms':>10}{'p95 ms':>10}{'LLM calls':>11}"
+          f"{'emb calls':>11}{'tokens':>10}{'errors':>8}")
+    for row in summary:
+        if row["dataset"] != "all":
+            continue
+        tokens = row["prompt_tokens_mean"] + row["completion_tokens_mean"]
+        print(f"{row['technique']:<15}{row['latency_p50'] * 1000:>10.1f}{row['latency_p95'] * 1000:>10.1f}"
+              f"{row['llm_calls_mean']:>11.1f}{row['embedding_calls_mean']:>11.1f}"
+              f"{tokens:>10.0f}{row['errors']:>8}")
+    print(f"\nPeak RSS: {max(row['peak_rss_mb'] for row in summary):.1f} MB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Offline latency / call-count benchmark of the RAG techniques")
+    parser.add_argument("--queries", default=str(SRC_DIR.parent / "configs" / "benchmark_queries.txt"),
+                        help="query file, one query per line")
+    parser.add_argument("--techniques", nargs="+", choices=list(TECHNIQUES),
+                        default=list(TECHNIQUES))
+    parser.add_argument("--datasets", nargs="+",
+                        choices=DATASETS, default=DATASETS)
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per technique, dataset and query")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="untimed runs per technique before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=BACKENDS, default="chroma",
+                        help="vector index backend the techniques search")
+    parser.add_argument("--retrieval", choices=["dense", "hybrid"], default="dense",
+                        help="dense search only, or BM25 + dense fused")
+    parser.add_argument("--llm-latency-ms", type=float, default=20.0,
+                        help="simulated latency of each LLM and web search call")
+    parser.add_argument("--embedding-latency-ms", type=float, default=2.0,
+                        help="simulated latency of each embeddings request")
+    parser.add_argument("--json", help="write runs and summary to this JSON file")
+    parser.add_argument("--csv", help="write the summary to this CSV file")
+    parser.add_argument("--traces",
+                        help="append the span trace of every run to this JSONL file")
+    parser.add_argument("--baseline",
+                        help="JSON output of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed growth over the baseline, as a fraction (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    results = run_benchmark(args)
+    summary = results["summary"]
+    print_table(summary)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+        print(f"Wrote {args.json}")
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(summary[0]))
+            writer.writeheader()
+            writer.writerows(summary)
+        print(f"Wrote {args.csv}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())["summary"]
+        regressions = find_regressions(summary, baseline, args.max_regression)
+        if regressions:
+            print(
+                f"\n{len(regressions)} regression(s) over {args.max_regression:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regressions over {args.max_regression:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""Recall / latency comparison of Chroma against the memory-mapped vector index.
+
+Queries are stored embeddings plus a little noise, so no embeddings API is
+needed. Recall@k is measured against an exact float64 search.
+
+    python src/compare_vector_index.py                          # synthetic corpus
+    python src/compare_vector_index.py --synthetic 200000 --probes 4 8 16
+    python src/compare_vector_index.py --chroma-path data/chroma_db
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+SRC_DIR = Path(__file__).resolve().parent
+sys.path[:0] = [str(SRC_DIR.parent), str(SRC_DIR)]
+
+import chromadb
+import numpy as np
+from chromadb.config import Settings
+from src.utils.vector_index import MmapVectorIndex
+
+
+def synthetic_collection(client, size: int, dim: int, clusters: int, seed: int):
+    """Collection of unit vectors drawn around random cluster centres"""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    vectors = centres[rng.integers(clusters, size=size)] + \
+        0.5 * rng.normal(size=(size, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    collection = client.create_collection(f"synthetic_{size}")
+    batch_size = client.get_max_batch_size()
+    for start in range(0, size, batch_size):
+        end = min(start + batch_size, size)
+        collection.add(ids=[f"doc_{i}" for i in range(start, end)],
+                       embeddings=vectors[start:end].tolist(),
+                       documents=[f"document {i}" for i in range(start, end)],
+                       metadatas=[{"cluster": int(i % clusters)} for i in range(start, end)])
+    return collection
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    """Ground truth: squared L2 in float64 over every vector"""
+    vectors = vectors.astype(np.float64)
+    sq_norms = (vectors ** 2).sum(axis=1)
+    truth = []
+    for query in queries.astype(np.float64):
+        distances = sq_norms - 2 * vectors @ query
+        truth.append(set(np.argsort(distances)[:k].tolist()))
+    return truth
+
+
+def measure(name: str, search, queries: np.ndarray, truth: List[set], k: int,
+            build_seconds: float = 0.0, size_mb: float = 0.0) -> Dict[str, Any]:
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        rows = search(query)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(set(rows) & expected) / k)
+    latencies = np.array(latencies) * 1000
+    return {
+        "backend": name,
+        "recall": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "build_seconds": build_seconds,
+        "size_mb": size_mb,
+    }
+
+
+def directory_mb(directory: Path) -> float:
+    return sum(f.stat().st_size for f in directory.iterdir()) / (1024 * 1024)
+
+
+def compare_collection(collection, args, workdir: Path) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(args.seed)
+
+    start = time.perf_counter()
+    flat = MmapVectorIndex.export(collection, workdir / "flat32", version=None)
+    flat_seconds = time.perf_counter() - start
+    vectors = np.asarray(flat.vectors)
+    if len(vectors) == 0:
+        return []
+
+    queries = vectors[rng.integers(len(vectors), size=args.queries)]
+    queries = queries + args.noise * rng.normal(size=queries.shape)
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+    k = min(args.k, len(vectors))
+    truth = exact_top_k(vectors, queries, k)
+    row_of = {doc_id: row for row, doc_id in enumerate(flat.ids)}
+
+    def chroma_search(query):
+        result = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+        return [row_of[doc_id] for doc_id in result["ids"][0]]
+
+    def index_search(index, probes=8):
+        return lambda query: [row for row, _ in index.search([query], k=k, n_probes=probes)[0]]
+
+    results = [
+        measure("chroma (hnsw)", chroma_search, queries, truth, k),
+        measure("mmap flat float32", index_search(flat), queries, truth, k,
+                flat_seconds, directory_mb(workdir / "flat32")),
+    ]
+
+    start = time.perf_counter()
+    half = MmapVectorIndex.export(collection, workdir / "flat16", version=None, dtype="float16")
+    results.append(measure("mmap flat float16", index_search(half), queries, truth, k,
+                           time.perf_counter() - start, directory_mb(workdir / "flat16")))
+
+    start = time.perf_counter()
+    ivf = MmapVectorIndex.export(collection, workdir / "ivf", version=None,
+                                 ivf_min_vectors=0, ivf_lists=args.ivf_lists)
+    ivf_seconds = time.perf_counter() - start
+    for probes in args.probes:
+        results.append(measure(f"mmap ivf{len(ivf.centroids)} probes={probes}",
+                               index_search(ivf, probes), queries, truth, k,
+                               ivf_seconds, directory_mb(workdir / "ivf")))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Recall/latency of Chroma vs the memory-mapped flat and IVF index")
+    parser.add_argument("--chroma-path",
+                        help="persistent Chroma directory to compare on (default: a synthetic corpus)")
+    parser.add_argument("--synthetic", type=int, default=20000,
+                        help="vectors in the synthetic corpus")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=64)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.05,
+                        help="gaussian noise added to the stored vectors used as queries")
+    parser.add_argument("--ivf-lists", type=int, default=None,
+                        help="IVF lists (default: sqrt of the collection size)")
+    parser.add_argument("--probes", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this JSON file")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    settings = Settings(anonymized_telemetry=False)
+    if args.chroma_path:
+        client = chromadb.PersistentClient(path=args.chroma_path, settings=settings)
+        collections = [client.get_collection(c if isinstance(c, str) else c.name)
+                       for c in client.list_collections()]
+    else:
+        client = chromadb.EphemeralClient(settings=settings)
+        collections = [synthetic_collection(client, args.synthetic, args.dim,
+                                            args.clusters, args.seed)]
+
+    report = {}
+    with tempfile.TemporaryDirectory(prefix="rag-index-compare-") as tmp:
+        for collection in collections:
+            print(f"\n{collection.name} ({collection.count()} vectors, k={args.k})")
+            rows = compare_collection(collection, args, Path(tmp) / collection.name)
+            report[collection.name] = rows
+            print(f"{'backend':<28}{'recall':>8}{'p50 ms':>9}{'p95 ms':>9}"
+                  f"{'build s':>9}{'MB':>8}")
+            for row in rows:
+                print(f"{row['backend']:<28}{row['recall']:>8.3f}{row['p50_ms']:>9.3f}"
+                      f"{row['p95_ms']:>9.3f}{row['build_seconds']:>9.2f}{row['size_mb']:>8.1f}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+        print(f"Wrote {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,110 @@
+import hashlib
+import json
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 import chromadb
-from openai import OpenAI
-from typing import List, Dict
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from typing import List, Dict, Optional
 from pyprojroot import here
 from load_config import APPConfig
+from utils.bm25 import BM25Index
+from utils.tokens import clip_to_tokens, count_tokens
 
 # Load application configuration
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
-
-# Configure OpenAI Client - using the same pattern as your working file
-client = OpenAI()  # Will use OPENAI_API_KEY from environment
+# Errors worth retrying with backoff; anything else fails the batch immediately
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError,
+                    APITimeoutError, InternalServerError)
 
 
 class DataPrep:
-    def __init__(self):
-        self.client = chromadb.PersistentClient(
+    def __init__(self, embedding_client=None, client=None):
+        self.client = client or chromadb.PersistentClient(
             path=str(here(APP_CONFIG.chroma_db_path)))
+        # Anything exposing the OpenAI `embeddings.create` API
+        # Will use OPENAI_API_KEY from environment
+        self.embedding_client = embedding_client or OpenAI()
 
-    def _get_embedding(self, text: str) -> List[float]:
-        """Get OpenAI embedding for text using latest model"""
-        try:
-            response = client.embeddings.create(
-                model=APP_CONFIG.embedding_model,  # Latest embedding model
-                input=text,
-                encoding_format="float"
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"Error getting embedding: {e}")
-            return []
+    def _make_batches(self, texts: List[str]) -> List[List[int]]:
+        """Group text indices into requests that respect the token and input limits"""
+        config = APP_CONFIG.ingestion
+        batches = []
+        current, current_tokens = [], 0
+
+        for i, text in enumerate(texts):
+            tokens = count_tokens(text, APP_CONFIG.embedding_model)
+            if current and (current_tokens + tokens > config.max_tokens_per_request
+                            or len(current) >= config.max_inputs_per_request):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+
+        if current:
+            batches.append(current)
+        return batches
+
+    def _truncate(self, text: str) -> str:
+        """Cut a document down to the embedding model's input limit"""
+        return clip_to_tokens(text, APP_CONFIG.ingestion.max_tokens_per_document,
+                              APP_CONFIG.embedding_model, suffix="")
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed one batch in a single request, retrying transient errors with exponential backoff"""
+        config = APP_CONFIG.ingestion
+        for attempt in range(config.max_retries + 1):
+            try:
+                response = self.embedding_client.embeddings.create(
+                    model=APP_CONFIG.embedding_model,  # Latest embedding model
+                    input=texts,
+                    encoding_format="float"
+                )
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except RETRYABLE_ERRORS as e:
+                if attempt == config.max_retries:
+                    raise
+                # Exponential backoff with jitter so parallel batches do not retry in lockstep
+                delay = config.initial_backoff_seconds * \
+                    (2 ** attempt) * (1 + random.random())
+                print(
+                    f"{type(e).__name__} on a batch of {len(texts)} documents, retrying in {delay:.1f}s "
+                    f"(attempt {attempt + 1}/{config.max_retries})")
+                time.sleep(delay)
+
+    def _embed_documents(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Embed texts with token-aware batching on a bounded pool of concurrent requests.
+
+        Returns one embedding per text, or None for texts whose batch failed
+        after all retries.
+        """
+        texts = [self._truncate(text) for text in texts]
+        batches = self._make_batches(texts)
+        embeddings = [None] * len(texts)
+        if not batches:
+            return embeddings
+
+        def run(batch: List[int]):
+            return batch, self._embed_batch([texts[i] for i in batch])
+
+        with ThreadPoolExecutor(max_workers=APP_CONFIG.ingestion.max_concurrency) as executor:
+            futures = [executor.submit(run, batch) for batch in batches]
+            for done, future in enumerate(futures, 1):
+                try:
+                    batch, batch_embeddings = future.result()
+                except Exception as e:
+                    print(
+                        f"Embedding batch {done}/{len(batches)} failed: {e}")
+                    continue
+                for i, embedding in zip(batch, batch_embeddings):
+                    embeddings[i] = embedding
+                print(
+                    f"Embedded batch {done}/{len(batches)} ({len(batch)} documents)")
+
+        return embeddings
 
     def _create_tech_docs_dataset(self) -> List[Dict]:
         """Create technical documentation dataset"""
@@ -345,56 +421,129 @@ class DataPrep:
             }
         ]
 
-    def _populate_collection(self, collection_name: str, documents: List[Dict]):
-        """Populate ChromaDB collection with documents"""
-        try:
-            # Try to delete existing collection and create fresh one
-            try:
-                self.client.delete_collection(collection_name)
-                print(f"Deleted existing collection: {collection_name}")
-            except:
-                print(
-                    f"Collection {collection_name} doesn't exist, creating new one")
+    def _stored_metadata(self, doc: Dict) -> Dict:
+        """Document metadata plus derived fields for `where` filters (Chroma's $gt/$lt need numbers)"""
+        metadata = dict(doc['metadata'])
+        if "date" in metadata:
+            published = date.fromisoformat(metadata["date"])
+            metadata["year"] = published.year
+            metadata["date_ordinal"] = published.toordinal()
+        return metadata
 
-            # Create fresh collection
-            collection = self.client.create_collection(collection_name)
+    def _content_hash(self, doc: Dict) -> str:
+        """Hash of everything that ends up in the collection for a document"""
+        payload = json.dumps({
+            "model": APP_CONFIG.embedding_model,
+            "content": doc['content'],
+            "metadata": self._stored_metadata(doc)
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-            # Prepare data for ChromaDB
-            ids = []
-            texts = []
-            metadatas = []
-            embeddings = []
+    def _existing_hashes(self, collection) -> Dict[str, Optional[str]]:
+        """Content hash of every id already in the collection, read page by page"""
+        hashes = {}
+        page_size = APP_CONFIG.ingestion.add_batch_size
+        offset = 0
+        while True:
+            page = collection.get(
+                include=["metadatas"], limit=page_size, offset=offset)
+            for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+                hashes[doc_id] = (metadata or {}).get("content_hash")
+            if len(page["ids"]) < page_size:
+                return hashes
+            offset += page_size
+
+    def _populate_collection(self, collection_name: str, documents: List[Dict]) -> Optional[str]:
+        """Sync a ChromaDB collection with documents, embedding only new or changed ones"""
+        try:
+            collection = self.client.get_or_create_collection(collection_name)
+            existing = self._existing_hashes(collection)
 
             print(
-                f"Processing {len(documents)} documents for {collection_name}...")
+                f"Processing {len(documents)} documents for {collection_name} ({len(existing)} already stored)...")
 
+            # Diff the documents against what is stored
+            added, updated, unchanged = [], [], 0
             for doc in documents:
-                # Get embedding for the document content
-                embedding = self._get_embedding(doc['content'])
-                if embedding:
-                    ids.append(doc['id'])
-                    texts.append(doc['content'])
-                    metadatas.append(doc['metadata'])
-                    embeddings.append(embedding)
-                    print(f"Processed {doc['id']}")
+                content_hash = self._content_hash(doc)
+                if doc['id'] not in existing:
+                    added.append((doc, content_hash))
+                elif existing[doc['id']] != content_hash:
+                    updated.append((doc, content_hash))
                 else:
+                    unchanged += 1
+            current_ids = {doc['id'] for doc in documents}
+            removed = [doc_id for doc_id in existing if doc_id not in current_ids]
+
+            changed = added + updated
+            embeddings = self._embed_documents(
+                [doc['content'] for doc, _ in changed])
+
+            # Prepare data for ChromaDB
+            ids = []
+            texts = []
+            metadatas = []
+            vectors = []
+            failed = set()
+            for (doc, content_hash), embedding in zip(changed, embeddings):
+                if embedding is None:
                     print(f"Failed to get embedding for {doc['id']}")
+                    failed.add(doc['id'])
+                    continue
+                ids.append(doc['id'])
+                texts.append(doc['content'])
+                metadatas.append(
+                    {**self._stored_metadata(doc), "content_hash": content_hash})
+                vectors.append(embedding)
 
-            # Add to collection
-            if ids:
-                collection.add(
-                    ids=ids,
-                    documents=texts,
-                    metadatas=metadatas,
-                    embeddings=embeddings
+            # Write in chunks to stay under Chroma's max batch size
+            batch_size = APP_CONFIG.ingestion.add_batch_size
+            for start in range(0, len(ids), batch_size):
+                end = start + batch_size
+                collection.upsert(
+                    ids=ids[start:end],
+                    documents=texts[start:end],
+                    metadatas=metadatas[start:end],
+                    embeddings=vectors[start:end]
                 )
-                print(
-                    f"Successfully added {len(ids)} documents to {collection_name}")
-            else:
-                print(f"No documents were added to {collection_name}")
+            for start in range(0, len(removed), batch_size):
+                collection.delete(ids=removed[start:start + batch_size])
+
+            if ids or removed:
+                # New version lets the playground drop answers cached for the old contents
+                metadata = {key: value for key, value in (collection.metadata or {}).items()
+                            if not key.startswith("hnsw:")}
+                collection.modify(
+                    metadata={**metadata, "version": uuid.uuid4().hex})
+
+            added_count = sum(1 for doc, _ in added if doc['id'] not in failed)
+            updated_count = sum(1 for doc, _ in updated if doc['id'] not in failed)
+            summary = (f"{collection_name}: {added_count} added, {updated_count} updated, "
+                       f"{len(removed)} removed, {unchanged} unchanged")
+            if failed:
+                summary += f", {len(failed)} failed"
+            print(summary)
+            return summary
 
         except Exception as e:
             print(f"Error populating collection {collection_name}: {e}")
+            return None
+
+    def _save_bm25_index(self, collection_name: str):
+        """Write the dataset's BM25 index for hybrid retrieval, unless it is already current"""
+        config = APP_CONFIG.hybrid_retrieval
+        collection = self.client.get_collection(collection_name)
+        version = (collection.metadata or {}).get("version")
+        path = here(config.bm25_path) / f"{collection_name}.json"
+        if path.exists():
+            index = BM25Index.load(path)
+            if index.version == version and len(index) == collection.count():
+                return
+        index = BM25Index.from_collection(
+            collection, version, k1=config.k1, b=config.b)
+        index.save(path)
+        print(
+            f"{collection_name}: BM25 index of {len(index)} documents, {len(index.postings)} terms")
 
     def setup_all_datasets(self):
         """Setup all datasets in ChromaDB"""
@@ -406,9 +555,13 @@ class DataPrep:
         news_articles = self._create_news_dataset()
 
         # Populate collections
-        self._populate_collection("tech_docs", tech_docs)
-        self._populate_collection("faq_data", faq_data)
-        self._populate_collection("news_articles", news_articles)
+        diffs = [
+            self._populate_collection("tech_docs", tech_docs),
+            self._populate_collection("faq_data", faq_data),
+            self._populate_collection("news_articles", news_articles)
+        ]
+        for collection_name in ["tech_docs", "faq_data", "news_articles"]:
+            self._save_bm25_index(collection_name)
 
         print("Dataset setup complete!")
 
@@ -422,6 +575,11 @@ class DataPrep:
             except:
                 print(f"{collection_name}: Collection not found")
 
+        print("\n=== Changes ===")
+        for diff in diffs:
+            if diff:
+                print(diff)
+
 
 if __name__ == "__main__":
     processor = DataPrep()
@@ -1,29 +1,124 @@
 from pathlib import Path
 import yaml
 import os
+import threading
 from pyprojroot import here
 from dotenv import load_dotenv
 from dataclasses import dataclass
+from typing import Dict, List, Optional
 load_dotenv()
 
 CONFIG_PATH = here("configs/config.yml")
 
+# Parsed configurations by resolved path; every module shares one instance per file
+_LOADED: Dict[str, "APPConfig"] = {}
+_LOAD_LOCK = threading.Lock()
+
+
+@dataclass
+class EmbeddingCacheConfig:
+    max_entries: int
+    ttl_seconds: Optional[float]
+    persist_path: Optional[str]
+    max_persisted_entries: Optional[int]
+
+
+@dataclass
+class DocumentGradingConfig:
+    mode: str
+    max_concurrency: int
+
+
+@dataclass
+class ContextPackingConfig:
+    similarity_threshold: float
+    shingle_size: int
+    num_permutations: int
+    min_passage_tokens: int
+
+
+@dataclass
+class AnswerCacheConfig:
+    enabled: bool
+    similarity_threshold: float
+    max_entries: int
+
+
+@dataclass
+class VectorIndexConfig:
+    backend: str
+    path: str
+    dtype: str
+    ivf_min_vectors: Optional[int]
+    ivf_lists: Optional[int]
+    ivf_probes: int
+
+
+@dataclass
+class HybridRetrievalConfig:
+    enabled: bool
+    bm25_path: str
+    dense_weight: float
+    lexical_weight: float
+    candidates: int
+    k1: float
+    b: float
+
+
+@dataclass
+class SessionStoreConfig:
+    path: Optional[str]
+    max_sessions: int
+    max_exchanges: int
+    history_token_budget: int
+    idle_ttl_seconds: Optional[float]
+
+
+@dataclass
+class PlaygroundConfig:
+    warm_up_techniques: List[str]
+
+
+@dataclass
+class TracingConfig:
+    jsonl_path: Optional[str]
+    metrics_port: Optional[int]
+
+
+@dataclass
+class IngestionConfig:
+    max_tokens_per_request: int
+    max_inputs_per_request: int
+    max_tokens_per_document: int
+    max_concurrency: int
+    max_retries: int
+    initial_backoff_seconds: float
+    add_batch_size: int
+
 
 @dataclass
 class CorrectiveRAGConfig:
     llm_model: str
     web_search_model: str
+    web_search_deadline_seconds: float
+    web_cache_ttl_seconds: Optional[float]
+    web_cache_max_entries: int
     temperature: float
     top_k: int
+    context_token_budget: Optional[int]
 
 
 @dataclass
 class AdaptiveRAGConfig:
     llm_model: str
     temperature: float
+    router_examples_path: Optional[str]
+    router_min_margin: float
+    router_cache_max_entries: int
     standard_retrieval_top_k: int
     multi_retrieval_first_top_k: int
     multi_retrieval_second_top_k: int
+    context_token_budget: Optional[int]
 
 
 @dataclass
@@ -32,6 +127,10 @@ class AgenticRAGConfig:
     temperature: float
     top_k: int
     other_retrieval_top_k: int
+    recent_days: int
+    web_search_model: str
+    research_deadline_seconds: float
+    context_token_budget: Optional[int]
 
 
 @dataclass
@@ -39,6 +138,7 @@ class ConversationalRAGConfig:
     llm_model: str
     temperature: float
     top_k: int
+    context_token_budget: Optional[int]
 
 
 @dataclass
@@ -48,6 +148,10 @@ class FusionRAGConfig:
     answer_generator_llm_model: str
     answer_generator_temperature: float
     top_k: int
+    rrf_k: float
+    original_query_weight: float
+    min_fused_score: float
+    context_token_budget: Optional[int]
 
 
 @dataclass
@@ -56,6 +160,8 @@ class HydeRAGConfig:
     temperature: float
     hypothetical_doc_retrieval_top_k: int
     direct_retrieval_top_k: int
+    hypothetical_doc_cache_max_entries: int
+    context_token_budget: Optional[int]
 
 
 @dataclass
@@ -63,6 +169,11 @@ class SelfRAGConfig:
     llm_model: str
     temperature: float
     top_k: int
+    max_retries: int
+    latency_budget_seconds: Optional[float]
+    token_budget: Optional[int]
+    grade_memo_max_entries: int
+    context_token_budget: Optional[int]
 
 
 @dataclass
@@ -72,6 +183,9 @@ class SpeculativeRAGConfig:
     verifier_llm_model: str
     verifier_temperature: float
     top_k: int
+    max_concurrency: int
+    call_timeout_seconds: float
+    context_token_budget: Optional[int]
 
 
 @dataclass
@@ -79,12 +193,23 @@ class StandardRAGConfig:
     llm_model: str
     temperature: float
     top_k: int
+    context_token_budget: Optional[int]
 
 
 @dataclass
 class APPConfig:
     chroma_db_path: str
     embedding_model: str
+    embedding_cache: EmbeddingCacheConfig
+    vector_index: VectorIndexConfig
+    hybrid_retrieval: HybridRetrievalConfig
+    ingestion: IngestionConfig
+    answer_cache: AnswerCacheConfig
+    session_store: SessionStoreConfig
+    playground: PlaygroundConfig
+    tracing: TracingConfig
+    document_grading: DocumentGradingConfig
+    context_packing: ContextPackingConfig
     corrective_rag: CorrectiveRAGConfig
     adaptive_rag: AdaptiveRAGConfig
     agentic_rag: AgenticRAGConfig
@@ -104,13 +229,32 @@ class APPConfig:
             print("⚠️ Warning: OPENAI_API_KEY not found in environment variables.")
 
     @classmethod
-    def load(cls, path: str = CONFIG_PATH) -> "APPConfig":
+    def load(cls, path: str = CONFIG_PATH, reload: bool = False) -> "APPConfig":
+        """The configuration at `path`, read once per process and shared by every caller"""
+        key = str(Path(path).resolve())
+        with _LOAD_LOCK:
+            if reload or key not in _LOADED:
+                _LOADED[key] = cls._read(path)
+            return _LOADED[key]
+
+    @classmethod
+    def _read(cls, path: str) -> "APPConfig":
         with open(Path(path), "r") as f:
             cfg = yaml.safe_load(f)
 
         return cls(
             chroma_db_path=cfg["chroma_db_path"],
             embedding_model=cfg["embedding_model"],
+            embedding_cache=EmbeddingCacheConfig(**cfg["embedding_cache"]),
+            vector_index=VectorIndexConfig(**cfg["vector_index"]),
+            hybrid_retrieval=HybridRetrievalConfig(**cfg["hybrid_retrieval"]),
+            ingestion=IngestionConfig(**cfg["ingestion"]),
+            answer_cache=AnswerCacheConfig(**cfg["answer_cache"]),
+            session_store=SessionStoreConfig(**cfg["session_store"]),
+            playground=PlaygroundConfig(**cfg["playground"]),
+            tracing=TracingConfig(**cfg["tracing"]),
+            document_grading=DocumentGradingConfig(**cfg["document_grading"]),
+            context_packing=ContextPackingConfig(**cfg["context_packing"]),
             corrective_rag=CorrectiveRAGConfig(**cfg["corrective_rag"]),
             adaptive_rag=AdaptiveRAGConfig(**cfg["adaptive_rag"]),
             agentic_rag=AgenticRAGConfig(**cfg["agentic_rag"]),
@@ -127,4 +271,5 @@ class APPConfig:
 # config = APPConfig.load("configs/config.yml")
 # or
 # config = APPConfig.load()  # uses default path
+# config = APPConfig.load(reload=True)  # re-read the file after editing it
 # print(config.corrective_rag.llm_model)
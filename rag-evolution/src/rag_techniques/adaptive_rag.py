@@ -1,76 +1,42 @@
-from typing import List, Tuple, Literal
-from pyprojroot import here
+from typing import List, Tuple, Literal, Any, AsyncIterator, Iterator, Optional
 from pydantic import BaseModel, Field
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from langchain.prompts import ChatPromptTemplate
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-import chromadb
-from langchain.schema import Document
+from langchain_core.prompts import ChatPromptTemplate
+from pyprojroot import here
 from src.load_config import APPConfig
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers, get_retrieval_service
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, span, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
+from src.utils.document_grading import DocumentGrader
+from src.utils.query_router import EmbeddingRouter, load_examples
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class AdaptiveRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.llm = ChatOpenAI(
+        self.llm = create_chat_model(
             model=APP_CONFIG.adaptive_rag.llm_model,
             temperature=APP_CONFIG.adaptive_rag.temperature
         )
-        self.logs = []
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.adaptive_rag.context_token_budget)
         self.retrievers = {}
         self._setup_retrievers()
         self._setup_graders()
+        self._setup_embedding_router()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 3):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _setup_graders(self):
-        """Setup document relevance graders"""
+        """Setup query router and document relevance grader"""
 
         # Data models for structured output
         class RouteQuery(BaseModel):
@@ -80,18 +46,9 @@ class AdaptiveRAG:
                 description="Choose retrieval strategy: standard for simple queries, multi_retrieval for complex queries, rewrite for unclear queries"
             )
 
-        class GradeDocuments(BaseModel):
-            """Binary score for relevance check on retrieved documents."""
-            binary_score: str = Field(
-                description="Documents are relevant to the question, 'yes' or 'no'"
-            )
-
         # Route query LLM
         self.query_router_llm = self.llm.with_structured_output(RouteQuery)
 
-        # Document grader LLM
-        self.doc_grader_llm = self.llm.with_structured_output(GradeDocuments)
-
         # Route prompt
         route_system = """You are an expert at determining the best retrieval strategy for different types of queries.
 
@@ -117,13 +74,10 @@ class AdaptiveRAG:
                 Only filter out documents that are completely unrelated to the topic.
                 Give a binary score 'yes' or 'no'."""
 
-        self.grade_prompt = ChatPromptTemplate.from_messages([
-            ("system", grade_system),
-            ("human",
-             "Retrieved document: \n\n {document} \n\n User question: {question}")
-        ])
-
-        self.doc_grader = self.grade_prompt | self.doc_grader_llm
+        self.document_grader = DocumentGrader(
+            self.llm, grade_system,
+            mode=APP_CONFIG.document_grading.mode,
+            max_concurrency=APP_CONFIG.document_grading.max_concurrency)
 
         # Query rewriter
         rewrite_system = """You are a query rewriter that converts unclear or vague questions into clearer, more specific questions optimized for retrieval.
@@ -142,23 +96,37 @@ class AdaptiveRAG:
 
         self.query_rewriter = self.rewrite_prompt | self.llm | StrOutputParser()
 
-    def _log(self, message: str):
-        """Enhanced logging with visual separators"""
-        log_entry = f"ADAPTIVE RAG: {message}"
-        self.logs.append(log_entry)
+    def _setup_embedding_router(self):
+        """Setup the local nearest-centroid router that answers confident routes without the LLM"""
+        self.embedding_router = None
+        examples_path = APP_CONFIG.adaptive_rag.router_examples_path
+        if examples_path:
+            self.embedding_router = EmbeddingRouter(
+                load_examples(here(examples_path)),
+                min_margin=APP_CONFIG.adaptive_rag.router_min_margin,
+                cache_max_entries=APP_CONFIG.adaptive_rag.router_cache_max_entries
+            )
 
-        # Add visual separator after key steps
-        if any(step in message for step in ["Strategy:", "Step", "Decision:"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
+    def _log(self, message: str):
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
-    def _route_query(self, query: str) -> str:
+    async def _aroute_query(self, query: str) -> str:
         """Route query to appropriate strategy"""
         self._log("Route Analysis: Determining optimal retrieval strategy")
 
-        route_result = self.query_router.invoke({"question": query})
-        strategy = route_result.strategy
+        with span("route") as route:
+            strategy = await self._alocal_route(query, route)
+            if strategy is None:
+                route.set(source="llm")
+                route_result = await self.query_router.ainvoke({"question": query})
+                strategy = route_result.strategy
+                if self.embedding_router is not None:
+                    self.embedding_router.remember(query, strategy, "llm")
+            route.set(strategy=strategy)
+
+        if self.embedding_router is not None:
+            self._log(f"Router: {self.embedding_router.stats_line()}")
 
         strategy_descriptions = {
             "standard": "Standard retrieval for clear, direct questions",
@@ -170,7 +138,39 @@ class AdaptiveRAG:
             f"Strategy: Selected '{strategy}' - {strategy_descriptions[strategy]}")
         return strategy
 
-    def _grade_documents(self, query: str, documents: List) -> List:
+    async def _alocal_route(self, query: str, route) -> Optional[str]:
+        """Strategy from the decision cache or a confident embedding match, else None"""
+        if self.embedding_router is None:
+            return None
+
+        decision = self.embedding_router.cached(query)
+        if decision is not None:
+            route.set(source="cache")
+            self._log(f"Router: Reusing the cached '{decision[0]}' decision ({decision[1]})")
+            return decision[0]
+
+        try:
+            # The query embedding is cached, so retrieval reuses it right after
+            embeddings = get_retrieval_service().embeddings
+            await self.embedding_router.afit(embeddings)
+            embedding, _ = await embeddings.aembed_query_with_status(query)
+        except Exception as e:
+            self._log(f"Router: Embedding router unavailable - {str(e)}")
+            return None
+
+        strategy, margin = self.embedding_router.classify(embedding)
+        route.set(margin=round(margin, 4))
+        if not self.embedding_router.is_confident(margin):
+            self._log(
+                f"Router: Ambiguous ('{strategy}' by {margin:.3f} < {self.embedding_router.min_margin}) - asking the LLM router")
+            return None
+
+        route.set(source="embedding")
+        self._log(f"Router: Embedding match '{strategy}' (margin {margin:.3f}) - skipped the LLM router")
+        self.embedding_router.remember(query, strategy, "local")
+        return strategy
+
+    async def _agrade_documents(self, query: str, documents: List) -> List:
         """Grade document relevance and filter out irrelevant docs"""
         if not documents:
             return documents
@@ -178,56 +178,58 @@ class AdaptiveRAG:
         self._log(
             f"Document Grading: Evaluating {len(documents)} retrieved documents")
 
+        grading = await self.document_grader.agrade(query, documents)
+
         relevant_docs = []
         for i, doc in enumerate(documents):
-            score = self.doc_grader.invoke({
-                "question": query,
-                "document": doc.page_content
-            })
-
-            if score.binary_score == "yes":
+            if grading.errors[i]:
+                self._log(
+                    f"✗ Document {i+1}: Grading failed - {grading.errors[i]}")
+            elif grading.is_relevant(i):
                 relevant_docs.append(doc)
                 self._log(f"✓ Document {i+1}: Relevant")
             else:
                 self._log(f"✗ Document {i+1}: Not relevant - filtered out")
 
+        self._log(f"Grading engine: {grading.summary()}")
         self._log(
             f"Filtering Results: {len(relevant_docs)}/{len(documents)} documents passed relevance check")
         return relevant_docs
 
-    def _rewrite_query(self, query: str) -> str:
+    async def _arewrite_query(self, query: str) -> str:
         """Rewrite unclear queries for better retrieval"""
         self._log("Query Rewriting: Improving unclear query for better retrieval")
 
-        rewritten = self.query_rewriter.invoke({"question": query})
+        with span("rewrite"):
+            rewritten = await self.query_rewriter.ainvoke({"question": query})
         self._log(f"Original: '{query[:60]}...'")
         self._log(f"Rewritten: '{rewritten[:60]}...'")
 
         return rewritten
 
-    def _standard_retrieval(self, query: str, dataset: str) -> List:
+    async def _astandard_retrieval(self, query: str, dataset: str) -> List:
         """Standard single-pass retrieval"""
         self._log("Step 1: Standard retrieval - single similarity search")
         retriever = self.retrievers[dataset]
-        docs = retriever.get_relevant_documents(
+        docs = await retriever.aget_relevant_documents(
             query, k=APP_CONFIG.adaptive_rag.standard_retrieval_top_k)
         self._log(
             f"Retrieved {len(docs)} documents using standard similarity search")
         return docs
 
-    def _multi_retrieval(self, query: str, dataset: str) -> List:
+    async def _amulti_retrieval(self, query: str, dataset: str) -> List:
         """Multi-step retrieval for complex queries"""
         self._log("Step 1: Multi-step retrieval - expanding search strategy")
 
         # First retrieval
         retriever = self.retrievers[dataset]
-        docs1 = retriever.get_relevant_documents(
+        docs1 = await retriever.aget_relevant_documents(
             query, k=APP_CONFIG.adaptive_rag.multi_retrieval_first_top_k)
         self._log(f"Initial retrieval: {len(docs1)} documents")
 
         # Generate alternative query formulations for complex topics
         alt_query_prompt = f"Alternative ways to search for: {query}"
-        docs2 = retriever.get_relevant_documents(
+        docs2 = await retriever.aget_relevant_documents(
             alt_query_prompt, k=APP_CONFIG.adaptive_rag.multi_retrieval_second_top_k)
         self._log(f"Alternative search: {len(docs2)} additional documents")
 
@@ -246,38 +248,41 @@ class AdaptiveRAG:
         return unique_docs
 
     def process_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+        return run_sync(self.aprocess_query(query, dataset))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
         self._log("Starting Adaptive RAG pipeline")
 
         try:
             if dataset not in self.retrievers:
-                return f"Dataset {dataset} not available", self.logs
+                return f"Dataset {dataset} not available", current_logs()
 
             # Step 1: Route query to determine strategy
-            strategy = self._route_query(query)
+            strategy = await self._aroute_query(query)
 
             # Step 2: Execute retrieval based on strategy
             if strategy == "rewrite":
                 # Rewrite query first, then use standard retrieval
-                improved_query = self._rewrite_query(query)
-                documents = self._standard_retrieval(improved_query, dataset)
+                improved_query = await self._arewrite_query(query)
+                documents = await self._astandard_retrieval(improved_query, dataset)
             elif strategy == "multi_retrieval":
-                documents = self._multi_retrieval(query, dataset)
+                documents = await self._amulti_retrieval(query, dataset)
             else:  # standard
-                documents = self._standard_retrieval(query, dataset)
+                documents = await self._astandard_retrieval(query, dataset)
 
             # Step 3: Grade and filter documents
-            filtered_docs = self._grade_documents(query, documents)
+            filtered_docs = await self._agrade_documents(query, documents)
 
             # Step 4: Adaptive decision making
             if not filtered_docs:
                 self._log(
                     "Decision: No relevant documents found - trying query rewrite as fallback")
                 if strategy != "rewrite":  # Avoid infinite loop
-                    improved_query = self._rewrite_query(query)
-                    documents = self._standard_retrieval(
+                    improved_query = await self._arewrite_query(query)
+                    documents = await self._astandard_retrieval(
                         improved_query, dataset)
-                    filtered_docs = self._grade_documents(
+                    filtered_docs = await self._agrade_documents(
                         improved_query, documents)
 
             # Step 5: Generate response
@@ -301,11 +306,11 @@ class AdaptiveRAG:
                     self._log("Context: No relevant documents available")
                     return "No relevant documents found."
 
-                total_chars = sum(len(doc.page_content)
-                                  for doc in docs if doc.page_content)
+                packed = self.context_packer.pack(docs)
                 self._log(
-                    f"Context: Using {len(docs)} filtered documents ({total_chars} chars)")
-                return "\n\n".join(doc.page_content for doc in docs if doc.page_content)
+                    f"Context: Using {len(packed.documents)} filtered documents ({packed.tokens} tokens)")
+                self._log(packed.summary())
+                return packed.text
 
             rag_chain = (
                 {"context": lambda x: format_docs(
@@ -315,15 +320,23 @@ class AdaptiveRAG:
                 | StrOutputParser()
             )
 
-            response = rag_chain.invoke(query)
+            response = await agenerate_answer(rag_chain, query)
 
             # Final summary
             self._log(
                 f"Completed: Adaptive RAG with {strategy} strategy successfully processed query")
 
-            return response, self.logs
+            return response, current_logs()
 
         except Exception as e:
             error_msg = f"Adaptive RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset)
+
+    def astream_query(self, query: str, dataset: str) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset)
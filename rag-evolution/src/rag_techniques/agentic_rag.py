@@ -1,70 +1,100 @@
-from typing import List, Tuple, Dict, Any
-from pyprojroot import here
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+import asyncio
+import re
+from typing import List, Tuple, Dict, Any, AsyncIterator, Iterator, Optional
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain.schema import Document
-from openai import OpenAI
-import chromadb
 from src.load_config import APPConfig
-
-APP_CONFIG = APPConfig().load()
+from src.utils.model_factory import create_chat_model, get_web_search_client
+from src.utils.retrieval import build_retrievers
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, span, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
+from src.utils.rank_fusion import document_key
+
+APP_CONFIG = APPConfig.load()
+
+# Dataset holding each domain detected by _detect_query_characteristics
+DOMAIN_DATASETS = {
+    "tech": "tech_docs",
+    "business": "faq_data",
+    "current": "news_articles"
+}
+
+# Query keywords -> `category` metadata values they ask about (see data_processor.py).
+# Detected categories become a `where` clause on every search whose dataset stores them.
+CATEGORY_KEYWORDS = {
+    "ai": ["ai", "machine_learning", "deep_learning", "no_code_ai"],
+    "artificial intelligence": ["ai", "machine_learning", "deep_learning", "no_code_ai"],
+    "machine learning": ["machine_learning", "deep_learning"],
+    "deep learning": ["deep_learning"],
+    "neural network": ["deep_learning"],
+    "data science": ["data_science"],
+    "python": ["python_basics", "programming"],
+    "programming": ["programming", "python_basics"],
+    "web development": ["web_development"],
+    "database": ["database"],
+    "api": ["api"],
+    "architecture": ["architecture"],
+    "devops": ["devops"],
+    "git": ["version_control"],
+    "version control": ["version_control"],
+    "cloud": ["cloud", "cloud_security"],
+    "security": ["security", "cloud_security"],
+    "privacy": ["privacy"],
+    "blockchain": ["blockchain", "cryptocurrency"],
+    "crypto": ["cryptocurrency", "blockchain"],
+    "cryptocurrency": ["cryptocurrency", "blockchain"],
+    "quantum": ["quantum"],
+    "5g": ["5g"],
+    "iot": ["iot", "smart_cities"],
+    "robot": ["robotics"],
+    "robotics": ["robotics"],
+    "self-driving": ["autonomous_vehicles"],
+    "autonomous": ["autonomous_vehicles"],
+    "healthcare": ["digital_health", "vr_healthcare", "biotech"],
+    "biotech": ["biotech"],
+    "space": ["space_tech"],
+    "sustainability": ["sustainable_tech", "green_tech"],
+    "shipping": ["shipping", "tracking", "international"],
+    "delivery": ["shipping", "tracking"],
+    "return": ["returns", "damage", "warranty"],
+    "refund": ["returns", "damage"],
+    "warranty": ["warranty"],
+    "payment": ["payment"],
+    "price": ["pricing", "coupons", "bulk"],
+    "pricing": ["pricing", "coupons", "bulk"],
+    "discount": ["coupons", "bulk"],
+    "coupon": ["coupons"],
+    "gift card": ["gift_cards"],
+    "account": ["account"],
+    "password": ["account"],
+    "cancel": ["cancellation"],
+    "stock": ["stock"],
+    "review": ["reviews"],
+}
+_CATEGORY_PATTERNS = [(re.compile(rf"\b{re.escape(keyword)}s?\b"), categories)
+                      for keyword, categories in CATEGORY_KEYWORDS.items()]
+
+# Whole words only: "new" must not match "news", nor "now" match "know"
+TEMPORAL_WORDS = re.compile(
+    r"\b(recent|recently|latest|current|currently|today|now|new|upcoming|20\d\d)\b")
 
 
 class AgenticRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.llm = ChatOpenAI(model=APP_CONFIG.corrective_rag.llm_model,
-                              temperature=APP_CONFIG.corrective_rag.temperature)
-        self.logs = []
+        self.llm = create_chat_model(model=APP_CONFIG.corrective_rag.llm_model,
+                                     temperature=APP_CONFIG.corrective_rag.temperature)
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.agentic_rag.context_token_budget, separator="\n")
         self.retrievers = {}
         self._setup_retrievers()
         self._setup_agents()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 3):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _setup_agents(self):
         """Setup specialized agents"""
@@ -74,25 +104,16 @@ class AgenticRAG:
         self.tool_agent = self.llm
 
     def _log(self, message: str):
-        """Enhanced logging with visual separators"""
-        log_entry = f"AGENTIC RAG: {message}"
-        self.logs.append(log_entry)
-
-        # Add visual separator after key steps
-        if any(step in message for step in ["Agent:", "Planning:", "Research:", "Synthesis:", "Tool:"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
-    def _detect_query_characteristics(self, query: str) -> Dict[str, bool]:
+    def _detect_query_characteristics(self, query: str) -> Dict[str, Any]:
         """Detect query characteristics using rule-based approach"""
 
         query_lower = query.lower()
 
         # Temporal indicators
-        temporal_words = ["recent", "latest", "current",
-                          "today", "now", "new", "upcoming", "2024", "2025"]
-        has_temporal = any(word in query_lower for word in temporal_words)
+        has_temporal = TEMPORAL_WORDS.search(query_lower) is not None
 
         # Complexity indicators
         complexity_words = ["compare", "difference", "vs",
@@ -109,18 +130,100 @@ class AgenticRAG:
 
         domains_detected = []
         for domain, keywords in domain_keywords.items():
-            if any(keyword in query_lower for keyword in keywords):
+            if any(re.search(rf"\b{re.escape(keyword)}\b", query_lower) for keyword in keywords):
                 domains_detected.append(domain)
 
+        categories = []
+        for pattern, keyword_categories in _CATEGORY_PATTERNS:
+            if pattern.search(query_lower):
+                categories.extend(keyword_categories)
+
         is_cross_domain = len(domains_detected) > 1
 
         return {
             "temporal": has_temporal,
             "complex": is_complex,
             "cross_domain": is_cross_domain,
-            "domains": domains_detected
+            "domains": domains_detected,
+            "categories": list(dict.fromkeys(categories)),
+            "years": sorted({int(year) for year in re.findall(r"\b(20\d\d)\b", query)})
         }
 
+    @staticmethod
+    def _catalog_categories(characteristics: Dict[str, Any], catalog: Dict[str, Any]) -> List[str]:
+        """Detected categories that the dataset actually stores"""
+        return [category for category in characteristics["categories"]
+                if category in catalog["categories"]]
+
+    def _metadata_filter(self, characteristics: Dict[str, Any],
+                         catalog: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Chroma `where` filter for the categories and period the query asks about.
+
+        Only categories the dataset stores are used. "Recent" means within
+        recent_days of the dataset's newest document, so the filter matches
+        something however old the corpus is.
+        """
+        clauses = []
+        categories = self._catalog_categories(characteristics, catalog)
+        if len(categories) == 1:
+            clauses.append({"category": categories[0]})
+        elif categories:
+            clauses.append({"category": {"$in": categories}})
+
+        newest = catalog["newest_date_ordinal"]
+        if characteristics["temporal"] and newest is not None:
+            years = characteristics["years"]
+            if len(years) == 1:
+                clauses.append({"year": years[0]})
+            elif years:
+                clauses.append({"year": {"$in": years}})
+            else:
+                clauses.append(
+                    {"date_ordinal": {"$gte": newest - APP_CONFIG.agentic_rag.recent_days}})
+
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    async def _aretrieve(self, dataset: str, query: str, k: int,
+                         characteristics: Dict[str, Any]) -> List:
+        """Search a dataset with its metadata filter pushed into the vector store.
+
+        A filter that matches nothing (a year the dataset has no documents
+        from) falls back to an unfiltered search.
+        """
+        retriever = self.retrievers[dataset]
+        catalog = await asyncio.to_thread(retriever.service.metadata_catalog, dataset)
+        where = self._metadata_filter(characteristics, catalog)
+        if where is None:
+            return await retriever.aget_relevant_documents(query, k=k)
+
+        self._log(f"Research: Filtering {dataset} on {where}")
+        documents = await retriever.aget_relevant_documents(query, k=k, where=where)
+        if not documents:
+            self._log(
+                f"Research: Filter matched nothing in {dataset} - widening to an unfiltered search")
+            documents = await retriever.aget_relevant_documents(query, k=k)
+        return documents
+
+    async def _adomain_datasets(self, dataset: str, characteristics: Dict[str, Any]) -> List[str]:
+        """Other datasets worth a search: those storing a detected category, else a detected domain's.
+
+        Collections are separate Chroma stores, so each target still needs its
+        own search; the category `where` clause narrows what it returns.
+        """
+        others = [other for other in self.retrievers if other != dataset]
+        if characteristics["categories"]:
+            catalogs = await asyncio.gather(*(
+                asyncio.to_thread(self.retrievers[other].service.metadata_catalog, other)
+                for other in others))
+            targets = [other for other, catalog in zip(others, catalogs)
+                       if self._catalog_categories(characteristics, catalog)]
+            if targets:
+                return targets
+        targets = [DOMAIN_DATASETS[domain] for domain in characteristics["domains"]]
+        return [other for other in dict.fromkeys(targets) if other in others]
+
     def _planning_agent(self, query: str, dataset: str) -> Dict[str, Any]:
         """Enhanced Planning Agent with rule-based + LLM analysis"""
 
@@ -166,110 +269,147 @@ class AgenticRAG:
             "steps": steps
         }
 
-    def _research_agent(self, query: str, dataset: str, plan: Dict) -> List[Dict]:
-        """Enhanced Research Agent with comprehensive information gathering"""
+    async def _aresearch_agent(self, query: str, dataset: str, plan: Dict) -> List[Dict]:
+        """Enhanced Research Agent with comprehensive information gathering.
+
+        The primary, cross-dataset, supplementary and web searches are
+        independent, so they run as concurrent branches under one deadline.
+        """
 
         self._log(
             "Agent: Research Agent executing comprehensive information gathering")
 
-        research_results = []
+        characteristics = plan["characteristics"]
+        config = APP_CONFIG.agentic_rag
+        branches = []
 
         # Always do primary local research
-        if "local_research" in plan["steps"]:
+        if "local_research" in plan["steps"] and dataset in self.retrievers:
             self._log(
                 "Research: Gathering primary information from local database")
-            if dataset in self.retrievers:
-                retriever = self.retrievers[dataset]
-                documents = retriever.get_relevant_documents(
-                    query, k=APP_CONFIG.agentic_rag.top_k)
-
-                if documents:
-                    self._log(
-                        f"Research: Found {len(documents)} primary documents in {dataset}")
-                    research_results.append({
-                        "source": "primary",
-                        "dataset": dataset,
-                        "documents": documents,
-                        "quality": "primary"
-                    })
+            branches.append((f"primary search in {dataset}", self._asearch_branch(
+                query, dataset, config.top_k, characteristics, "primary", "primary")))
 
         # Cross-dataset search for multi-source/comprehensive plans
         if "cross_dataset_search" in plan["steps"]:
             self._log("Research: Cross-dataset search for comprehensive coverage")
 
-            other_datasets = [d for d in ["tech_docs",
-                                          "faq_data", "news_articles"] if d != dataset]
+            other_datasets = await self._adomain_datasets(dataset, characteristics)
+            self._log(
+                f"Research: Domains {characteristics['domains']} / categories {characteristics['categories']} "
+                f"route the search to {other_datasets or 'no other dataset'}")
 
             for other_dataset in other_datasets:
-                if other_dataset in self.retrievers:
-                    other_retriever = self.retrievers[other_dataset]
-                    other_docs = other_retriever.get_relevant_documents(
-                        query, k=APP_CONFIG.agentic_rag.other_retrieval_top_k)
-
-                    if other_docs:
-                        self._log(
-                            f"Research: Found {len(other_docs)} cross-domain documents in {other_dataset}")
-                        research_results.append({
-                            "source": "cross_domain",
-                            "dataset": other_dataset,
-                            "documents": other_docs,
-                            "quality": "supplementary"
-                        })
+                branches.append((f"cross-domain search in {other_dataset}", self._asearch_branch(
+                    query, other_dataset, config.other_retrieval_top_k, characteristics,
+                    "cross_domain", "supplementary")))
 
         # Supplementary search for complex queries
         elif "supplementary_search" in plan["steps"]:
             self._log("Research: Supplementary search for complex query support")
 
-            other_datasets = [d for d in ["tech_docs",
-                                          "faq_data", "news_articles"] if d != dataset]
+            # Prefer a dataset matching a detected domain over an arbitrary one
+            other_datasets = await self._adomain_datasets(dataset, characteristics) or [
+                d for d in ["tech_docs", "faq_data", "news_articles"] if d != dataset and d in self.retrievers]
 
             # Limited supplementary search
             for other_dataset in other_datasets[:1]:
-                if other_dataset in self.retrievers:
-                    other_retriever = self.retrievers[other_dataset]
-                    other_docs = other_retriever.get_relevant_documents(
-                        query, k=APP_CONFIG.agentic_rag.other_retrieval_top_k)
-
-                    if other_docs:
-                        self._log(
-                            f"Research: Found {len(other_docs)} supplementary documents in {other_dataset}")
-                        research_results.append({
-                            "source": "supplementary",
-                            "dataset": other_dataset,
-                            "documents": other_docs,
-                            "quality": "secondary"
-                        })
+                branches.append((f"supplementary search in {other_dataset}", self._asearch_branch(
+                    query, other_dataset, config.other_retrieval_top_k, characteristics,
+                    "supplementary", "secondary")))
 
         # Web search for temporal/current queries
         if "web_search" in plan["steps"]:
             self._log(
                 "Research: Current information needed - requesting web search")
-            web_info = self._tool_agent(query)
-            if web_info:
-                research_results.append({
-                    "source": "web",
-                    "content": web_info,
-                    "quality": "current"
-                })
+            branches.append(("web search", self._aweb_branch(query)))
 
-        return research_results
+        return await self._arun_branches(branches, config.research_deadline_seconds)
 
-    def _tool_agent(self, query: str) -> str:
-        """Tool Agent: Handle web search and external tools"""
+    async def _asearch_branch(self, query: str, dataset: str, k: int, characteristics: Dict[str, Any],
+                              source: str, quality: str) -> Optional[Dict]:
+        documents = await self._aretrieve(dataset, query, k, characteristics)
+        if not documents:
+            return None
+        self._log(
+            f"Research: Found {len(documents)} {source.replace('_', '-')} documents in {dataset}")
+        return {
+            "source": source,
+            "dataset": dataset,
+            "documents": documents,
+            "quality": quality
+        }
 
-        self._log("Agent: Tool Agent performing web search for current information")
+    async def _aweb_branch(self, query: str) -> Optional[Dict]:
+        web_info = await self._atool_agent(query)
+        if not web_info:
+            return None
+        return {
+            "source": "web",
+            "content": web_info,
+            "quality": "current"
+        }
 
+    async def _arun_branches(self, branches: List[Tuple[str, Any]], deadline_seconds: float) -> List[Dict]:
+        """Run research branches concurrently, merging results as they finish.
+
+        Branches still running at the deadline are cancelled and logged as
+        dropped, so latency is bounded by the deadline rather than the sum of
+        all branches. Results keep the branch order (primary first).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + deadline_seconds
+        tasks = {asyncio.ensure_future(coroutine): (i, label)
+                 for i, (label, coroutine) in enumerate(branches)}
+        pending = set(tasks)
+        merged = []
         try:
-            client = OpenAI()
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, label = tasks[task]
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        self._log(f"Research: {label} failed - {str(e)}")
+                        continue
+                    if result is not None:
+                        merged.append((index, result))
+        finally:
+            # Do not wait for dropped branches; their results are discarded
+            for task in pending:
+                task.cancel()
+
+        for task in pending:
+            self._log(
+                f"Research: Dropped {tasks[task][1]} - missed the {deadline_seconds}s deadline")
+        return [result for _, result in sorted(merged, key=lambda item: item[0])]
 
-            response = client.responses.create(
-                model=self.llm,
-                tools=[{
-                    "type": "web_search_preview",
-                    "search_context_size": "low"
-                }],
-                input=f"Current information about: {query[:35]}"
-            )
+    async def _atool_agent(self, query: str) -> str:
+        """Tool Agent: Handle web search and external tools ("" if the search failed)"""
+
+        self._log("Agent: Tool Agent performing web search for current information")
+
+        try:
+            client = get_web_search_client()
+
+            with span("web_search") as web_search_span:
+                response = await client.responses.create(
+                    model=APP_CONFIG.agentic_rag.web_search_model,
+                    tools=[{
+                        "type": "web_search_preview",
+                        "search_context_size": "low"
+                    }],
+                    input=f"Current information about: {query[:35]}"
+                )
+                web_search_span.set(chars=len(response.output_text))
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    web_search_span.add_llm_usage(usage.input_tokens, usage.output_tokens)
 
             web_content = response.output_text
 
@@ -282,10 +422,11 @@ class AgenticRAG:
             return web_content
 
         except Exception as e:
+            # Nothing is returned, so the web branch drops out like an empty search
             self._log(f"Tool Agent error: {str(e)}")
-            return "Current web information not available"
+            return ""
 
-    def _synthesis_agent(self, query: str, research_results: List[Dict]) -> str:
+    async def _asynthesis_agent(self, query: str, research_results: List[Dict]) -> str:
         """Enhanced Synthesis Agent with comprehensive information integration"""
 
         self._log("Agent: Synthesis Agent combining comprehensive research results")
@@ -300,25 +441,34 @@ class AgenticRAG:
         source_categories = {"primary": 0,
                              "cross_domain": 0, "supplementary": 0, "web": 0}
 
+        # Pack the documents of every dataset together, in research order, so
+        # passages repeated across datasets are sent once and share one budget
+        packed = self.context_packer.pack(
+            [doc for result in research_results for doc in result.get("documents", [])])
+        kept = {document_key(doc): doc for doc in packed.documents}
+        self._log(packed.summary())
+
         for result in research_results:
             if "documents" in result:
+                documents = [kept.pop(document_key(doc)) for doc in result["documents"]
+                             if document_key(doc) in kept]
+                if not documents:
+                    continue
                 docs_text = "\n".join(
-                    [doc.page_content for doc in result["documents"]])
+                    [doc.page_content for doc in documents])
 
                 if result["source"] == "primary":
                     context_parts.append(
                         f"Primary source ({result['dataset']}): {docs_text}")
-                    source_categories["primary"] += len(result["documents"])
+                    source_categories["primary"] += len(documents)
                 elif result["source"] == "cross_domain":
                     context_parts.append(
                         f"Cross-domain source ({result['dataset']}): {docs_text}")
-                    source_categories["cross_domain"] += len(
-                        result["documents"])
+                    source_categories["cross_domain"] += len(documents)
                 else:
                     context_parts.append(
                         f"Supplementary source ({result['dataset']}): {docs_text}")
-                    source_categories["supplementary"] += len(
-                        result["documents"])
+                    source_categories["supplementary"] += len(documents)
 
                 sources_used.append(result["dataset"])
 
@@ -362,7 +512,7 @@ Answer:"""
             prompt = ChatPromptTemplate.from_template(synthesis_prompt)
             synthesis_chain = prompt | self.synthesis_agent | StrOutputParser()
 
-            response = synthesis_chain.invoke({
+            response = await agenerate_answer(synthesis_chain, {
                 "context": full_context,
                 "question": query
             })
@@ -375,7 +525,10 @@ Answer:"""
             return "Error generating response from available information."
 
     def process_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+        return run_sync(self.aprocess_query(query, dataset))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
         self._log(
             "Starting Agentic RAG pipeline with robust multi-agent coordination")
 
@@ -384,10 +537,10 @@ Answer:"""
             plan = self._planning_agent(query, dataset)
 
             # Step 2: Comprehensive Research Agent
-            research_results = self._research_agent(query, dataset, plan)
+            research_results = await self._aresearch_agent(query, dataset, plan)
 
             # Step 3: Enhanced Synthesis Agent
-            response = self._synthesis_agent(query, research_results)
+            response = await self._asynthesis_agent(query, research_results)
 
             # Calculate detailed statistics
             total_docs = 0
@@ -410,9 +563,17 @@ Answer:"""
             self._log(
                 f"Completed: Used {total_docs + web_sources} information pieces from {info_sources} sources ({sources_summary})")
 
-            return response, self.logs
+            return response, current_logs()
 
         except Exception as e:
             error_msg = f"Agentic RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset)
+
+    def astream_query(self, query: str, dataset: str) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset)
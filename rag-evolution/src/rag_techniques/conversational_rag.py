@@ -1,96 +1,67 @@
-from typing import List, Tuple, Dict
-from pyprojroot import here
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from typing import List, Tuple, Dict, Any, AsyncIterator, Iterator, Optional
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
-import chromadb
-from langchain.schema import Document
 from src.load_config import APPConfig
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
+from src.utils.session_store import exchange_text
+from src.utils.tokens import clip_to_tokens, count_tokens
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class ConversationalRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.llm = ChatOpenAI(model=APP_CONFIG.conversational_rag.llm_model,
-                              temperature=APP_CONFIG.conversational_rag.temperature)
-        self.logs = []
+        self.llm = create_chat_model(model=APP_CONFIG.conversational_rag.llm_model,
+                                     temperature=APP_CONFIG.conversational_rag.temperature)
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.conversational_rag.context_token_budget)
         self.retrievers = {}
         self._setup_retrievers()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 5):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            self.logger(
-                                f"Retrieved {len(documents)} documents using context-aware search")
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _log(self, message: str):
-        """Simple logging with conversational RAG prefix"""
-        log_entry = f"CONVERSATIONAL RAG: {message}"
-        self.logs.append(log_entry)
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
-        if any(step in message for step in ["Step 1:", "Step 2:"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
+    def _format_conversation_history(self, history: List[Dict], summary: Optional[str] = None) -> str:
+        """Format conversation history for context, within the session history token budget.
 
-    def _format_conversation_history(self, history: List[Dict]) -> str:
-        """Format conversation history for context"""
-        if not history:
+        The session store already compacts older exchanges into `summary`; this
+        keeps the newest exchanges that fit in case a caller passes more.
+        """
+        if not history and not summary:
             return "No previous conversation."
 
-        # Take last 5 exchanges to avoid token limit issues
-        recent_history = history[-5:]
+        budget = APP_CONFIG.session_store.history_token_budget
         formatted = []
-
-        for exchange in recent_history:
-            formatted.append(f"User: {exchange['user']}")
-            formatted.append(f"Assistant: {exchange['assistant']}")
-
-        return "\n".join(formatted)
+        if summary:
+            summary = clip_to_tokens(summary, budget // 2)
+            formatted.append(f"Summary of earlier conversation:\n{summary}")
+            budget -= count_tokens(formatted[0])
+
+        recent = []
+        for exchange in reversed(history or []):
+            text = exchange_text(exchange)
+            tokens = count_tokens(text)
+            if tokens > budget:
+                if not recent:
+                    # Even the newest exchange alone is too long; keep its beginning
+                    recent.append(clip_to_tokens(text, max(budget, 0)))
+                break
+            recent.append(text)
+            budget -= tokens
+
+        return "\n".join(formatted + list(reversed(recent)))
 
     def _create_contextual_query(self, current_query: str, history: List[Dict]) -> str:
         """Create a contextual query by combining current query with relevant history"""
@@ -107,8 +78,13 @@ class ConversationalRAG:
 
         return current_query
 
-    def process_query(self, query: str, dataset: str, conversation_history: List[Dict] = None) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+    def process_query(self, query: str, dataset: str, conversation_history: List[Dict] = None,
+                      conversation_summary: Optional[str] = None) -> Tuple[str, List[str]]:
+        return run_sync(self.aprocess_query(query, dataset, conversation_history, conversation_summary))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str, conversation_history: List[Dict] = None,
+                             conversation_summary: Optional[str] = None) -> Tuple[str, List[str]]:
         self._log("Starting Conversational RAG pipeline")
 
         if conversation_history is None:
@@ -116,7 +92,7 @@ class ConversationalRAG:
 
         try:
             if dataset not in self.retrievers:
-                return f"Dataset {dataset} not available", self.logs
+                return f"Dataset {dataset} not available", current_logs()
 
             retriever = self.retrievers[dataset]
 
@@ -130,6 +106,9 @@ class ConversationalRAG:
                     f"Last context: User asked '{last_exchange['user'][:60]}...'")
             else:
                 self._log("Memory: Starting fresh conversation (no history)")
+            if conversation_summary:
+                self._log(
+                    f"Memory: Loading a summary of {len(conversation_summary.splitlines())} earlier exchanges")
 
             # Create conversational RAG prompt
             template = """You are a helpful assistant that answers questions based on the provided context and conversation history.
@@ -166,17 +145,17 @@ class ConversationalRAG:
                     self._log("Context: No relevant documents found")
                     return "No relevant documents found."
 
-                total_chars = sum(len(doc.page_content)
-                                  for doc in docs if doc.page_content)
+                packed = self.context_packer.pack(docs)
                 self._log(
-                    f"Context: Prepared {len(docs)} docs ({total_chars} chars) with memory")
-                return "\n\n".join(doc.page_content for doc in docs if doc.page_content)
+                    f"Context: Prepared {len(packed.documents)} docs ({packed.tokens} tokens) with memory")
+                self._log(packed.summary())
+                return packed.text
 
             # RAG chain with conversation history
-            def retrieve_and_format(inputs):
+            async def retrieve_and_format(inputs):
                 self._log(
                     "Step 1: Retrieving documents with conversation awareness")
-                docs = retriever.get_relevant_documents(
+                docs = await retriever.aget_relevant_documents(
                     contextual_query, k=APP_CONFIG.conversational_rag.top_k)
                 formatted = format_docs(docs)
                 self._log(
@@ -185,10 +164,11 @@ class ConversationalRAG:
 
             def format_history(inputs):
                 formatted = self._format_conversation_history(
-                    conversation_history)
-                if conversation_history:
+                    conversation_history, conversation_summary)
+                if conversation_history or conversation_summary:
                     self._log(
-                        f"Memory: Injecting {len(conversation_history)} exchanges into prompt")
+                        f"Memory: Injecting {len(conversation_history)} exchanges into prompt "
+                        f"({count_tokens(formatted)}/{APP_CONFIG.session_store.history_token_budget} tokens)")
                 return formatted
 
             rag_chain = (
@@ -202,16 +182,26 @@ class ConversationalRAG:
                 | StrOutputParser()
             )
 
-            response = rag_chain.invoke(original_query)
+            response = await agenerate_answer(rag_chain, original_query)
 
             # Final summary
-            context_type = "with conversation memory" if conversation_history else "without memory"
+            context_type = "with conversation memory" if conversation_history or conversation_summary else "without memory"
             self._log(
                 f"Completed: Generated contextual response {context_type}")
 
-            return response, self.logs
+            return response, current_logs()
 
         except Exception as e:
             error_msg = f"Conversational RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str, conversation_history: List[Dict] = None,
+                     conversation_summary: Optional[str] = None) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset, conversation_history, conversation_summary)
+
+    def astream_query(self, query: str, dataset: str, conversation_history: List[Dict] = None,
+                      conversation_summary: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset, conversation_history, conversation_summary)
@@ -1,88 +1,47 @@
 
-from typing import List, Tuple
-from pyprojroot import here
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from typing import List, Tuple, Any, AsyncIterator, Iterator, Optional
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
-from pydantic import BaseModel, Field
 from src.load_config import APPConfig
-import chromadb
-from langchain.schema import Document
-from openai import OpenAI
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, span, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
+from src.utils.document_grading import DocumentGrader
+from src.utils.web_search import CachedWebSearch
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class CorrectiveRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.llm = ChatOpenAI(
+        self.llm = create_chat_model(
             model=APP_CONFIG.corrective_rag.llm_model,
             temperature=APP_CONFIG.corrective_rag.temperature
         )
-        self.logs = []
+        self.web_search = CachedWebSearch(
+            model=APP_CONFIG.corrective_rag.web_search_model,
+            deadline_seconds=APP_CONFIG.corrective_rag.web_search_deadline_seconds,
+            ttl_seconds=APP_CONFIG.corrective_rag.web_cache_ttl_seconds,
+            max_entries=APP_CONFIG.corrective_rag.web_cache_max_entries
+        )
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.corrective_rag.context_token_budget)
         self.retrievers = {}
         self._setup_retrievers()
         self._setup_graders()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 3):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _setup_graders(self):
         """Setup document grading and query rewriting models"""
 
-        # Document relevance grader
-        class GradeDocuments(BaseModel):
-            """Binary score for relevance check on retrieved documents."""
-            binary_score: str = Field(
-                description="Documents are relevant to the question, 'yes' or 'no'"
-            )
-
-        self.doc_grader_llm = self.llm.with_structured_output(GradeDocuments)
-
         # Document grading prompt
         grade_system = """You are a grader assessing relevance of retrieved documents to a user question.
         
@@ -90,13 +49,10 @@ class CorrectiveRAG:
                             The goal is to filter out erroneous retrievals that don't help answer the question.
                             Give a binary score 'yes' or 'no'."""
 
-        self.grade_prompt = ChatPromptTemplate.from_messages([
-            ("system", grade_system),
-            ("human",
-             "Retrieved document: \n\n {document} \n\n User question: {question}")
-        ])
-
-        self.doc_grader = self.grade_prompt | self.doc_grader_llm
+        self.document_grader = DocumentGrader(
+            self.llm, grade_system,
+            mode=APP_CONFIG.document_grading.mode,
+            max_concurrency=APP_CONFIG.document_grading.max_concurrency)
 
         # Query rewriter for better retrieval
         rewrite_system = """You are a question re-writer that converts an input question to a better version optimized for vectorstore retrieval.
@@ -116,54 +72,45 @@ class CorrectiveRAG:
         self.query_rewriter = self.rewrite_prompt | self.llm | StrOutputParser()
 
     def _log(self, message: str):
-        """Enhanced logging with visual separators"""
-        log_entry = f"CORRECTIVE RAG: {message}"
-        self.logs.append(log_entry)
-
-        # Add visual separator after key steps
-        if any(step in message for step in ["Step", "Decision:", "Correction:"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
-
-    def _web_search(self, query: str) -> str:
-        """Optimized web search with token limits"""
-        try:
-            self._log(
-                "Web Search: Using OpenAI's web search tool (minimal tokens)")
-
-            client = OpenAI()
-
-            # Create a more focused search query
-            # Limit query length
-            focused_query = f"Brief summary: {query[:50]}"
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
-            response = client.responses.create(
-                model=APP_CONFIG.corrective_rag.web_search_model,
-                tools=[{
-                    "type": "web_search_preview",
-                    "search_context_size": "low"
-                }],
-                input=f"Give a concise 2-sentence answer for: {focused_query}"
-            )
+    async def _aweb_search(self, query: str) -> Optional[str]:
+        """Cached web search with a hard deadline; None means continue with local documents only"""
+        self._log(
+            "Web Search: Using OpenAI's web search tool (minimal tokens)")
 
-            web_content = response.output_text
+        # Create a more focused search query
+        # Limit query length
+        focused_query = f"Brief summary: {query[:50]}"
 
-            # Truncate to maximum 500 characters to control tokens
-            if len(web_content) > 2000:
-                web_content = web_content[:2000] + "..."
-                self._log(
-                    "Web Search: Truncated results to 2000 chars for efficiency")
+        web_content, outcome = await self.web_search.asearch(
+            focused_query, f"Give a concise 2-sentence answer for: {focused_query}")
 
+        if outcome == "hit":
+            self._log("Web Search: Cache hit for this query")
+        elif outcome == "deadline":
             self._log(
-                f"Web Search: Retrieved {len(web_content)} chars from web")
-            return web_content
+                f"Web Search: No answer within {self.web_search.deadline_seconds}s - "
+                "continuing with local documents only")
+        elif outcome == "error":
+            self._log("Web Search: Failed - continuing with local documents only")
+        self._log(f"Web Search: {self.web_search.stats_line()}")
+
+        if web_content is None:
+            return None
+
+        # Truncate to maximum 2000 characters to control tokens
+        if len(web_content) > 2000:
+            web_content = web_content[:2000] + "..."
+            self._log(
+                "Web Search: Truncated results to 2000 chars for efficiency")
 
-        except Exception as e:
-            self._log(f"Web Search: Failed - {str(e)}")
-            return f"Current web information unavailable for: {query}"
+        self._log(
+            f"Web Search: Retrieved {len(web_content)} chars from web")
+        return web_content
 
-    def _grade_documents(self, query: str, documents: List) -> Tuple[List, bool]:
+    async def _agrade_documents(self, query: str, documents: List) -> Tuple[List, bool]:
         """Grade document relevance and determine if web search is needed"""
         if not documents:
             self._log("Document Grading: No documents to grade")
@@ -171,27 +118,24 @@ class CorrectiveRAG:
 
         self._log(f"Document Grading: Evaluating {len(documents)} documents")
 
+        grading = await self.document_grader.agrade(query, documents)
+
         relevant_docs = []
         need_web_search = False
 
         for i, doc in enumerate(documents):
-            try:
-                score = self.doc_grader.invoke({
-                    "question": query,
-                    "document": doc.page_content
-                })
-
-                if score.binary_score.lower() == "yes":
-                    relevant_docs.append(doc)
-                    self._log(f"Document {i+1}: RELEVANT - keeping")
-                else:
-                    need_web_search = True
-                    self._log(
-                        f"Document {i+1}: NOT RELEVANT - will need web search")
-
-            except Exception as e:
-                self._log(f"Document {i+1}: Grading failed - {str(e)}")
+            if grading.errors[i]:
+                self._log(f"Document {i+1}: Grading failed - {grading.errors[i]}")
                 need_web_search = True
+            elif grading.is_relevant(i):
+                relevant_docs.append(doc)
+                self._log(f"Document {i+1}: RELEVANT - keeping")
+            else:
+                need_web_search = True
+                self._log(
+                    f"Document {i+1}: NOT RELEVANT - will need web search")
+
+        self._log(f"Grading engine: {grading.summary()}")
 
         relevance_ratio = len(relevant_docs) / len(documents)
         self._log(
@@ -213,23 +157,26 @@ class CorrectiveRAG:
         return relevant_docs, need_web_search
 
     def process_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+        return run_sync(self.aprocess_query(query, dataset))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
         self._log("Starting Corrective RAG pipeline")
 
         try:
             if dataset not in self.retrievers:
-                return f"Dataset {dataset} not available", self.logs
+                return f"Dataset {dataset} not available", current_logs()
 
             retriever = self.retrievers[dataset]
 
             # Step 1: Initial retrieval
             self._log("Step 1: Initial document retrieval from local database")
-            documents = retriever.get_relevant_documents(
+            documents = await retriever.aget_relevant_documents(
                 query, k=APP_CONFIG.corrective_rag.top_k)
             self._log(f"Retrieved {len(documents)} documents from {dataset}")
 
             # Step 2: Grade documents and decide on web search
-            relevant_docs, need_web_search = self._grade_documents(
+            relevant_docs, need_web_search = await self._agrade_documents(
                 query, documents)
 
             # Step 3: Corrective action if needed
@@ -240,19 +187,28 @@ class CorrectiveRAG:
                 # Transform query for better results
                 self._log(
                     "Query Transformation: Rewriting query for better retrieval")
-                improved_query = self.query_rewriter.invoke(
-                    {"question": query})
+                with span("rewrite"):
+                    improved_query = await self.query_rewriter.ainvoke(
+                        {"question": query})
                 self._log(f"Original: '{query[:50]}...'")
                 self._log(f"Improved: '{improved_query[:50]}...'")
 
                 # Web search as fallback
-                web_results = self._web_search(improved_query)
+                web_results = await self._aweb_search(improved_query)
 
                 # Combine web results with any relevant local docs
-                if relevant_docs:
-                    context = "\n\n".join(
-                        [doc.page_content for doc in relevant_docs])
+                if web_results is None:
+                    # Without web results, fall back to the best local documents we have
+                    packed = self.context_packer.pack(relevant_docs or documents)
+                    context = packed.text
+                    self._log(packed.summary())
+                    need_web_search = False
+                    self._log("Context: Web search unavailable - using local documents only")
+                elif relevant_docs:
+                    packed = self.context_packer.pack(relevant_docs)
+                    context = packed.text
                     context += f"\n\n--- Additional Web Information ---\n{web_results}"
+                    self._log(packed.summary())
                     self._log(
                         "Context: Combined local documents + web search results")
                 else:
@@ -261,8 +217,9 @@ class CorrectiveRAG:
 
             else:
                 # Use only local documents
-                context = "\n\n".join(
-                    [doc.page_content for doc in relevant_docs])
+                packed = self.context_packer.pack(relevant_docs)
+                context = packed.text
+                self._log(packed.summary())
                 self._log("Context: Using local documents only")
 
             # Step 4: Generate corrected response
@@ -288,15 +245,23 @@ class CorrectiveRAG:
                 | StrOutputParser()
             )
 
-            response = rag_chain.invoke(query)
+            response = await agenerate_answer(rag_chain, query)
 
             # Final summary
             source_type = "corrected with web search" if need_web_search else "local documents only"
             self._log(f"Completed: Generated response using {source_type}")
 
-            return response, self.logs
+            return response, current_logs()
 
         except Exception as e:
             error_msg = f"Corrective RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset)
+
+    def astream_query(self, query: str, dataset: str) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset)
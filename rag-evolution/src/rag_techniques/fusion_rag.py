@@ -1,78 +1,40 @@
-from typing import List, Tuple
-from pyprojroot import here
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from typing import List, Optional, Tuple, Any, AsyncIterator, Iterator
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain.load import dumps, loads
-import chromadb
-from langchain.schema import Document
+from langchain_core.documents import Document
 from src.load_config import APPConfig
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, span, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
+from src.utils.rank_fusion import reciprocal_rank_fusion
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class FusionRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.query_generator_llm = ChatOpenAI(
+        self.query_generator_llm = create_chat_model(
             # For query generation
             model=APP_CONFIG.fusion_rag.query_generator_llm_model,
             temperature=APP_CONFIG.fusion_rag.query_generator_temperature
         )
-        self.answer_generator_llm = ChatOpenAI(
+        self.answer_generator_llm = create_chat_model(
             model=APP_CONFIG.fusion_rag.answer_generator_llm_model,
             temperature=APP_CONFIG.fusion_rag.answer_generator_temperature
         )  # For final answer
-        self.logs = []
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.fusion_rag.context_token_budget, template="Document {index}:\n{content}")
         self.retrievers = {}
         self._setup_retrievers()
         self._setup_generators()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 5):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            return documents
-                        except Exception as e:
-                            self.logger(
-                                f"Retrieval error for query '{query}': {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _setup_generators(self):
         """Setup query generation and answer generation prompts"""
@@ -122,17 +84,10 @@ Instructions:
 Answer:""")
 
     def _log(self, message: str):
-        """Enhanced logging with visual separators"""
-        log_entry = f"FUSION RAG: {message}"
-        self.logs.append(log_entry)
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
-        # Add visual separator after key steps
-        if any(step in message for step in ["Creating different ways", "Searching through", "Combining and ranking", "Analyzing the best"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
-
-    def _generate_sub_queries(self, original_query: str) -> List[str]:
+    async def _agenerate_sub_queries(self, original_query: str) -> List[str]:
         """Generate multiple sub-queries from the original query"""
 
         try:
@@ -141,8 +96,9 @@ Answer:""")
             # Generate sub-queries
             query_chain = self.query_generation_prompt | self.query_generator_llm | StrOutputParser()
 
-            generated_text = query_chain.invoke(
-                {"original_query": original_query})
+            with span("generate_queries"):
+                generated_text = await query_chain.ainvoke(
+                    {"original_query": original_query})
 
             # Parse the generated queries
             sub_queries = []
@@ -169,8 +125,8 @@ Answer:""")
             self._log(f"Error creating search variations: {str(e)}")
             return [original_query]  # Fallback to original query only
 
-    def _retrieve_for_queries(self, queries: List[str], dataset: str, k: int = 5) -> List[List]:
-        """Retrieve documents for each query"""
+    async def _aretrieve_for_queries(self, queries: List[str], dataset: str, k: int = 5) -> List[List]:
+        """Retrieve documents for each query in a single batched round trip"""
 
         self._log(
             f"Searching through {dataset.replace('_', ' ')} knowledge base")
@@ -180,43 +136,35 @@ Answer:""")
             return []
 
         retriever = self.retrievers[dataset]
-        all_results = []
 
-        for i, query in enumerate(queries, 1):
-            documents = retriever.get_relevant_documents(
-                query, k=APP_CONFIG.fusion_rag.top_k)
-            all_results.append(documents)
+        # One embedding request and one vector search for all search approaches
+        all_results = await retriever.aget_relevant_documents_batch(
+            queries, k=APP_CONFIG.fusion_rag.top_k)
+
+        for i, documents in enumerate(all_results, 1):
             self._log(
                 f"Search approach {i} found {len(documents)} relevant documents")
 
         return all_results
 
-    def _reciprocal_rank_fusion(self, results: List[List], k: int = 10) -> List:
-        """Apply Reciprocal Rank Fusion to rerank documents with better discrimination"""
+    def _reciprocal_rank_fusion(self, results: List[List], k: Optional[float] = None,
+                                weights: Optional[List[float]] = None) -> List[Tuple[Document, float]]:
+        """Apply weighted Reciprocal Rank Fusion keyed on document ids"""
 
         self._log("Combining and ranking all search results")
 
-        fused_scores = {}
-
-        # Calculate RRF scores with lower k for better differentiation
-        for query_idx, docs in enumerate(results):
-            for rank, doc in enumerate(docs):
-                doc_str = dumps(doc)
-                if doc_str not in fused_scores:
-                    fused_scores[doc_str] = 0
+        # Lower k gives better discrimination between top ranks
+        if k is None:
+            k = APP_CONFIG.fusion_rag.rrf_k
+        if weights is None:
+            # The original query is the first result list; sub-queries share the default weight
+            weights = [APP_CONFIG.fusion_rag.original_query_weight] + \
+                [1.0] * (len(results) - 1)
 
-                # RRF formula with lower k for better discrimination: 1/(rank + k)
-                rrf_score = 1 / (rank + k)
-                fused_scores[doc_str] += rrf_score
-
-        # Sort by fused scores (highest first)
-        reranked_results = [
-            (loads(doc), score)
-            for doc, score in sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)
-        ]
+        reranked_results = reciprocal_rank_fusion(results, k=k, weights=weights)
 
         self._log(
-            f"Found {len(fused_scores)} unique documents across all searches")
+            f"Found {len(reranked_results)} unique documents across all searches")
         self._log(
             "Top ranked documents based on consistency across search approaches:")
 
@@ -225,32 +173,30 @@ Answer:""")
             content_preview = doc.page_content[:60].replace('\n', ' ')
             self._log(f"Rank {i}: (Score: {score:.3f}) {content_preview}...")
 
-        # Return only the documents (not scores)
-        return [doc for doc, score in reranked_results]
+        return reranked_results
 
-    def _generate_final_answer(self, question: str, context_docs: List, max_docs: int = 8) -> str:
-        """Generate final answer using top-ranked documents"""
+    async def _agenerate_final_answer(self, question: str, context_docs: List[Tuple[Any, float]],
+                                      max_docs: int = 8) -> str:
+        """Generate final answer using top-ranked (document, fused score) pairs"""
 
         self._log(
             "Analyzing the best documents to create your comprehensive answer")
 
-        # Use top N documents for context
+        # Use top N documents for context, ordered by their fused scores
         top_docs = context_docs[:max_docs]
-
-        # Prepare context
-        context_text = "\n\n".join([
-            f"Document {i+1}:\n{doc.page_content}"
-            for i, doc in enumerate(top_docs)
-        ])
+        packed = self.context_packer.pack(
+            [doc for doc, _ in top_docs], scores=[score for _, score in top_docs])
+        context_text = packed.text
 
         self._log(
-            f"Using the top {len(top_docs)} most relevant documents for answer generation")
+            f"Using the top {len(packed.documents)} most relevant documents for answer generation")
+        self._log(packed.summary())
 
         # Generate answer
         try:
             answer_chain = self.answer_generation_prompt | self.answer_generator_llm | StrOutputParser()
 
-            answer = answer_chain.invoke({
+            answer = await agenerate_answer(answer_chain, {
                 "context": context_text,
                 "question": question
             })
@@ -264,41 +210,58 @@ Answer:""")
             return f"Error generating answer: {str(e)}"
 
     def process_query(self, query: str, dataset: str, top_k: int = 5, max_context_docs: int = 8) -> Tuple[str, List[str]]:
+        return run_sync(self.aprocess_query(query, dataset, top_k, max_context_docs))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str, top_k: int = 5, max_context_docs: int = 8) -> Tuple[str, List[str]]:
         """Process query using Fusion RAG approach"""
 
-        self.logs = []  # Clear logs
         self._log(
             "Starting multi-perspective search and intelligent document fusion")
 
         try:
             # Step 1: Generate multiple sub-queries
-            queries = self._generate_sub_queries(query)
+            queries = await self._agenerate_sub_queries(query)
 
             # Step 2: Retrieve documents for each query
-            all_results = self._retrieve_for_queries(queries, dataset, k=top_k)
+            all_results = await self._aretrieve_for_queries(queries, dataset, k=top_k)
 
             if not any(all_results):
                 self._log(
                     "No relevant documents found across any search approach")
-                return "I couldn't find relevant documents to answer your question.", self.logs
-
-            # Step 3: Apply RRF to rerank documents
-            reranked_docs = self._reciprocal_rank_fusion(all_results)
+                return "I couldn't find relevant documents to answer your question.", current_logs()
+
+            # Step 3: Apply RRF to rerank documents, dropping weak fused scores
+            scored_docs = self._reciprocal_rank_fusion(all_results)
+            min_score = APP_CONFIG.fusion_rag.min_fused_score
+            reranked_docs = [
+                (doc, score) for doc, score in scored_docs if score >= min_score]
+            if len(reranked_docs) < len(scored_docs):
+                self._log(
+                    f"Dropped {len(scored_docs) - len(reranked_docs)} documents below fused score {min_score}")
 
             if not reranked_docs:
                 self._log("No documents available after ranking process")
-                return "I couldn't find relevant documents to answer your question.", self.logs
+                return "I couldn't find relevant documents to answer your question.", current_logs()
 
             # Step 4: Generate final answer
-            final_answer = self._generate_final_answer(
+            final_answer = await self._agenerate_final_answer(
                 query, reranked_docs, max_context_docs)
 
             self._log(
                 f"Completed: Processed {len(queries)} search approaches and analyzed {len(reranked_docs)} documents")
 
-            return final_answer, self.logs
+            return final_answer, current_logs()
 
         except Exception as e:
             error_msg = f"Fusion RAG process failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str, top_k: int = 5, max_context_docs: int = 8) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset, top_k, max_context_docs)
+
+    def astream_query(self, query: str, dataset: str, top_k: int = 5, max_context_docs: int = 8) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset, top_k, max_context_docs)
@@ -1,70 +1,37 @@
-from typing import List, Tuple
-from pyprojroot import here
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from typing import List, Tuple, Any, AsyncIterator, Iterator
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
-import chromadb
-from langchain.schema import Document
 from src.load_config import APPConfig
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, span, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
+from src.utils.embedding_cache import normalize_text
+from src.utils.lru_cache import LRUCache
+from src.utils.rank_fusion import document_key
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class HydeRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.llm = ChatOpenAI(model=APP_CONFIG.hyde_rag.llm_model,
-                              temperature=APP_CONFIG.hyde_rag.temperature)
-        self.logs = []
+        self.llm = create_chat_model(model=APP_CONFIG.hyde_rag.llm_model,
+                                     temperature=APP_CONFIG.hyde_rag.temperature)
+        # Generated hypothetical documents keyed by (dataset, normalized query)
+        self.hypothetical_docs = LRUCache(APP_CONFIG.hyde_rag.hypothetical_doc_cache_max_entries)
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.hyde_rag.context_token_budget)
         self.retrievers = {}
         self._setup_retrievers()
         self._setup_hyde_generator()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 3):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _setup_hyde_generator(self):
         """Setup hypothetical document generator"""
@@ -106,18 +73,20 @@ class HydeRAG:
         self.hyde_chain = self.llm | StrOutputParser()
 
     def _log(self, message: str):
-        """Enhanced logging with visual separators"""
-        log_entry = f"HYDE RAG: {message}"
-        self.logs.append(log_entry)
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
-        # Add visual separator after key steps
-        if any(step in message for step in ["Step", "HyDE Generation:"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
+    async def _agenerate_hypothetical_document(self, query: str, dataset: str) -> str:
+        """Generate hypothetical document based on query and dataset type, or reuse a cached one"""
 
-    def _generate_hypothetical_document(self, query: str, dataset: str) -> str:
-        """Generate hypothetical document based on query and dataset type"""
+        cache_key = (dataset, normalize_text(query))
+        cached = self.hypothetical_docs.get(cache_key)
+        if cached is not None:
+            stats = self.hypothetical_docs.stats()
+            self._log(
+                f"HyDE Generation: Reusing cached hypothetical document "
+                f"(hits={stats['hits']}, misses={stats['misses']}, cached={stats['entries']})")
+            return cached
 
         self._log(
             "HyDE Generation: Creating hypothetical document for improved retrieval")
@@ -132,12 +101,15 @@ class HydeRAG:
 
             # Generate hypothetical document
             hyde_chain = prompt | self.llm | StrOutputParser()
-            hypothetical_doc = hyde_chain.invoke({"query": query})
+            with span("hypothetical_doc"):
+                hypothetical_doc = await hyde_chain.ainvoke({"query": query})
 
             # Log the hypothetical document (truncated for readability)
             doc_preview = hypothetical_doc[:300] if hypothetical_doc else "No content"
             self._log(f"Generated HyDE document: '{doc_preview}...'")
 
+            if hypothetical_doc:
+                self.hypothetical_docs.put(cache_key, hypothetical_doc)
             return hypothetical_doc
 
         except Exception as e:
@@ -145,52 +117,61 @@ class HydeRAG:
             # Fallback to original query if HyDE fails
             return query
 
-    def _retrieve_with_hyde(self, hypothetical_doc: str, dataset: str) -> List:
-        """Retrieve documents using the hypothetical document as search query"""
+    async def _aretrieve_with_hyde(self, query: str, hypothetical_doc: str, dataset: str) -> List:
+        """Search with the hypothetical document and the original query in one batched call.
+
+        Both texts are embedded in one request and sent in one vector query; the
+        hypothetical-document hits come first, followed by direct-query hits not
+        already found.
+        """
 
-        self._log("HyDE Retrieval: Searching with generated hypothetical document")
+        self._log(
+            "HyDE Retrieval: Searching with the hypothetical document and the original query together")
 
         if dataset not in self.retrievers:
             self._log(f"Dataset {dataset} not available")
             return []
 
         retriever = self.retrievers[dataset]
+        hyde_k = APP_CONFIG.hyde_rag.hypothetical_doc_retrieval_top_k
+        direct_k = APP_CONFIG.hyde_rag.direct_retrieval_top_k
 
-        # Use hypothetical document for retrieval instead of original query
-        documents = retriever.get_relevant_documents(
-            hypothetical_doc, k=APP_CONFIG.hyde_rag.hypothetical_doc_retrieval_top_k)
+        hyde_docs, direct_docs = await retriever.aget_relevant_documents_batch(
+            [hypothetical_doc, query], k=max(hyde_k, direct_k))
+
+        documents, seen = [], set()
+        for doc in hyde_docs[:hyde_k] + direct_docs[:direct_k]:
+            doc_id = document_key(doc)
+            if doc_id not in seen:
+                seen.add(doc_id)
+                documents.append(doc)
 
         self._log(
-            f"HyDE Retrieval: Found {len(documents)} documents using hypothetical embedding")
+            f"HyDE Retrieval: {len(hyde_docs[:hyde_k])} hypothetical-document + "
+            f"{len(direct_docs[:direct_k])} direct-query hits -> {len(documents)} unique documents")
 
         return documents
 
     def process_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+        return run_sync(self.aprocess_query(query, dataset))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
         self._log("Starting HyDE RAG pipeline")
 
         try:
             if dataset not in self.retrievers:
-                return f"Dataset {dataset} not available", self.logs
+                return f"Dataset {dataset} not available", current_logs()
 
             self._log(f"Original Query: '{query[:60]}...'")
 
             # Step 1: Generate hypothetical document
-            hypothetical_doc = self._generate_hypothetical_document(
+            hypothetical_doc = await self._agenerate_hypothetical_document(
                 query, dataset)
 
-            # Step 2: Retrieve using hypothetical document
-            documents = self._retrieve_with_hyde(hypothetical_doc, dataset)
-
-            if not documents:
-                self._log(
-                    "Fallback: No documents found with HyDE, trying direct query")
-                # Fallback to direct retrieval if HyDE fails
-                retriever = self.retrievers[dataset]
-                documents = retriever.get_relevant_documents(
-                    query, k=APP_CONFIG.hyde_rag.direct_retrieval_top_k)
-                self._log(
-                    f"Fallback retrieval: Found {len(documents)} documents")
+            # Step 2: Retrieve using hypothetical document and the direct query together
+            documents = await self._aretrieve_with_hyde(
+                query, hypothetical_doc, dataset)
 
             # Step 3: Generate response using retrieved documents
             self._log("Step 2: Generating response with HyDE-enhanced context")
@@ -212,11 +193,11 @@ class HydeRAG:
                     self._log("Context: No documents available")
                     return "No relevant documents found."
 
-                total_chars = sum(len(doc.page_content)
-                                  for doc in docs if doc.page_content)
+                packed = self.context_packer.pack(docs)
                 self._log(
-                    f"Context: Using {len(docs)} HyDE-retrieved documents ({total_chars} chars)")
-                return "\n\n".join(doc.page_content for doc in docs if doc.page_content)
+                    f"Context: Using {len(packed.documents)} HyDE-retrieved documents ({packed.tokens} tokens)")
+                self._log(packed.summary())
+                return packed.text
 
             rag_chain = (
                 {"context": lambda x: format_docs(
@@ -226,14 +207,22 @@ class HydeRAG:
                 | StrOutputParser()
             )
 
-            response = rag_chain.invoke(query)
+            response = await agenerate_answer(rag_chain, query)
 
             self._log(
                 "Completed: HyDE RAG generated response using hypothetical document retrieval")
 
-            return response, self.logs
+            return response, current_logs()
 
         except Exception as e:
             error_msg = f"HyDE RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset)
+
+    def astream_query(self, query: str, dataset: str) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset)
@@ -1,83 +1,41 @@
-from typing import List, Tuple
-from pyprojroot import here
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+import asyncio
+from typing import List, Tuple, Any, AsyncIterator, Iterator
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from pydantic import BaseModel, Field
-import chromadb
-from langchain.schema import Document
 from src.load_config import APPConfig
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers, get_retrieval_service
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, current_request, request_scoped
+from src.utils.tracing import record_error, span, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
+from src.utils.document_grading import DocumentGrader, GradeMemo
+from src.utils.budget import RequestBudget
 
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class SelfRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.llm = ChatOpenAI(model=APP_CONFIG.self_rag.llm_model,
-                              temperature=APP_CONFIG.self_rag.temperature)
-        self.logs = []
+        self.llm = create_chat_model(model=APP_CONFIG.self_rag.llm_model,
+                                     temperature=APP_CONFIG.self_rag.temperature)
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.self_rag.context_token_budget)
         self.retrievers = {}
         self._setup_retrievers()
         self._setup_graders()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 3):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _setup_graders(self):
         """Setup self-reflection grading models"""
 
-        # Document relevance grader
-        class GradeDocuments(BaseModel):
-            """Binary score for relevance check on retrieved documents."""
-            binary_score: str = Field(
-                description="Documents are relevant to the question, 'yes' or 'no'"
-            )
-
         # Hallucination grader
         class GradeHallucinations(BaseModel):
             """Binary score for hallucination present in generation answer."""
@@ -93,7 +51,6 @@ class SelfRAG:
             )
 
         # Setup grading chains
-        self.doc_grader_llm = self.llm.with_structured_output(GradeDocuments)
         self.hallucination_grader_llm = self.llm.with_structured_output(
             GradeHallucinations)
         self.answer_grader_llm = self.llm.with_structured_output(GradeAnswer)
@@ -107,13 +64,12 @@ class SelfRAG:
 
             Give a binary score 'yes' or 'no'."""
 
-        self.doc_grade_prompt = ChatPromptTemplate.from_messages([
-            ("system", doc_grade_system),
-            ("human",
-             "Retrieved document: \n\n {document} \n\n User question: {question}")
-        ])
-
-        self.doc_grader = self.doc_grade_prompt | self.doc_grader_llm
+        self.document_grader = DocumentGrader(
+            self.llm, doc_grade_system,
+            mode=APP_CONFIG.document_grading.mode,
+            max_concurrency=APP_CONFIG.document_grading.max_concurrency)
+        self.grade_memo = GradeMemo(
+            max_entries=APP_CONFIG.self_rag.grade_memo_max_entries)
 
         # Hallucination grading prompt
         hallucination_system = """You are a grader assessing whether an LLM generation is grounded in / supported by retrieved facts.
@@ -159,41 +115,38 @@ class SelfRAG:
         self.query_rewriter = self.rewrite_prompt | self.llm | StrOutputParser()
 
     def _log(self, message: str):
-        """Enhanced logging with visual separators"""
-        log_entry = f"SELF-RAG: {message}"
-        self.logs.append(log_entry)
-
-        # Add visual separator after key steps
-        if any(step in message for step in ["Step", "Self-Reflection:", "Retry"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
-
-    def _grade_documents(self, question: str, documents: List) -> Tuple[List, bool]:
-        """Self-reflection: Grade document relevance and determine if retry needed"""
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
+
+    async def _agrade_documents(self, question: str, documents: List, dataset: str) -> Tuple[List, bool]:
+        """Self-reflection: Grade document relevance and determine if retry needed.
+
+        Grades are memoized per (question, document id) within the dataset's
+        current collection version, so documents a rewritten query brings back
+        again are not re-graded.
+        """
         if not documents:
             return [], True
 
         self._log(
             f"Self-Reflection: Grading {len(documents)} retrieved documents for relevance")
 
+        scope = (dataset, await asyncio.to_thread(get_retrieval_service().collection_version, dataset))
+        grading = await self.document_grader.agrade_memoized(
+            question, documents, self.grade_memo, scope)
+
         relevant_docs = []
         for i, doc in enumerate(documents):
-            try:
-                score = self.doc_grader.invoke({
-                    "question": question,
-                    "document": doc.page_content
-                })
-
-                if score.binary_score.lower() == "yes":
-                    relevant_docs.append(doc)
-                    self._log(
-                        f"Document {i+1}: RELEVANT - keeping for generation")
-                else:
-                    self._log(f"Document {i+1}: NOT RELEVANT - filtering out")
+            if grading.errors[i]:
+                self._log(f"Document {i+1}: Grading failed - {grading.errors[i]}")
+            elif grading.is_relevant(i):
+                relevant_docs.append(doc)
+                self._log(
+                    f"Document {i+1}: RELEVANT - keeping for generation")
+            else:
+                self._log(f"Document {i+1}: NOT RELEVANT - filtering out")
 
-            except Exception as e:
-                self._log(f"Document {i+1}: Grading failed - {str(e)}")
+        self._log(f"Grading engine: {grading.summary()}")
 
         # Decision logic for retry
         total_docs = len(documents)
@@ -215,7 +168,7 @@ class SelfRAG:
 
         return relevant_docs, need_retry
 
-    def _generate_response(self, question: str, documents: List) -> str:
+    async def _agenerate_response(self, question: str, documents: List) -> str:
         """Generate response using filtered documents"""
 
         template = """Answer the question based on the following context:
@@ -233,7 +186,9 @@ class SelfRAG:
         def format_docs(docs):
             if not docs:
                 return "No relevant documents found."
-            return "\n\n".join(doc.page_content for doc in docs if doc.page_content)
+            packed = self.context_packer.pack(docs)
+            self._log(packed.summary())
+            return packed.text
 
         context = format_docs(documents)
 
@@ -244,9 +199,9 @@ class SelfRAG:
             | StrOutputParser()
         )
 
-        return rag_chain.invoke(question)
+        return await agenerate_answer(rag_chain, question)
 
-    def _self_reflect_on_generation(self, question: str, documents: List, generation: str) -> Tuple[bool, bool]:
+    async def _aself_reflect_on_generation(self, question: str, documents: List, generation: str) -> Tuple[bool, bool]:
         """Self-reflection: Check if generation is grounded and addresses question"""
 
         self._log("Self-Reflection: Evaluating generated response quality")
@@ -254,10 +209,11 @@ class SelfRAG:
         # Check for hallucinations
         try:
             doc_text = "\n".join([doc.page_content for doc in documents])
-            hallucination_score = self.hallucination_grader.invoke({
-                "documents": doc_text,
-                "generation": generation
-            })
+            with span("check_grounding"):
+                hallucination_score = await self.hallucination_grader.ainvoke({
+                    "documents": doc_text,
+                    "generation": generation
+                })
             is_grounded = hallucination_score.binary_score.lower() == "yes"
 
             if is_grounded:
@@ -273,10 +229,11 @@ class SelfRAG:
 
         # Check if answer addresses the question
         try:
-            answer_score = self.answer_grader.invoke({
-                "question": question,
-                "generation": generation
-            })
+            with span("check_answer"):
+                answer_score = await self.answer_grader.ainvoke({
+                    "question": question,
+                    "generation": generation
+                })
             addresses_question = answer_score.binary_score.lower() == "yes"
 
             if addresses_question:
@@ -293,33 +250,41 @@ class SelfRAG:
         return is_grounded, addresses_question
 
     def process_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+        return run_sync(self.aprocess_query(query, dataset))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
         self._log("Starting Self-RAG pipeline with self-reflection mechanisms")
 
-        max_retries = 2
+        max_retries = APP_CONFIG.self_rag.max_retries
         current_query = query
 
         try:
             if dataset not in self.retrievers:
-                return f"Dataset {dataset} not available", self.logs
+                return f"Dataset {dataset} not available", current_logs()
 
             retriever = self.retrievers[dataset]
+            budget = RequestBudget(
+                current_request().trace,
+                latency_seconds=APP_CONFIG.self_rag.latency_budget_seconds,
+                tokens=APP_CONFIG.self_rag.token_budget)
 
             for attempt in range(max_retries + 1):
                 if attempt > 0:
+                    budget.attempt_finished()
                     self._log(
                         f"Retry {attempt}: Attempting improved retrieval and generation")
 
                 # Step 1: Retrieve documents
                 self._log("Step 1: Initial document retrieval")
-                documents = retriever.get_relevant_documents(
+                documents = await retriever.aget_relevant_documents(
                     current_query, k=APP_CONFIG.self_rag.top_k)
                 self._log(
                     f"Retrieved {len(documents)} documents from {dataset}")
 
-                # Step 2: Self-reflection on documents
-                relevant_docs, need_retry = self._grade_documents(
-                    current_query, documents)
+                # Step 2: Self-reflection on documents, always against the original question
+                relevant_docs, need_retry = await self._agrade_documents(
+                    query, documents, dataset)
 
                 # Adaptive threshold: be more lenient on final attempt
                 if need_retry and attempt == max_retries and relevant_docs:
@@ -329,26 +294,30 @@ class SelfRAG:
                     need_retry = False
 
                 if need_retry:
-                    if attempt < max_retries:
+                    if attempt < max_retries and self._retry_affordable(budget):
                         self._log(
                             "Self-Reflection: Document quality insufficient - rewriting query for retry")
-                        current_query = self.query_rewriter.invoke(
-                            {"question": current_query})
+                        with span("rewrite"):
+                            current_query = await self.query_rewriter.ainvoke(
+                                {"question": current_query})
                         self._log(
                             f"Rewritten query: '{current_query[:60]}...'")
                         continue
-                    else:
+                    elif not relevant_docs:
                         self._log(
-                            "Self-Reflection: Max retries reached with insufficient documents")
-                        return "I couldn't find sufficient relevant information to answer your question reliably.", self.logs
+                            "Self-Reflection: No retries left with insufficient documents")
+                        self._log(f"Budget: {budget.summary()}")
+                        return "I couldn't find sufficient relevant information to answer your question reliably.", current_logs()
+                    self._log(
+                        "Self-Reflection: No retries left - generating from the relevant documents found")
 
                 # Step 3: Generate response
                 self._log("Step 2: Generating response with relevant documents")
-                generation = self._generate_response(
+                generation = await self._agenerate_response(
                     current_query, relevant_docs)
 
                 # Step 4: Self-reflection on generation
-                is_grounded, addresses_question = self._self_reflect_on_generation(
+                is_grounded, addresses_question = await self._aself_reflect_on_generation(
                     query, relevant_docs, generation  # Use original query for final check
                 )
 
@@ -356,28 +325,48 @@ class SelfRAG:
                 if is_grounded and addresses_question:
                     self._log(
                         "Self-Reflection: Response quality approved - accepting answer")
+                    self._log(f"Budget: {budget.summary()}")
                     self._log(
                         "Completed: Self-RAG generated high-quality response with self-reflection")
-                    return generation, self.logs
+                    return generation, current_logs()
 
-                elif attempt < max_retries:
+                elif attempt < max_retries and self._retry_affordable(budget):
                     if not is_grounded:
                         self._log(
                             "Self-Reflection: Response not grounded - retrying generation")
                     if not addresses_question:
                         self._log(
                             "Self-Reflection: Response doesn't address question - rewriting query")
-                        current_query = self.query_rewriter.invoke(
-                            {"question": current_query})
+                        with span("rewrite"):
+                            current_query = await self.query_rewriter.ainvoke(
+                                {"question": current_query})
                     continue
                 else:
                     self._log(
-                        "Self-Reflection: Max retries reached - returning best available response")
+                        "Self-Reflection: No retries left - returning best available response")
+                    self._log(f"Budget: {budget.summary()}")
                     self._log(
                         "Completed: Self-RAG completed with quality concerns noted")
-                    return generation, self.logs
+                    return generation, current_logs()
 
         except Exception as e:
             error_msg = f"Self-RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def _retry_affordable(self, budget: RequestBudget) -> bool:
+        """Whether another attempt fits in the request budget"""
+        if budget.can_afford_another():
+            self._log(f"Budget: {budget.summary()} - another attempt fits")
+            return True
+        self._log(
+            "Budget: Another attempt would exceed the request budget - stopping retries")
+        return False
+
+    def stream_query(self, query: str, dataset: str) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset)
+
+    def astream_query(self, query: str, dataset: str) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset)
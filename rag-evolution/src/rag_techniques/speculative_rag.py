@@ -1,78 +1,43 @@
-from typing import List, Tuple
-from pyprojroot import here
+from typing import List, Tuple, Any, AsyncIterator, Iterator
 import random
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+import asyncio
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-import chromadb
-from langchain.schema import Document
 from src.load_config import APPConfig
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, span, trace_event
+from src.utils.streaming import astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class SpeculativeRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.drafter_llm = ChatOpenAI(
+        self.drafter_llm = create_chat_model(
             # For generating drafts
             model=APP_CONFIG.speculative_rag.drafter_llm_model,
-            temperature=APP_CONFIG.speculative_rag.drafter_temperature
+            temperature=APP_CONFIG.speculative_rag.drafter_temperature,
+            timeout=APP_CONFIG.speculative_rag.call_timeout_seconds
         )
         # Lower temp for consistent scoring
-        self.verifier_llm = ChatOpenAI(
+        self.verifier_llm = create_chat_model(
             model=APP_CONFIG.speculative_rag.verifier_llm_model,
-            temperature=APP_CONFIG.speculative_rag.verifier_temperature
+            temperature=APP_CONFIG.speculative_rag.verifier_temperature,
+            timeout=APP_CONFIG.speculative_rag.call_timeout_seconds
         )
-        self.logs = []
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.speculative_rag.context_token_budget)
         self.retrievers = {}
         self._setup_retrievers()
         self._setup_generators()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data", "news_articles"]
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 6):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _setup_generators(self):
         """Setup draft and verification generators with STRICT scoring"""
@@ -144,15 +109,8 @@ Answer:""")
                         OVERALL: [average score]""")
 
     def _log(self, message: str):
-        """Enhanced logging with visual separators"""
-        log_entry = f"SPECULATIVE RAG: {message}"
-        self.logs.append(log_entry)
-
-        # Add visual separator after key steps
-        if any(step in message for step in ["Sampling:", "Drafting:", "Verification:", "Selection:"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
     def _multi_perspective_sampling(self, documents: List, k: int = 3) -> List[List]:
         """Create multiple document subsets from different perspectives"""
@@ -194,7 +152,7 @@ Answer:""")
             f"Sampling: Generated {len(subsets)} document subsets with sizes: {[len(s) for s in subsets]}")
         return subsets[:k]
 
-    def _generate_draft_response(self, query: str, evidence_subset: List[str]) -> str:
+    async def _agenerate_draft_response(self, query: str, evidence_subset: List[str]) -> str:
         """Generate a draft response using a subset of evidence"""
 
         try:
@@ -203,17 +161,18 @@ Answer:""")
 
             draft_chain = self.draft_prompt | self.drafter_llm | StrOutputParser()
 
-            draft = draft_chain.invoke({
-                "evidence": evidence_text,
-                "question": query
-            })
+            with span("draft"):
+                draft = await draft_chain.ainvoke({
+                    "evidence": evidence_text,
+                    "question": query
+                })
 
             return draft
 
         except Exception as e:
             return f"Error generating draft: {str(e)}"
 
-    def _verify_response(self, query: str, evidence_subset: List[str], draft: str, draft_index: int) -> Tuple[float, str]:
+    async def _averify_response(self, query: str, evidence_subset: List[str], draft: str, draft_index: int) -> Tuple[float, str]:
         """Verify and score a draft response with detailed feedback and forced differentiation"""
 
         try:
@@ -263,12 +222,13 @@ Answer:""")
 
             verify_chain = verification_prompt_with_focus | self.verifier_llm | StrOutputParser()
 
-            score_text = verify_chain.invoke({
-                "evidence": evidence_text,
-                "question": query,
-                "answer": draft,
-                "focus_instruction": focus_instruction
-            })
+            with span("verify"):
+                score_text = await verify_chain.ainvoke({
+                    "evidence": evidence_text,
+                    "question": query,
+                    "answer": draft,
+                    "focus_instruction": focus_instruction
+                })
 
             # Extract score and add small random variation to break ties
             try:
@@ -296,62 +256,115 @@ Answer:""")
                 2.0  # 3.0 to 5.0 for errors
             return error_score, f"Error during verification: {str(e)}"
 
+    async def _adraft_and_verify(self, query: str, evidence_subset: List[str], draft_index: int) -> Tuple[str, float, str]:
+        """Generate one draft and verify it as soon as it is ready"""
+
+        draft = await self._agenerate_draft_response(query, evidence_subset)
+        self._log(
+            f"Draft {draft_index + 1}: Generated response using {len(evidence_subset)} documents ({len(draft)} chars)")
+
+        score, feedback = await self._averify_response(
+            query, evidence_subset, draft, draft_index)
+        self._log(
+            f"Draft {draft_index + 1}: STRICT quality score = {score:.1f}/10")
+        return draft, score, feedback
+
+    async def _arun_drafts_concurrently(self, query: str, document_subsets: List[List]) -> List[Tuple[int, str, float]]:
+        """Run draft+verify pipelines as concurrent tasks, at most max_concurrency at a time.
+
+        Each pipeline gets two LLM calls worth of time once it holds a slot, so
+        queueing behind other drafts does not count against it; pipelines that
+        have not finished by then are dropped instead of holding up the answer.
+        """
+
+        config = APP_CONFIG.speculative_rag
+        pipeline_timeout = 2 * config.call_timeout_seconds
+        semaphore = asyncio.Semaphore(config.max_concurrency)
+
+        async def bounded(subset: List[str], draft_index: int):
+            async with semaphore:
+                return await asyncio.wait_for(
+                    self._adraft_and_verify(query, subset, draft_index), pipeline_timeout)
+
+        results = await asyncio.gather(
+            *(bounded(subset, i) for i, subset in enumerate(document_subsets)),
+            return_exceptions=True)
+
+        candidates, timed_out = [], []
+        for draft_index, result in enumerate(results):
+            if isinstance(result, asyncio.TimeoutError):
+                timed_out.append(draft_index + 1)
+            elif isinstance(result, Exception):
+                self._log(
+                    f"Draft {draft_index + 1}: Pipeline failed - {str(result)}")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                draft, score, _ = result
+                candidates.append((draft_index, draft, score))
+
+        if timed_out:
+            self._log(
+                f"Drafting: Dropped drafts {timed_out} after {pipeline_timeout}s timeout")
+
+        return sorted(candidates)
+
     def process_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+        return run_sync(self.aprocess_query(query, dataset))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
         self._log(
             "Starting Speculative RAG pipeline with parallel generation and STRICT verification")
 
         try:
             if dataset not in self.retrievers:
-                return f"Dataset {dataset} not available", self.logs
+                return f"Dataset {dataset} not available", current_logs()
 
             # Step 1: Retrieve documents
             self._log("Step 1: Retrieving documents from knowledge base")
             retriever = self.retrievers[dataset]
-            documents = retriever.get_relevant_documents(
+            documents = await retriever.aget_relevant_documents(
                 # Get more docs for better sampling
                 query, k=APP_CONFIG.speculative_rag.top_k)
 
             if not documents:
                 self._log("No documents retrieved")
-                return "I couldn't find relevant documents to answer your question.", self.logs
+                return "I couldn't find relevant documents to answer your question.", current_logs()
 
             self._log(
                 f"Retrieved {len(documents)} documents for multi-perspective sampling")
 
+            # Drafts sample from the packed evidence: no near-duplicates, within budget
+            packed = self.context_packer.pack(documents)
+            documents = packed.documents
+            self._log(packed.summary())
+
             # Step 2: Multi-perspective sampling
             k_perspectives = 3  # Number of different perspectives
             document_subsets = self._multi_perspective_sampling(
                 documents, k=k_perspectives)
 
-            # Step 3: Parallel draft generation
-            self._log("Drafting: Generating multiple draft responses in parallel")
-            drafts = []
+            # Step 3 + 4: Parallel draft generation, each draft verified as soon as it finishes
+            self._log(
+                f"Drafting: Generating {len(document_subsets)} draft responses in parallel "
+                f"(max {APP_CONFIG.speculative_rag.max_concurrency} concurrent)")
+            self._log(
+                "Verification: CRITICALLY evaluating each draft as soon as it is ready")
+            candidates = await self._arun_drafts_concurrently(query, document_subsets)
 
-            for i, subset in enumerate(document_subsets):
-                draft = self._generate_draft_response(query, subset)
-                drafts.append(draft)
-                self._log(
-                    f"Draft {i+1}: Generated response using {len(subset)} documents ({len(draft)} chars)")
+            if not candidates:
+                self._log("No draft finished within the time limit")
+                return "I couldn't generate an answer in time. Please try again.", current_logs()
 
-            # Step 4: STRICT parallel verification
-            self._log(
-                "Verification: CRITICALLY evaluating quality of each draft response")
-            scores = []
-            detailed_feedback = []
-
-            for i, (draft, subset) in enumerate(zip(drafts, document_subsets)):
-                score, feedback = self._verify_response(
-                    query, subset, draft, i)
-                scores.append(score)
-                detailed_feedback.append(feedback)
-                self._log(
-                    f"Draft {i+1}: STRICT quality score = {score:.1f}/10")
+            drafts = [draft for _, draft, _ in candidates]
+            scores = [score for _, _, score in candidates]
 
             # Step 5: Select best response
-            best_index = scores.index(max(scores))
-            best_score = scores[best_index]
-            best_response = drafts[best_index]
+            best_position = scores.index(max(scores))
+            best_index = candidates[best_position][0]
+            best_score = scores[best_position]
+            best_response = drafts[best_position]
 
             self._log(
                 f"Selection: Chose Draft {best_index + 1} with highest score ({best_score:.1f}/10)")
@@ -362,9 +375,17 @@ Answer:""")
             score_dist = f"Score distribution: {[f'{s:.1f}' for s in scores]}"
             self._log(f"Debug: {score_dist}")
 
-            return best_response, self.logs
+            return best_response, current_logs()
 
         except Exception as e:
             error_msg = f"Speculative RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines while the pipeline runs; the selected draft arrives as the answer"""
+        return stream_pipeline(self.aprocess_query, query, dataset)
+
+    def astream_query(self, query: str, dataset: str) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset)
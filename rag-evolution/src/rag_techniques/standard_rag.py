@@ -1,93 +1,48 @@
-from typing import List, Tuple
-from pyprojroot import here
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from typing import List, Tuple, Any, AsyncIterator, Iterator
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from src.load_config import APPConfig
-import chromadb
-from langchain.schema import Document
+from src.utils.model_factory import create_chat_model
+from src.utils.retrieval import build_retrievers
+from src.utils.async_runtime import run_sync
+from src.utils.request_context import current_logs, request_scoped
+from src.utils.tracing import record_error, trace_event
+from src.utils.streaming import agenerate_answer, astream_pipeline, stream_pipeline
+from src.utils.context_packer import ContextPacker
 
-APP_CONFIG = APPConfig().load()
+APP_CONFIG = APPConfig.load()
 
 
 class StandardRAG:
     def __init__(self):
-        self.embeddings = OpenAIEmbeddings(model=APP_CONFIG.embedding_model)
-        self.llm = ChatOpenAI(
+        self.llm = create_chat_model(
             model=APP_CONFIG.standard_rag.llm_model,
             temperature=APP_CONFIG.standard_rag.temperature
         )
-        self.logs = []
+        self.context_packer = ContextPacker.from_config(
+            APP_CONFIG.standard_rag.context_token_budget)
         self.retrievers = {}
         self._setup_retrievers()
 
     def _setup_retrievers(self):
-        """Setup retrievers for all datasets"""
-        datasets = ["tech_docs", "faq_data",
-                    "news_articles"]  # Support all datasets
-
-        for dataset in datasets:
-            try:
-                chroma_client = chromadb.PersistentClient(
-                    path=str(here(APP_CONFIG.chroma_db_path)))
-                collection = chroma_client.get_collection(dataset)
-
-                class CustomRetriever:
-                    def __init__(self, collection, embeddings, logger):
-                        self.collection = collection
-                        self.embeddings = embeddings
-                        self.logger = logger
-
-                    def get_relevant_documents(self, query: str, k: int = 5):
-                        try:
-                            query_embedding = self.embeddings.embed_query(
-                                query)
-                            results = self.collection.query(
-                                query_embeddings=[query_embedding],
-                                n_results=k,
-                                include=['documents', 'metadatas']
-                            )
-
-                            documents = []
-                            if results['documents'] and results['documents'][0]:
-                                for i, doc_content in enumerate(results['documents'][0]):
-                                    metadata = results['metadatas'][0][i] if results['metadatas'][0] else {
-                                    }
-                                    documents.append(
-                                        Document(page_content=doc_content, metadata=metadata))
-
-                            self.logger(
-                                f"Retrieved {len(documents)} documents using similarity search")
-                            return documents
-                        except Exception as e:
-                            self.logger(f"Retrieval error: {str(e)}")
-                            return []
-
-                self.retrievers[dataset] = CustomRetriever(
-                    collection, self.embeddings, self._log)
-
-            except Exception as e:
-                self._log(f"Setup error for {dataset}: {str(e)}")
+        """Setup retrievers for all datasets on the shared retrieval service"""
+        self.retrievers = build_retrievers(self._log)
 
     def _log(self, message: str):
-        """Simple logging"""
-        log_entry = f"STANDARD RAG: {message}"
-        self.logs.append(log_entry)
-
-        # Add visual separator after each step
-        if any(step in message for step in ["Step 1:", "Step 2:"]):
-            self.logs.append("     |")
-            self.logs.append("     |")
-            self.logs.append("     V")
+        """Record a pipeline step on the current trace span"""
+        trace_event(message)
 
     def process_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
-        self.logs = []  # Clear logs
+        return run_sync(self.aprocess_query(query, dataset))
+
+    @request_scoped
+    async def aprocess_query(self, query: str, dataset: str) -> Tuple[str, List[str]]:
         self._log("Starting Standard RAG pipeline")
 
         try:
             if dataset not in self.retrievers:
-                return f"Dataset {dataset} not available", self.logs
+                return f"Dataset {dataset} not available", current_logs()
 
             retriever = self.retrievers[dataset]
 
@@ -108,14 +63,18 @@ class StandardRAG:
                 if not docs:
                     self._log("No documents retrieved")
                     return "No relevant documents found."
-                self._log(f"Formatting {len(docs)} documents into context")
-                return "\n\n".join(doc.page_content for doc in docs if doc.page_content)
+                packed = self.context_packer.pack(docs)
+                self._log(f"Formatting {len(packed.documents)} documents into context")
+                self._log(packed.summary())
+                return packed.text
 
             # RAG chain
-            def retrieve_and_format(query_input):
+            async def retrieve_and_format(query_input):
                 self._log("Step 1: Retrieving relevant documents")
-                docs = retriever.get_relevant_documents(
+                docs = await retriever.aget_relevant_documents(
                     query_input, k=APP_CONFIG.standard_rag.top_k)
+                self._log(
+                    f"Retrieved {len(docs)} documents using similarity search")
                 formatted = format_docs(docs)
                 self._log("Step 2: Generating response with retrieved context")
                 return formatted
@@ -127,13 +86,21 @@ class StandardRAG:
                 | StrOutputParser()
             )
 
-            response = rag_chain.invoke(query)
+            response = await agenerate_answer(rag_chain, query)
             self._log(
                 "Standard RAG completed: Single retrieval → Direct generation")
 
-            return response, self.logs
+            return response, current_logs()
 
         except Exception as e:
             error_msg = f"RAG failed: {str(e)}"
             self._log(error_msg)
-            return f"Error processing request: {str(e)}", self.logs
+            record_error(e)
+            return f"Error processing request: {str(e)}", current_logs()
+
+    def stream_query(self, query: str, dataset: str) -> Iterator[Tuple[str, Any]]:
+        """Stream log lines and answer tokens while the pipeline runs"""
+        return stream_pipeline(self.aprocess_query, query, dataset)
+
+    def astream_query(self, query: str, dataset: str) -> AsyncIterator[Tuple[str, Any]]:
+        return astream_pipeline(self.aprocess_query, query, dataset)
@@ -0,0 +1,285 @@
+"""Cold-start benchmark of the playground.
+
+Measures, in fresh interpreters:
+- import time of the app and of every technique module (`python -X importtime`),
+  with the heaviest packages each one pulls in;
+- process start to "ready" (app imported, UI built) and to the first answered
+  request, served with the local model stand-ins over a throw-away Chroma
+  built from DataPrep's datasets. Warm-up is off, so the first request pays
+  for constructing its technique: the worst case a user can hit.
+
+No API key or network access is needed.
+
+    python src/startup_benchmark.py --json startup.json
+    python src/startup_benchmark.py --targets app --runs 5 --top 15
+    python src/startup_benchmark.py --baseline startup.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SRC_DIR = Path(__file__).resolve().parent
+ROOT_DIR = SRC_DIR.parent
+
+TECHNIQUE_MODULES = [
+    "rag_techniques.standard_rag", "rag_techniques.conversational_rag",
+    "rag_techniques.fusion_rag", "rag_techniques.hyde_rag", "rag_techniques.self_rag",
+    "rag_techniques.adaptive_rag", "rag_techniques.corrective_rag",
+    "rag_techniques.agentic_rag", "rag_techniques.speculative_rag",
+]
+
+# Run in every child before the target is imported: the same sys.path as
+# `python src/app.py`, and no side effects outside the benchmark's temp dir
+PRELUDE = f"""
+import sys
+sys.path[:0] = [{str(SRC_DIR)!r}, {str(ROOT_DIR)!r}]
+from src.load_config import APPConfig
+config = APPConfig.load()
+config.playground.warm_up_techniques = []
+config.session_store.path = None
+config.tracing.jsonl_path = None
+config.tracing.metrics_port = None
+"""
+
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """Entries of `-X importtime` output: name, depth, self and cumulative microseconds"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        # One space after the bar, then two per nesting level
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append({"name": name.strip(), "depth": depth,
+                        "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    return entries
+
+
+def heaviest_packages(entries: List[Dict[str, Any]], target: str, top: int) -> List[Dict[str, Any]]:
+    """Top-level packages imported for `target`, by the cumulative time of their own import line"""
+    packages: Dict[str, int] = {}
+    for entry in entries:
+        if entry["name"] == entry["name"].split(".")[0] and entry["name"] not in (target, "site"):
+            packages[entry["name"]] = max(packages.get(entry["name"], 0), entry["cumulative_us"])
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"package": name, "ms": round(us / 1000, 1)} for name, us in ranked]
+
+
+def measure_import(target: str, runs: int, top: int) -> Dict[str, Any]:
+    """Median import time of `target` in `runs` fresh interpreters"""
+    totals, targets, last_entries = [], [], []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"{PRELUDE}\nimport {target}"],
+            cwd=ROOT_DIR, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"import {target} failed:\n{result.stderr[-2000:]}")
+        entries = parse_importtime(result.stderr)
+        totals.append(sum(e["cumulative_us"] for e in entries if e["depth"] == 0) / 1000)
+        targets.append(next(e["cumulative_us"] for e in reversed(entries)
+                            if e["name"] == target and e["depth"] == 0) / 1000)
+        last_entries = entries
+    return {
+        "target": target,
+        "runs": runs,
+        # Everything the interpreter imported, prelude included
+        "total_import_ms": round(statistics.median(totals), 1),
+        # The target alone, not counting what the prelude had already imported
+        "target_import_ms": round(statistics.median(targets), 1),
+        "heaviest_packages": heaviest_packages(last_entries, target, top),
+    }
+
+
+def build_chroma(path: Path):
+    """Persist DataPrep's datasets, embedded with LocalEmbeddings, into a Chroma at `path`"""
+    sys.path[:0] = [str(ROOT_DIR), str(SRC_DIR)]
+    import chromadb
+    from chromadb.config import Settings
+    import data_processor
+    from src.utils.local_models import LocalEmbeddings, LocalEmbeddingsClient
+
+    client = chromadb.PersistentClient(
+        path=str(path), settings=Settings(anonymized_telemetry=False))
+    prep = data_processor.DataPrep(
+        embedding_client=LocalEmbeddingsClient(LocalEmbeddings()), client=client)
+    prep._populate_collection("tech_docs", prep._create_tech_docs_dataset())
+    prep._populate_collection("faq_data", prep._create_faq_dataset())
+    prep._populate_collection("news_articles", prep._create_news_dataset())
+
+
+def _local_chat_model(**kwargs):
+    from src.utils.local_models import LocalChatModel
+    return LocalChatModel(**kwargs)
+
+
+def _local_embeddings(**kwargs):
+    from src.utils.local_models import LocalEmbeddings
+    return LocalEmbeddings()
+
+
+def _local_web_search():
+    from src.utils.local_models import LocalWebSearchClient
+    return LocalWebSearchClient()
+
+
+def child_first_request(workdir: str, technique: str, dataset: str, query: str):
+    """Child process: start the app like `python src/app.py`, answer one request, report timestamps"""
+    exec(PRELUDE, {})
+    from src.load_config import APPConfig
+    from src.utils import model_factory
+
+    config = APPConfig.load()
+    config.chroma_db_path = str(Path(workdir) / "chroma")
+    config.vector_index.path = str(Path(workdir) / "vector_index")
+    config.hybrid_retrieval.bm25_path = str(Path(workdir) / "bm25")
+    config.embedding_cache.persist_path = None
+    model_factory.override_models(
+        chat=_local_chat_model, embeddings=_local_embeddings, web_search=_local_web_search)
+
+    import app
+    print(json.dumps({"event": "ready", "time": time.time()}), flush=True)
+    response, _ = asyncio.run(app.rag_playground.aget_response(
+        query, technique, dataset, "startup-benchmark"))
+    print(json.dumps({"event": "answered", "time": time.time(),
+                      "error": response.startswith("Error")}), flush=True)
+
+
+def measure_first_request(workdir: Path, technique: str, dataset: str, query: str,
+                          runs: int) -> Dict[str, Any]:
+    """Median seconds from process start to ready and to the first answer"""
+    ready, answered, errors = [], [], 0
+    for _ in range(runs):
+        started = time.time()
+        result = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), "--child", str(workdir),
+             technique, dataset, query],
+            cwd=ROOT_DIR, capture_output=True, text=True)
+        events = {}
+        for line in result.stdout.splitlines():
+            if line.startswith('{"event"'):
+                event = json.loads(line)
+                events[event["event"]] = event
+        if result.returncode != 0 or "answered" not in events:
+            raise RuntimeError(f"first request failed:\n{result.stderr[-2000:]}")
+        ready.append(events["ready"]["time"] - started)
+        answered.append(events["answered"]["time"] - started)
+        errors += events["answered"]["error"]
+    return {
+        "technique": technique,
+        "dataset": dataset,
+        "runs": runs,
+        "ready_seconds": round(statistics.median(ready), 3),
+        "first_answer_seconds": round(statistics.median(answered), 3),
+        "errors": errors,
+    }
+
+
+def find_regressions(results: Dict[str, Any], baseline: Dict[str, Any],
+                     max_regression: float) -> List[str]:
+    """Timings that grew by more than max_regression over the baseline"""
+    pairs = [(f"import {row['target']}", row["target_import_ms"] / 1000,
+              next((old["target_import_ms"] / 1000 for old in baseline.get("imports", [])
+                    if old["target"] == row["target"]), None))
+             for row in results["imports"]]
+    if results.get("first_request") and baseline.get("first_request"):
+        for metric in ("ready_seconds", "first_answer_seconds"):
+            pairs.append((metric, results["first_request"][metric],
+                          baseline["first_request"][metric]))
+    regressions = []
+    for name, seconds, old in pairs:
+        # 50 ms of slack absorbs process start-up noise on tiny imports
+        if old is not None and seconds > old * (1 + max_regression) + 0.05:
+            regressions.append(f"{name}: {old:.3f}s -> {seconds:.3f}s")
+    return regressions
+
+
+def print_report(results: Dict[str, Any]):
+    print(f"\n{'target':<36}{'import ms':>11}{'total ms':>11}  heaviest packages")
+    for row in results["imports"]:
+        packages = ", ".join(f"{p['package']} {p['ms']:.0f}" for p in row["heaviest_packages"])
+        print(f"{row['target']:<36}{row['target_import_ms']:>11.0f}"
+              f"{row['total_import_ms']:>11.0f}  {packages}")
+    first = results.get("first_request")
+    if first:
+        print(f"\nProcess start -> ready:        {first['ready_seconds']:.2f}s")
+        print(f"Process start -> first answer: {first['first_answer_seconds']:.2f}s "
+              f"({first['technique']}, {first['dataset']}, {first['errors']} errors)")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Cold-start import time and time-to-first-request of the playground")
+    parser.add_argument("--targets", nargs="+", default=["app"] + TECHNIQUE_MODULES,
+                        help="modules to time, importable from src/")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="fresh interpreters per measurement; the median is reported")
+    parser.add_argument("--top", type=int, default=5,
+                        help="heaviest packages listed per target")
+    parser.add_argument("--technique", default="Standard (Naive) RAG",
+                        help="technique answering the first request")
+    parser.add_argument("--dataset", default="tech_docs")
+    parser.add_argument("--query", default="How do I configure the vector database?")
+    parser.add_argument("--skip-first-request", action="store_true",
+                        help="only measure import times")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="JSON output of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed growth over the baseline, as a fraction (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def main() -> int:
+    if sys.argv[1:2] == ["--child"]:
+        child_first_request(*sys.argv[2:6])
+        return 0
+
+    args = parse_args()
+    results: Dict[str, Any] = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "imports": [],
+        "first_request": None,
+    }
+    for target in args.targets:
+        print(f"Timing import {target} ({args.runs} runs)...")
+        results["imports"].append(measure_import(target, args.runs, args.top))
+
+    if not args.skip_first_request:
+        with tempfile.TemporaryDirectory(prefix="rag-startup-") as workdir:
+            print("Building the benchmark Chroma...")
+            build_chroma(Path(workdir) / "chroma")
+            print(f"Timing process start to first answer ({args.runs} runs)...")
+            results["first_request"] = measure_first_request(
+                Path(workdir), args.technique, args.dataset, args.query, args.runs)
+
+    print_report(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+        print(f"Wrote {args.json}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = find_regressions(results, baseline, args.max_regression)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.max_regression:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regressions over {args.max_regression:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    response: str
+    logs: List[str]
+    similarity: float = 1.0
+
+
+class SemanticAnswerCache:
+    """LRU cache of final answers matched by query-embedding similarity.
+
+    Answers are grouped per (technique, dataset, collection version). A lookup
+    returns the cached answer whose query embedding is most similar to the new
+    one, if the cosine similarity reaches `similarity_threshold`. When a dataset
+    shows up with a new collection version, every answer cached for its old
+    contents is dropped.
+    """
+
+    def __init__(self, max_entries: int = 1000, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # (technique, dataset, query) -> (unit embedding, answer), least recently used first
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[np.ndarray, CachedAnswer]]" = OrderedDict()
+        self._versions: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self, dataset: str, version: Optional[str]):
+        """Drop a dataset's answers once its collection version changes"""
+        if dataset in self._versions and self._versions[dataset] != version:
+            stale = [key for key in self._entries if key[1] == dataset]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += 1
+        self._versions[dataset] = version
+
+    def lookup(self, technique: str, dataset: str, version: Optional[str],
+               embedding: List[float]) -> Optional[CachedAnswer]:
+        query_vector = self._unit(embedding)
+        with self._lock:
+            self._check_version(dataset, version)
+            keys = [key for key in self._entries
+                    if key[0] == technique and key[1] == dataset]
+            if keys:
+                matrix = np.stack([self._entries[key][0] for key in keys])
+                similarities = matrix @ query_vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    key = keys[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    answer = self._entries[key][1]
+                    return CachedAnswer(answer.query, answer.response, list(answer.logs),
+                                        float(similarities[best]))
+            self.misses += 1
+            return None
+
+    def store(self, technique: str, dataset: str, version: Optional[str], query: str,
+              embedding: List[float], response: str, logs: List[str]):
+        key = (technique, dataset, query)
+        with self._lock:
+            self._check_version(dataset, version)
+            self._entries[key] = (self._unit(embedding),
+                                  CachedAnswer(query, response, list(logs)))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self._entries), "invalidations": self.invalidations}
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable
+
+# The OpenAI async clients inside ChatOpenAI/OpenAIEmbeddings keep connection
+# pools bound to the event loop they first ran on, so every technique
+# coroutine runs on this one long-lived loop, whichever thread or loop the
+# caller is on.
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def get_runtime_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared event loop, starting its daemon thread on first use"""
+    global _loop, _loop_thread
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                _loop_thread = threading.Thread(
+                    target=loop.run_forever, name="rag-runtime-loop", daemon=True)
+                _loop_thread.start()
+                _loop = loop
+    return _loop
+
+
+def on_runtime_loop() -> bool:
+    return _loop_thread is not None and threading.current_thread() is _loop_thread
+
+
+def submit(coro: Awaitable) -> Future:
+    """Schedule a coroutine on the shared loop from any thread.
+
+    The caller's contextvars are copied into the new task, so request-scoped
+    state set before submitting is visible inside the coroutine.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_runtime_loop())
+
+
+def run_sync(coro: Awaitable) -> Any:
+    """Block the calling thread until a coroutine finishes on the shared loop"""
+    if on_runtime_loop():
+        raise RuntimeError(
+            "run_sync() called from the runtime loop; await the coroutine instead")
+    return submit(coro).result()
+
+
+async def run_on_runtime(coro: Awaitable) -> Any:
+    """Await a coroutine on the shared loop from any event loop.
+
+    The coroutine always runs as a task of its own, so contextvars it sets do
+    not leak back into the caller.
+    """
+    if on_runtime_loop():
+        return await asyncio.ensure_future(coro)
+    return await asyncio.wrap_future(submit(coro))
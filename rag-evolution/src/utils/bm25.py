@@ -0,0 +1,100 @@
+import heapq
+import json
+import math
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Words too common to say anything about a document
+STOPWORDS = frozenset("""
+a about an and are as at be but by can do does for from had has have how i in is
+it its me my of on or our so than that the their them then there these they this
+to was we were what when where which who why will with you your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens without stopwords"""
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 inverted index over one dataset, persisted as JSON.
+
+    Postings map each term to (row, term frequency) pairs; rows index `ids`.
+    `version` is the collection version the index was built from, so readers
+    can tell when DataPrep has changed the collection since.
+    """
+
+    def __init__(self, ids: List[str], doc_lengths: List[int], postings: Dict[str, List[List[int]]],
+                 version: Optional[str] = None, k1: float = 1.5, b: float = 0.75):
+        self.ids = ids
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.version = version
+        self.k1 = k1
+        self.b = b
+        self.average_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+        self.idf = {term: math.log(1 + (len(ids) - len(rows) + 0.5) / (len(rows) + 0.5))
+                    for term, rows in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids: List[str], texts: List[str], version: Optional[str] = None,
+              k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        postings: Dict[str, List[List[int]]] = {}
+        doc_lengths = []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append([row, frequency])
+        return cls(ids, doc_lengths, postings, version, k1, b)
+
+    @classmethod
+    def from_collection(cls, collection, version: Optional[str] = None, k1: float = 1.5,
+                        b: float = 0.75, page_size: int = 1000) -> "BM25Index":
+        """Index every document of a Chroma collection, read page by page"""
+        ids, texts = [], []
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            ids += page["ids"]
+            texts += page["documents"]
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+        return cls.build(ids, texts, version, k1, b)
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[str, float]]:
+        """Top-k (id, score) pairs, best first; documents sharing no term are left out"""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for row, frequency in self.postings[term]:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[row] / (self.average_length or 1.0)
+                scores[row] = scores.get(row, 0.0) + idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * length_norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.ids[row], score) for row, score in best]
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        staging = path.with_suffix(path.suffix + ".tmp")
+        with open(staging, "w", encoding="utf-8") as f:
+            json.dump({"version": self.version, "k1": self.k1, "b": self.b, "ids": self.ids,
+                       "doc_lengths": self.doc_lengths, "postings": self.postings}, f)
+        staging.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "BM25Index":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["doc_lengths"], data["postings"],
+                   data["version"], data["k1"], data["b"])
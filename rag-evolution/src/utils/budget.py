@@ -0,0 +1,54 @@
+from typing import Optional, Tuple
+from src.utils.tracing import Span
+
+
+class RequestBudget:
+    """Latency and token budget of one request, read from its root trace span.
+
+    Call `attempt_finished()` once per pass of a retry loop, when the next pass
+    starts. `can_afford_another()` projects one more pass at the cost of the most
+    expensive pass so far, counting the one in progress, and says whether it
+    still fits. A limit of None is unlimited.
+    """
+
+    def __init__(self, trace: Span, latency_seconds: Optional[float] = None,
+                 tokens: Optional[int] = None):
+        self.trace = trace
+        self.latency_seconds = latency_seconds
+        self.tokens = tokens
+        self.attempts = 0
+        self._max_attempt_seconds = 0.0
+        self._max_attempt_tokens = 0
+        self._mark = self.used()
+
+    def used(self) -> Tuple[float, int]:
+        """(seconds, tokens) consumed by the request so far"""
+        totals = self.trace.totals()
+        return self.trace.duration, totals["prompt_tokens"] + totals["completion_tokens"]
+
+    def attempt_finished(self):
+        seconds, tokens = self.used()
+        self._max_attempt_seconds = max(self._max_attempt_seconds, seconds - self._mark[0])
+        self._max_attempt_tokens = max(self._max_attempt_tokens, tokens - self._mark[1])
+        self._mark = (seconds, tokens)
+        self.attempts += 1
+
+    def can_afford_another(self) -> bool:
+        seconds, tokens = self.used()
+        # The pass in progress has cost at least this much so far
+        attempt_seconds = max(self._max_attempt_seconds, seconds - self._mark[0])
+        attempt_tokens = max(self._max_attempt_tokens, tokens - self._mark[1])
+        if self.latency_seconds is not None and seconds + attempt_seconds > self.latency_seconds:
+            return False
+        if self.tokens is not None and tokens + attempt_tokens > self.tokens:
+            return False
+        return True
+
+    def summary(self) -> str:
+        seconds, tokens = self.used()
+        latency_limit = f"{self.latency_seconds:g}s" if self.latency_seconds is not None else "unlimited"
+        token_limit = str(self.tokens) if self.tokens is not None else "unlimited"
+        # Finished passes plus the one in progress
+        attempts = self.attempts + 1
+        return (f"{seconds:.2f}s of {latency_limit}, {tokens} of {token_limit} tokens "
+                f"after {attempts} attempt{'s' if attempts != 1 else ''}")
@@ -0,0 +1,197 @@
+import re
+import threading
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import numpy as np
+from langchain_core.documents import Document
+from src.load_config import APPConfig
+from src.utils.rank_fusion import document_key
+from src.utils.tokens import DEFAULT_MODEL, clip_to_tokens, count_tokens
+from src.utils.tracing import span
+
+# Mersenne prime modulus of the MinHash permutations h(x) = (a * x + b) mod p;
+# a, b < 2**31 and 32-bit shingle hashes keep a * x + b inside uint64
+_PRIME = (1 << 61) - 1
+_WORD = re.compile(r"\w+")
+
+
+class MinHasher:
+    """MinHash signatures of word shingles, for estimating Jaccard similarity"""
+
+    def __init__(self, num_permutations: int = 64, shingle_size: int = 3, seed: int = 1):
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 31, size=num_permutations).astype(np.uint64)
+        self._b = rng.randint(0, 1 << 31, size=num_permutations).astype(np.uint64)
+
+    def shingles(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return [" ".join(words)] if words else []
+        return [" ".join(words[i:i + self.shingle_size])
+                for i in range(len(words) - self.shingle_size + 1)]
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.array(sorted({zlib.crc32(shingle.encode()) for shingle in self.shingles(text)}),
+                          dtype=np.uint64)
+        if not len(hashes):
+            return np.full(len(self._a), _PRIME, dtype=np.uint64)
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _PRIME).min(axis=1)
+
+    @staticmethod
+    def similarity(first: np.ndarray, second: np.ndarray) -> float:
+        """Estimated Jaccard similarity: the fraction of matching signature slots"""
+        return float(np.mean(first == second))
+
+
+@dataclass
+class PackedContext:
+    """The context handed to the answer prompt, and what packing left out"""
+    text: str
+    documents: List[Document] = field(default_factory=list)
+    candidates: int = 0
+    duplicates: int = 0
+    dropped: int = 0
+    clipped: bool = False
+    input_tokens: int = 0
+    tokens: int = 0
+    max_tokens: Optional[int] = None
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(0, self.input_tokens - self.tokens)
+
+    def summary(self) -> str:
+        budget = f" of {self.max_tokens}" if self.max_tokens is not None else ""
+        saved = (f"saved {self.saved_tokens} of {self.input_tokens} tokens "
+                 f"({self.saved_tokens / self.input_tokens:.0%})" if self.input_tokens else "saved 0 tokens")
+        budget_cuts = f"{self.dropped} dropped{' and 1 clipped' if self.clipped else ''} for the budget"
+        return (f"Context packing: {len(self.documents)}/{self.candidates} passages in "
+                f"{self.tokens}{budget} tokens, {self.duplicates} near-duplicates removed, "
+                f"{budget_cuts}; {saved}")
+
+
+class ContextPacker:
+    """Builds a technique's prompt context from its retrieved documents.
+
+    Passages are ordered by score (best first; retrieval order when no scores
+    are given), and a passage whose MinHash similarity to one already kept is
+    at least `similarity_threshold` is dropped as a near-duplicate. The rest are
+    packed until `max_tokens` tiktoken tokens are used; the first passage that
+    does not fit is clipped to the remaining budget if at least
+    `min_passage_tokens` are left. `template` renders each passage, with its
+    1-based position as `index`. Every pack() is traced as a `pack_context` span.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, similarity_threshold: float = 0.8,
+                 shingle_size: int = 3, num_permutations: int = 64, min_passage_tokens: int = 50,
+                 separator: str = "\n\n", template: str = "{content}", model: str = DEFAULT_MODEL):
+        self.max_tokens = max_tokens
+        self.similarity_threshold = similarity_threshold
+        self.min_passage_tokens = min_passage_tokens
+        self.separator = separator
+        self.template = template
+        self.model = model
+        self.hasher = MinHasher(num_permutations, shingle_size)
+        self.packs = 0
+        self.input_tokens = 0
+        self.packed_tokens = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, max_tokens: Optional[int], **overrides) -> "ContextPacker":
+        """Packer with the `context_packing` settings of config.yml and a technique's token budget"""
+        packing = APPConfig.load().context_packing
+        settings = dict(similarity_threshold=packing.similarity_threshold,
+                        shingle_size=packing.shingle_size,
+                        num_permutations=packing.num_permutations,
+                        min_passage_tokens=packing.min_passage_tokens)
+        settings.update(overrides)
+        return cls(max_tokens=max_tokens, **settings)
+
+    def _render(self, documents: List[Document]) -> str:
+        return self.separator.join(self.template.format(index=i, content=doc.page_content)
+                                   for i, doc in enumerate(documents, 1))
+
+    def deduplicate(self, documents: List[Document]) -> List[Document]:
+        """Documents in order, without those too similar to an earlier one"""
+        kept, keys, signatures = [], set(), []
+        for doc in documents:
+            key = document_key(doc)
+            if key in keys:
+                continue
+            signature = self.hasher.signature(doc.page_content)
+            if any(MinHasher.similarity(signature, other) >= self.similarity_threshold
+                   for other in signatures):
+                continue
+            kept.append(doc)
+            keys.add(key)
+            signatures.append(signature)
+        return kept
+
+    def pack(self, documents: List[Document], scores: Optional[List[float]] = None) -> PackedContext:
+        if scores is not None:
+            # Drop empty passages together with their scores, so the pairs stay aligned
+            ranked = sorted(((doc, score) for doc, score in zip(documents, scores) if doc.page_content),
+                            key=lambda pair: pair[1], reverse=True)
+            documents = [doc for doc, _ in ranked]
+        else:
+            documents = [doc for doc in documents if doc.page_content]
+
+        with span("pack_context", passages=len(documents)) as pack_span:
+            input_tokens = count_tokens(self._render(documents), self.model)
+            unique = self.deduplicate(documents)
+
+            kept: List[Document] = []
+            used = 0
+            clipped = False
+            separator_tokens = count_tokens(self.separator, self.model)
+            for doc in unique:
+                gap = separator_tokens if kept else 0
+                rendered = self.template.format(index=len(kept) + 1, content=doc.page_content)
+                cost = gap + count_tokens(rendered, self.model)
+                if self.max_tokens is None or used + cost <= self.max_tokens:
+                    kept.append(doc)
+                    used += cost
+                    continue
+                overhead = gap + count_tokens(
+                    self.template.format(index=len(kept) + 1, content=""), self.model)
+                # One token is left for the clip marker
+                remaining = self.max_tokens - used - overhead - 1
+                if remaining >= self.min_passage_tokens:
+                    kept.append(Document(
+                        page_content=clip_to_tokens(doc.page_content, remaining, self.model),
+                        metadata=doc.metadata))
+                    clipped = True
+                break
+
+            text = self._render(kept)
+            tokens = count_tokens(text, self.model)
+            if self.max_tokens is not None and tokens > self.max_tokens:
+                # Token counts of passages are not exactly additive once joined;
+                # one token is left for the clip marker
+                text = clip_to_tokens(text, self.max_tokens - 1, self.model)
+                tokens = count_tokens(text, self.model)
+
+            packed = PackedContext(
+                text=text, documents=kept, candidates=len(documents),
+                duplicates=len(documents) - len(unique),
+                dropped=len(unique) - len(kept), clipped=clipped,
+                input_tokens=input_tokens, tokens=tokens, max_tokens=self.max_tokens)
+            pack_span.set(kept=len(kept), duplicates=packed.duplicates,
+                          tokens=tokens, saved_tokens=packed.saved_tokens)
+
+        with self._lock:
+            self.packs += 1
+            self.input_tokens += input_tokens
+            self.packed_tokens += tokens
+            self.duplicates += packed.duplicates
+        return packed
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"packs": self.packs, "input_tokens": self.input_tokens,
+                    "packed_tokens": self.packed_tokens, "duplicates": self.duplicates,
+                    "saved_tokens": self.input_tokens - self.packed_tokens}
@@ -0,0 +1,213 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional
+from pydantic import BaseModel, Field
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_community.callbacks import get_openai_callback
+from src.utils.lru_cache import LRUCache
+from src.utils.rank_fusion import document_key
+from src.utils.tracing import span
+
+
+class GradeDocuments(BaseModel):
+    """Binary score for relevance check on retrieved documents."""
+    binary_score: str = Field(
+        description="Documents are relevant to the question, 'yes' or 'no'"
+    )
+
+
+class GradeDocumentList(BaseModel):
+    """Binary relevance scores for a numbered list of retrieved documents."""
+    binary_scores: List[str] = Field(
+        description="One 'yes' or 'no' per document, in the same order as the documents"
+    )
+
+
+@dataclass
+class GradingResult:
+    mode: str
+    scores: List[Optional[str]]  # 'yes' / 'no', or None when grading failed
+    errors: List[Optional[str]]
+    latency_seconds: float
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_cost: float = 0.0
+    memo_hits: int = 0
+
+    def is_relevant(self, i: int) -> bool:
+        return (self.scores[i] or "").strip().lower() == "yes"
+
+    def summary(self) -> str:
+        if self.mode == "memo":
+            return f"reused the earlier grades of all {self.memo_hits} documents (0 tokens)"
+        tokens = self.prompt_tokens + self.completion_tokens
+        reused = f", {self.memo_hits} reused from earlier grades" if self.memo_hits else ""
+        return (f"{self.mode} mode graded {len(self.scores) - self.memo_hits} documents in {self.latency_seconds:.2f}s "
+                f"({tokens} tokens, ${self.total_cost:.5f}){reused}")
+
+
+class GradeMemo:
+    """LRU of relevance scores keyed by (scope, question, document id).
+
+    The scope is whatever makes a grade stale, e.g. (dataset, collection version).
+    Failed grades are never stored, so they are retried.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self._cache = LRUCache(max_entries)
+
+    def get(self, scope: Hashable, question: str, doc) -> Optional[str]:
+        return self._cache.get((scope, question, document_key(doc)))
+
+    def put(self, scope: Hashable, question: str, doc, score: str):
+        self._cache.put((scope, question, document_key(doc)), score)
+
+    def stats(self) -> Dict[str, int]:
+        stats = self._cache.stats()
+        return {"hits": stats["hits"], "misses": stats["misses"], "entries": stats["entries"]}
+
+
+@dataclass
+class _ModeStats:
+    calls: int = 0
+    documents: int = 0
+    seconds: float = 0.0
+    tokens: int = 0
+    cost: float = 0.0
+
+
+_stats: Dict[str, _ModeStats] = {}
+_stats_lock = threading.Lock()
+
+
+def grading_stats() -> Dict[str, Dict[str, float]]:
+    """Cumulative latency and token cost per grading mode for this process"""
+    with _stats_lock:
+        return {mode: dict(vars(stats)) for mode, stats in _stats.items()}
+
+
+class DocumentGrader:
+    """Relevance grading engine shared by SelfRAG, CorrectiveRAG and AdaptiveRAG.
+
+    mode="batch" grades each document with its own call, run concurrently via
+    `abatch` with max_concurrency=N. mode="listwise" grades every document in a
+    single structured call that returns one yes/no per document, and falls
+    back to batch mode if the answer does not line up with the documents.
+    """
+
+    def __init__(self, llm, grade_system: str, mode: str = "batch", max_concurrency: int = 4):
+        if mode not in ("batch", "listwise"):
+            raise ValueError(f"Unknown grading mode: {mode}")
+        self.mode = mode
+        self.max_concurrency = max_concurrency
+
+        self.grade_prompt = ChatPromptTemplate.from_messages([
+            ("system", grade_system),
+            ("human",
+             "Retrieved document: \n\n {document} \n\n User question: {question}")
+        ])
+        self.doc_grader = self.grade_prompt | llm.with_structured_output(
+            GradeDocuments)
+
+        listwise_system = grade_system + """
+
+                You will receive several numbered documents. Grade each one independently
+                and return exactly one score per document, in the same order."""
+        self.listwise_prompt = ChatPromptTemplate.from_messages([
+            ("system", listwise_system),
+            ("human",
+             "Retrieved documents: \n\n {documents} \n\n Number of documents: {count} \n\n User question: {question}")
+        ])
+        self.listwise_grader = self.listwise_prompt | llm.with_structured_output(
+            GradeDocumentList)
+
+    async def agrade(self, question: str, documents: List) -> GradingResult:
+        start = time.perf_counter()
+        with span("grade", documents=len(documents)) as grading_span, get_openai_callback() as cb:
+            mode = self.mode
+            result = None
+            if mode == "listwise":
+                result = await self._agrade_listwise(question, documents)
+                if result is None:
+                    mode = "listwise->batch"
+            if result is None:
+                result = await self._agrade_batch(question, documents)
+            scores, errors = result
+            grading_span.set(mode=mode, relevant=sum(score == "yes" for score in scores),
+                             failed=sum(error is not None for error in errors))
+
+        grading = GradingResult(
+            mode=mode,
+            scores=scores,
+            errors=errors,
+            latency_seconds=time.perf_counter() - start,
+            prompt_tokens=cb.prompt_tokens,
+            completion_tokens=cb.completion_tokens,
+            total_cost=cb.total_cost
+        )
+        self._record(grading)
+        return grading
+
+    async def _agrade_batch(self, question: str, documents: List):
+        inputs = [{"question": question, "document": doc.page_content}
+                  for doc in documents]
+        outputs = await self.doc_grader.abatch(
+            inputs,
+            config={"max_concurrency": self.max_concurrency},
+            return_exceptions=True
+        )
+
+        scores, errors = [], []
+        for output in outputs:
+            if isinstance(output, Exception):
+                scores.append(None)
+                errors.append(str(output))
+            else:
+                scores.append(output.binary_score)
+                errors.append(None)
+        return scores, errors
+
+    async def _agrade_listwise(self, question: str, documents: List):
+        numbered = "\n\n".join(
+            f"[{i+1}] {doc.page_content}" for i, doc in enumerate(documents))
+        try:
+            output = await self.listwise_grader.ainvoke({
+                "question": question,
+                "documents": numbered,
+                "count": len(documents)
+            })
+        except Exception:
+            return None
+
+        if len(output.binary_scores) != len(documents):
+            return None
+        return list(output.binary_scores), [None] * len(documents)
+
+    async def agrade_memoized(self, question: str, documents: List, memo: GradeMemo,
+                              scope: Hashable = None) -> GradingResult:
+        """agrade() that only sends documents without a memoized grade for this question"""
+        known = [memo.get(scope, question, doc) for doc in documents]
+        missing = [i for i, score in enumerate(known) if score is None]
+        if not missing:
+            return GradingResult(mode="memo", scores=known, errors=[None] * len(documents),
+                                 latency_seconds=0.0, memo_hits=len(documents))
+
+        grading = await self.agrade(question, [documents[i] for i in missing])
+        scores, errors = list(known), [None] * len(documents)
+        for i, score, error in zip(missing, grading.scores, grading.errors):
+            scores[i], errors[i] = score, error
+            if error is None and score is not None:
+                memo.put(scope, question, documents[i], score)
+        grading.scores, grading.errors = scores, errors
+        grading.memo_hits = len(documents) - len(missing)
+        return grading
+
+    def _record(self, grading: GradingResult):
+        with _stats_lock:
+            stats = _stats.setdefault(grading.mode, _ModeStats())
+            stats.calls += 1
+            stats.documents += len(grading.scores)
+            stats.seconds += grading.latency_seconds
+            stats.tokens += grading.prompt_tokens + grading.completion_tokens
+            stats.cost += grading.total_cost
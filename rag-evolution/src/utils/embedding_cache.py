@@ -0,0 +1,182 @@
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so trivially different queries share one cache entry"""
+    return " ".join(text.split()).casefold()
+
+
+class EmbeddingCache:
+    """Size-bounded LRU of embeddings with optional TTL and SQLite persistence.
+
+    Entries are keyed by (model, normalized text). When `persist_path` is set,
+    every new embedding is also written to a SQLite file and looked up there on
+    an in-memory miss, so the cache survives restarts. Expired rows, and all but
+    the newest `max_persisted_entries`, are deleted from the file at startup and
+    at most once a minute on write.
+    """
+
+    def __init__(self, max_entries: int = 2048, ttl_seconds: Optional[float] = None,
+                 persist_path: Optional[str] = None, max_persisted_entries: Optional[int] = 100000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_persisted_entries = max_persisted_entries
+        self.hits = 0
+        self.misses = 0
+        self._last_prune = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if persist_path:
+            Path(persist_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(persist_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text TEXT NOT NULL, embedding BLOB NOT NULL, "
+                "created_at REAL NOT NULL, PRIMARY KEY (model, text))")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+            self._db.commit()
+            self._prune()
+
+    def _expired(self, created_at: float) -> bool:
+        return bool(self.ttl_seconds) and time.time() - created_at > self.ttl_seconds
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = (model, normalize_text(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                embedding, created_at = entry
+                if not self._expired(created_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding, created_at FROM embeddings WHERE model = ? AND text = ?",
+                    key).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    embedding = array('f', row[0]).tolist()
+                    self._store(key, embedding, row[1])
+                    self.hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, model: str, text: str, embedding: List[float]):
+        key = (model, normalize_text(text))
+        created_at = time.time()
+        with self._lock:
+            self._store(key, embedding, created_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    (*key, array('f', embedding).tobytes(), created_at))
+                self._db.commit()
+                if created_at - self._last_prune > 60:
+                    self._prune()
+
+    def _store(self, key: Tuple[str, str], embedding: List[float], created_at: float):
+        self._entries[key] = (embedding, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune(self):
+        """Delete expired rows, and the oldest beyond max_persisted_entries, from disk"""
+        self._last_prune = time.time()
+        if self.ttl_seconds:
+            self._db.execute("DELETE FROM embeddings WHERE created_at < ?",
+                             (time.time() - self.ttl_seconds,))
+        if self.max_persisted_entries is not None:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings "
+                "ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (self.max_persisted_entries,))
+        self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+class CachedEmbeddings:
+    """Embeddings wrapper that answers repeated queries from an EmbeddingCache"""
+
+    def __init__(self, embeddings, model: str, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+
+    def embed_query_with_status(self, text: str) -> Tuple[List[float], bool]:
+        """Embed a query and report whether it was served from the cache"""
+        embedding = self.cache.get(self.model, text)
+        if embedding is not None:
+            return embedding, True
+        embedding = self.embeddings.embed_query(text)
+        self.cache.put(self.model, text, embedding)
+        return embedding, False
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_query_with_status(text)[0]
+
+    async def aembed_query_with_status(self, text: str) -> Tuple[List[float], bool]:
+        embedding = self.cache.get(self.model, text)
+        if embedding is not None:
+            return embedding, True
+        embedding = await self.embeddings.aembed_query(text)
+        self.cache.put(self.model, text, embedding)
+        return embedding, False
+
+    def embed_queries_with_status(self, texts: List[str]) -> Tuple[List[List[float]], int]:
+        """Embed several queries, sending every cache miss in a single request.
+
+        Returns the embeddings in input order and the number of cache hits.
+        """
+        embeddings, hits, missing = self._lookup(texts)
+        if missing:
+            first_texts = [texts[positions[0]] for positions in missing.values()]
+            self._fill(embeddings, first_texts, missing,
+                       self.embeddings.embed_documents(first_texts))
+        return embeddings, hits
+
+    async def aembed_queries_with_status(self, texts: List[str]) -> Tuple[List[List[float]], int]:
+        embeddings, hits, missing = self._lookup(texts)
+        if missing:
+            first_texts = [texts[positions[0]] for positions in missing.values()]
+            self._fill(embeddings, first_texts, missing,
+                       await self.embeddings.aembed_documents(first_texts))
+        return embeddings, hits
+
+    def _lookup(self, texts: List[str]):
+        """Cached embeddings in input order, the hit count, and the misses grouped by normalized text"""
+        embeddings = [self.cache.get(self.model, text) for text in texts]
+        hits = sum(1 for embedding in embeddings if embedding is not None)
+
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(normalize_text(texts[i]), []).append(i)
+        return embeddings, hits, missing
+
+    def _fill(self, embeddings: List, first_texts: List[str], missing: Dict[str, List[int]],
+              new_embeddings: List[List[float]]):
+        for text, positions, embedding in zip(first_texts, missing.values(), new_embeddings):
+            self.cache.put(self.model, text, embedding)
+            for i in positions:
+                embeddings[i] = embedding
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def stats_line(self) -> str:
+        stats = self.cache.stats()
+        return f"hits={stats['hits']}, misses={stats['misses']}, cached={stats['entries']}"
@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Literal, Optional, get_args, get_origin
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+# Deterministic, offline stand-ins for ChatOpenAI, OpenAIEmbeddings and the
+# OpenAI clients, used by the benchmark. Every call is tallied in RECORDER.
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token)"""
+    return max(1, len(text) // 4)
+
+
+def _stable_hash(text: str) -> int:
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest(), 16)
+
+
+class CallRecorder:
+    """Thread-safe tally of model calls, token estimates and seconds per stage"""
+
+    COUNTERS = ("llm_calls", "embedding_calls", "embedded_texts", "web_search_calls",
+                "prompt_tokens", "completion_tokens")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {name: 0 for name in self.COUNTERS}
+            self.stage_seconds: Dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float, **counts: int):
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(
+                stage, 0.0) + seconds
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.counts, "stage_seconds": dict(self.stage_seconds)}
+
+
+RECORDER = CallRecorder()
+
+
+class LocalChatModel(BaseChatModel):
+    """Chat model that answers from the prompt text alone, after an optional simulated latency"""
+
+    model: str = "local"
+    temperature: float = 0.0
+    timeout: Optional[float] = None
+    latency_seconds: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "local"
+
+    @staticmethod
+    def _prompt_text(messages) -> str:
+        return "\n".join(str(message.content) for message in messages)
+
+    def _respond(self, prompt: str) -> str:
+        digest = _stable_hash(prompt)
+        if "Create 3 alternative queries" in prompt:
+            topic = re.search(r"Original Query: (.*)", prompt)
+            topic = topic.group(1).strip() if topic else "the topic"
+            return (f"1. Definition and core concepts of {topic}\n"
+                    f"2. Practical applications of {topic}\n"
+                    f"3. Recent developments related to {topic}")
+        if "numerical score" in prompt:
+            return str(3 + digest % 6)
+        if "re-writer" in prompt:
+            question = prompt.strip().splitlines()[-1]
+            return f"Detailed explanation of {question[-120:]}"
+
+        # Otherwise answer with a slice of the prompt's own words
+        words = re.findall(r"\w+", prompt)
+        length = 40 + digest % 60
+        start = (digest // 7) % max(1, len(words) - length)
+        return "Answer: " + " ".join(words[start:start + length])
+
+    def _record(self, prompt: str, completion: str, seconds: float):
+        RECORDER.record("llm", seconds, llm_calls=1,
+                        prompt_tokens=estimate_tokens(prompt),
+                        completion_tokens=estimate_tokens(completion))
+
+    @staticmethod
+    def _result(prompt: str, text: str) -> ChatResult:
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(text)
+        message = AIMessage(content=text, usage_metadata={
+            "input_tokens": prompt_tokens,
+            "output_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        start = time.perf_counter()
+        time.sleep(self.latency_seconds)
+        prompt = self._prompt_text(messages)
+        text = self._respond(prompt)
+        self._record(prompt, text, time.perf_counter() - start)
+        return self._result(prompt, text)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency_seconds)
+        prompt = self._prompt_text(messages)
+        text = self._respond(prompt)
+        self._record(prompt, text, time.perf_counter() - start)
+        return self._result(prompt, text)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        result = self._generate(messages, stop, run_manager, **kwargs)
+        for word in result.generations[0].message.content.split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        result = await self._agenerate(messages, stop, run_manager, **kwargs)
+        for word in result.generations[0].message.content.split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+
+    def with_structured_output(self, schema, **kwargs):
+        """Fill the schema's fields from a hash of the prompt: ~70% 'yes' grades, any Literal choice"""
+
+        def build(prompt_value, start: float) -> Any:
+            prompt = prompt_value.to_string() if hasattr(
+                prompt_value, "to_string") else str(prompt_value)
+            values = {}
+            for name, field in schema.model_fields.items():
+                values[name] = self._structured_value(
+                    prompt, name, field.annotation)
+            result = schema(**values)
+            self._record(prompt, str(values), time.perf_counter() - start)
+            return result
+
+        async def abuild(prompt_value) -> Any:
+            start = time.perf_counter()
+            await asyncio.sleep(self.latency_seconds)
+            return build(prompt_value, start)
+
+        def build_sync(prompt_value) -> Any:
+            start = time.perf_counter()
+            time.sleep(self.latency_seconds)
+            return build(prompt_value, start)
+
+        return RunnableLambda(build_sync, afunc=abuild)
+
+    @staticmethod
+    def _structured_value(prompt: str, name: str, annotation) -> Any:
+        digest = _stable_hash(f"{name}:{prompt}")
+        if get_origin(annotation) is Literal:
+            choices = get_args(annotation)
+            return choices[digest % len(choices)]
+        if get_origin(annotation) in (list, List):
+            count = re.search(r"Number of documents: (\d+)", prompt)
+            count = int(count.group(1)) if count else 1
+            return ["yes" if _stable_hash(f"{i}:{prompt}") % 10 < 7 else "no"
+                    for i in range(count)]
+        return "yes" if digest % 10 < 7 else "no"
+
+
+class LocalEmbeddings:
+    """Hashed bag-of-words embeddings: texts sharing words get similar vectors"""
+
+    def __init__(self, model: str = "local", latency_seconds: float = 0.0, dimensions: int = 256):
+        self.model = model
+        self.latency_seconds = latency_seconds
+        self.dimensions = dimensions
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            vector[_stable_hash(word) % self.dimensions] += 1.0
+        norm = sum(x * x for x in vector) ** 0.5 or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        time.sleep(self.latency_seconds)
+        embeddings = [self._embed(text) for text in texts]
+        RECORDER.record("embedding", time.perf_counter() - start,
+                        embedding_calls=1, embedded_texts=len(texts))
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency_seconds)
+        embeddings = [self._embed(text) for text in texts]
+        RECORDER.record("embedding", time.perf_counter() - start,
+                        embedding_calls=1, embedded_texts=len(texts))
+        return embeddings
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+class LocalEmbeddingsClient:
+    """OpenAI-client lookalike exposing `embeddings.create`, for DataPrep"""
+
+    def __init__(self, embeddings: LocalEmbeddings):
+        self._local = embeddings
+        self.embeddings = self
+
+    def create(self, model: str, input: List[str], encoding_format: str = "float"):
+        vectors = self._local.embed_documents(list(input))
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=vector)
+                                     for i, vector in enumerate(vectors)])
+
+
+class LocalWebSearchClient:
+    """AsyncOpenAI lookalike whose `responses.create` returns a canned web result"""
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.responses = self
+
+    async def create(self, model: Any = None, tools: Any = None, input: str = "", **kwargs):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency_seconds)
+        text = f"Recent reports summarised for: {input[-200:]}"
+        RECORDER.record("web_search", time.perf_counter() - start, web_search_calls=1,
+                        prompt_tokens=estimate_tokens(input),
+                        completion_tokens=estimate_tokens(text))
+        return SimpleNamespace(output_text=text)
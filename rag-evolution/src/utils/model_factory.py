@@ -0,0 +1,60 @@
+import threading
+from typing import Any, Callable, Optional
+
+# langchain_openai and openai take about a second to import, so they are
+# imported by the first create_* call that needs them, not at startup
+
+# Replacements installed with override_models(), e.g. local stand-ins for benchmarks
+_chat_factory: Optional[Callable[..., Any]] = None
+_embeddings_factory: Optional[Callable[..., Any]] = None
+_web_search_factory: Optional[Callable[[], Any]] = None
+
+# One web search client per process: AsyncOpenAI keeps a pooled HTTP connection
+# pool, so reusing it avoids a TCP/TLS handshake per search
+_web_search_client: Optional[Any] = None
+_web_search_lock = threading.Lock()
+
+
+def create_chat_model(**kwargs):
+    """ChatOpenAI(**kwargs), unless a chat model factory was installed"""
+    if _chat_factory is not None:
+        return _chat_factory(**kwargs)
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(**kwargs)
+
+
+def create_embeddings(**kwargs):
+    """OpenAIEmbeddings(**kwargs), unless an embeddings factory was installed"""
+    if _embeddings_factory is not None:
+        return _embeddings_factory(**kwargs)
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(**kwargs)
+
+
+def create_web_search_client():
+    """AsyncOpenAI client used for the Responses API web search tool"""
+    if _web_search_factory is not None:
+        return _web_search_factory()
+    from openai import AsyncOpenAI
+    return AsyncOpenAI()
+
+
+def get_web_search_client():
+    """Shared web search client, created on first use"""
+    global _web_search_client
+    with _web_search_lock:
+        if _web_search_client is None:
+            _web_search_client = create_web_search_client()
+        return _web_search_client
+
+
+def override_models(chat: Optional[Callable[..., Any]] = None,
+                    embeddings: Optional[Callable[..., Any]] = None,
+                    web_search: Optional[Callable[[], Any]] = None):
+    """Install factories used instead of the OpenAI classes; None restores the default"""
+    global _chat_factory, _embeddings_factory, _web_search_factory, _web_search_client
+    _chat_factory = chat
+    _embeddings_factory = embeddings
+    _web_search_factory = web_search
+    with _web_search_lock:
+        _web_search_client = None
@@ -0,0 +1,92 @@
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from src.utils.embedding_cache import normalize_text
+from src.utils.lru_cache import LRUCache
+
+
+def load_examples(path: Path) -> List[Tuple[str, str]]:
+    """(label, question) pairs from a "label | question" file; # comments and blank lines skipped"""
+    examples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            label, _, question = line.partition("|")
+            if not question.strip():
+                raise ValueError(f"Expected 'label | question' in {path}: {line}")
+            examples.append((label.strip(), question.strip()))
+    return examples
+
+
+class EmbeddingRouter:
+    """Nearest-centroid classifier over query embeddings with a decision cache.
+
+    Each label's centroid is the normalized mean of its example embeddings.
+    A query goes to the label whose centroid is most cosine-similar; the gap to
+    the runner-up is the confidence, and decisions below `min_margin` are left
+    to the caller (the LLM router). Decisions, whoever made them, are cached
+    per normalized query.
+    """
+
+    def __init__(self, examples: List[Tuple[str, str]], min_margin: float = 0.03,
+                 cache_max_entries: int = 1024):
+        self.examples = examples
+        self.labels = sorted({label for label, _ in examples})
+        self.min_margin = min_margin
+        self.cache_max_entries = cache_max_entries
+        self.centroids: Optional[np.ndarray] = None
+        self.counts = {"cache": 0, "local": 0, "llm": 0}
+        self._decisions = LRUCache(cache_max_entries)
+        self._lock = threading.Lock()
+
+    async def afit(self, embeddings):
+        """Embed the examples (one batched call through the embedding cache) and build the centroids"""
+        if self.centroids is not None:
+            return
+        vectors, _ = await embeddings.aembed_queries_with_status(
+            [question for _, question in self.examples])
+        vectors = self._unit(np.asarray(vectors, dtype=np.float32))
+        labels = np.array([label for label, _ in self.examples])
+        self.centroids = self._unit(np.stack(
+            [vectors[labels == label].mean(axis=0) for label in self.labels]))
+
+    @staticmethod
+    def _unit(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def classify(self, embedding: List[float]) -> Tuple[str, float]:
+        """Closest label and its margin over the runner-up (cosine similarity)"""
+        similarities = self.centroids @ self._unit(np.asarray(embedding, dtype=np.float32))
+        order = np.argsort(similarities)[::-1]
+        margin = float(similarities[order[0]] - similarities[order[1]]) if len(order) > 1 else 1.0
+        return self.labels[order[0]], margin
+
+    def is_confident(self, margin: float) -> bool:
+        return margin >= self.min_margin
+
+    def cached(self, query: str) -> Optional[Tuple[str, str]]:
+        """(label, source) of an earlier decision for the same normalized query"""
+        decision = self._decisions.get(normalize_text(query))
+        if decision is not None:
+            with self._lock:
+                self.counts["cache"] += 1
+        return decision
+
+    def remember(self, query: str, label: str, source: str):
+        """Cache a decision; source is "local" or "llm" """
+        with self._lock:
+            self.counts[source] += 1
+        self._decisions.put(normalize_text(query), (label, source))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts, cached=len(self._decisions))
+
+    def stats_line(self) -> str:
+        stats = self.stats()
+        return (f"decided locally={stats['local']}, by LLM={stats['llm']}, "
+                f"from cache={stats['cache']}")
@@ -0,0 +1,49 @@
+from typing import List, Optional, Tuple
+import numpy as np
+from langchain_core.documents import Document
+
+
+def document_key(doc: Document) -> str:
+    """Stable identity of a retrieved document: its Chroma id, else its content"""
+    return doc.metadata.get("id") or doc.page_content
+
+
+def reciprocal_rank_fusion(results: List[List[Document]], k: float = 60,
+                           weights: Optional[List[float]] = None) -> List[Tuple[Document, float]]:
+    """Weighted Reciprocal Rank Fusion keyed on document ids.
+
+    score(d) = sum_q weights[q] / (k + rank_q(d)), with 0-based ranks. The
+    scores are computed over a (queries x unique documents) rank matrix, and
+    (document, score) pairs are returned best first.
+    """
+    if weights is None:
+        weights = [1.0] * len(results)
+    if len(weights) != len(results):
+        raise ValueError(
+            f"Got {len(weights)} weights for {len(results)} result lists")
+
+    positions = {}
+    unique_docs = []
+    for docs in results:
+        for doc in docs:
+            key = document_key(doc)
+            if key not in positions:
+                positions[key] = len(unique_docs)
+                unique_docs.append(doc)
+
+    if not unique_docs:
+        return []
+
+    # ranks[q, d] is the rank of document d in result list q (inf when absent)
+    ranks = np.full((len(results), len(unique_docs)), np.inf)
+    for query_idx, docs in enumerate(results):
+        for rank, doc in enumerate(docs):
+            doc_idx = positions[document_key(doc)]
+            ranks[query_idx, doc_idx] = min(ranks[query_idx, doc_idx], rank)
+
+    weight_column = np.asarray(weights, dtype=float)[:, None]
+    scores = (weight_column / (k + ranks)).sum(axis=0)
+
+    # Stable sort keeps first-seen order among equal scores
+    order = np.argsort(-scores, kind="stable")
+    return [(unique_docs[i], float(scores[i])) for i in order]
@@ -0,0 +1,69 @@
+import contextvars
+import functools
+import inspect
+from typing import Any, Callable, List, Optional, Tuple
+from src.utils.async_runtime import run_on_runtime
+from src.utils.tracing import Span, render_trace, root_span
+
+# Receives ("log" | "reset" | "token", payload) events for a streaming consumer
+_current_sink = contextvars.ContextVar("rag_stream_sink", default=None)
+_current_request = contextvars.ContextVar("rag_request", default=None)
+
+
+class RequestContext:
+    """Per-request state of a technique run: its trace and stream consumer.
+
+    Lives in a contextvar instead of on the technique instance, so concurrent
+    requests served by the same technique never share or clobber logs.
+    """
+
+    def __init__(self, trace: Span, sink: Optional[Callable[[Tuple[str, Any]], None]] = None):
+        self.trace = trace
+        self.sink = sink
+
+    @property
+    def logs(self) -> List[str]:
+        return render_trace(self.trace)
+
+    def emit(self, event: str, payload: Any = None):
+        if self.sink is not None:
+            self.sink((event, payload))
+
+
+def current_request() -> Optional[RequestContext]:
+    return _current_request.get()
+
+
+def current_logs() -> List[str]:
+    """Log lines of the running request, rendered from its trace"""
+    request = current_request()
+    return request.logs if request is not None else []
+
+
+def request_scoped(method):
+    """Run an async technique entry point in its own RequestContext and trace on the shared loop.
+
+    The root span is named after the technique class. A (response, logs) result
+    gets its logs re-rendered once the root span is closed, so they include
+    the total duration.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        attributes = {"dataset": arguments["dataset"]} if "dataset" in arguments else {}
+
+        async def scoped():
+            sink = _current_sink.get()
+            with root_span(type(args[0]).__name__, sink=sink, **attributes) as trace:
+                request = RequestContext(trace, sink=sink)
+                _current_request.set(request)
+                result = await method(*args, **kwargs)
+            if isinstance(result, tuple) and len(result) == 2:
+                result = (result[0], request.logs)
+            return result
+
+        return await run_on_runtime(scoped())
+
+    return wrapper
@@ -0,0 +1,472 @@
+import asyncio
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from pyprojroot import here
+from langchain_core.documents import Document
+from src.load_config import APPConfig
+from src.utils.embedding_cache import CachedEmbeddings, EmbeddingCache
+from src.utils.model_factory import create_embeddings
+from src.utils.bm25 import BM25Index
+from src.utils.rank_fusion import reciprocal_rank_fusion
+from src.utils.tracing import record_error, span
+from src.utils.vector_index import MmapVectorIndex, matches_where
+
+APP_CONFIG = APPConfig.load()
+
+DATASETS = ["tech_docs", "faq_data", "news_articles"]
+BACKENDS = ("chroma", "mmap")
+
+
+class RetrievalService:
+    """Process-wide retrieval layer shared by every RAG technique.
+
+    Owns a single Chroma client and a single embeddings model, and caches the
+    collection handle of each dataset so its HNSW segments are loaded once per
+    process instead of once per technique. Query embeddings go through an
+    EmbeddingCache so repeated questions are not re-embedded.
+
+    With the "mmap" backend, searches skip Chroma: each collection is exported
+    once into a memory-mapped MmapVectorIndex and searched in-process. The
+    export is redone when DataPrep changes the collection's version.
+
+    In hybrid mode, searches that know the query text also rank the dataset's
+    BM25 index and fuse both rankings with weighted Reciprocal Rank Fusion, so
+    short keyword queries still find their documents.
+    """
+
+    clients_created = 0
+
+    def __init__(self, client=None, embeddings=None, cache: Optional[EmbeddingCache] = None,
+                 backend: Optional[str] = None, index_path: Optional[str] = None,
+                 hybrid: Optional[bool] = None, bm25_path: Optional[str] = None):
+        self.backend = backend or APP_CONFIG.vector_index.backend
+        if self.backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown vector index backend '{self.backend}', expected one of {BACKENDS}")
+        self.index_path = Path(index_path or here(APP_CONFIG.vector_index.path))
+        self.hybrid = APP_CONFIG.hybrid_retrieval.enabled if hybrid is None else hybrid
+        self.bm25_path = Path(bm25_path or here(APP_CONFIG.hybrid_retrieval.bm25_path))
+        if client is None:
+            # Imported here: chromadb alone adds about a second to startup
+            import chromadb
+            client = chromadb.PersistentClient(
+                path=str(here(APP_CONFIG.chroma_db_path)))
+            RetrievalService.clients_created += 1
+        self.client = client
+        if cache is None:
+            cache_config = APP_CONFIG.embedding_cache
+            cache = EmbeddingCache(
+                max_entries=cache_config.max_entries,
+                ttl_seconds=cache_config.ttl_seconds,
+                persist_path=str(here(cache_config.persist_path)) if cache_config.persist_path else None,
+                max_persisted_entries=cache_config.max_persisted_entries
+            )
+        self.embeddings = CachedEmbeddings(
+            embeddings or create_embeddings(model=APP_CONFIG.embedding_model),
+            model=APP_CONFIG.embedding_model,
+            cache=cache
+        )
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._indexes: Dict[str, MmapVectorIndex] = {}
+        self._bm25: Dict[str, BM25Index] = {}
+        self._catalogs: Dict[str, Dict[str, Any]] = {}
+        self._index_lock = threading.Lock()
+
+    def get_collection(self, dataset: str):
+        """Return the cached collection handle, opening it on first use"""
+        collection = self._collections.get(dataset)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.get(dataset)
+                if collection is None:
+                    collection = self.client.get_collection(dataset)
+                    self._collections[dataset] = collection
+        return collection
+
+    def collection_version(self, dataset: str) -> Optional[str]:
+        """Version DataPrep stamps on a collection whenever its contents change.
+
+        Read fresh from the client on every call so rebuilds done by another
+        process are noticed; a collection that was recreated under a new id also
+        replaces the cached handle.
+        """
+        collection = self.client.get_collection(dataset)
+        with self._lock:
+            cached = self._collections.get(dataset)
+            if cached is None or cached.id != collection.id:
+                self._collections[dataset] = collection
+        version = (collection.metadata or {}).get("version")
+        with self._index_lock:
+            index = self._indexes.get(dataset)
+            if index is not None and index.version != version:
+                del self._indexes[dataset]
+            bm25 = self._bm25.get(dataset)
+            if bm25 is not None and bm25.version != version:
+                del self._bm25[dataset]
+            catalog = self._catalogs.get(dataset)
+            if catalog is not None and catalog["version"] != version:
+                del self._catalogs[dataset]
+        return version
+
+    def get_index(self, dataset: str) -> MmapVectorIndex:
+        """Return the memory-mapped index of a dataset, exporting it from Chroma if missing or stale"""
+        index = self._indexes.get(dataset)
+        if index is None:
+            with self._index_lock:
+                index = self._indexes.get(dataset)
+                if index is None:
+                    index = self._open_index(dataset)
+                    self._indexes[dataset] = index
+        return index
+
+    def _open_index(self, dataset: str) -> MmapVectorIndex:
+        config = APP_CONFIG.vector_index
+        collection = self.client.get_collection(dataset)
+        version = (collection.metadata or {}).get("version")
+        directory = self.index_path / dataset
+        if (directory / "meta.json").exists():
+            index = MmapVectorIndex(directory)
+            if index.version == version and len(index) == collection.count():
+                return index
+        return MmapVectorIndex.export(collection, directory, version,
+                                      dtype=config.dtype,
+                                      ivf_min_vectors=config.ivf_min_vectors,
+                                      ivf_lists=config.ivf_lists)
+
+    def get_bm25(self, dataset: str) -> BM25Index:
+        """Return the BM25 index DataPrep saved for a dataset, rebuilding it if missing or stale"""
+        bm25 = self._bm25.get(dataset)
+        if bm25 is None:
+            with self._index_lock:
+                bm25 = self._bm25.get(dataset)
+                if bm25 is None:
+                    bm25 = self._open_bm25(dataset)
+                    self._bm25[dataset] = bm25
+        return bm25
+
+    def _open_bm25(self, dataset: str) -> BM25Index:
+        config = APP_CONFIG.hybrid_retrieval
+        collection = self.client.get_collection(dataset)
+        version = (collection.metadata or {}).get("version")
+        path = self.bm25_path / f"{dataset}.json"
+        if path.exists():
+            bm25 = BM25Index.load(path)
+            if bm25.version == version and len(bm25) == collection.count():
+                return bm25
+        bm25 = BM25Index.from_collection(collection, version, k1=config.k1, b=config.b)
+        bm25.save(path)
+        return bm25
+
+    def metadata_catalog(self, dataset: str) -> Dict[str, Any]:
+        """Categories and newest date_ordinal stored in a dataset, read once per collection version.
+
+        Lets callers build `where` filters that can match something, instead of
+        finding out with an empty search.
+        """
+        catalog = self._catalogs.get(dataset)
+        if catalog is None:
+            with self._index_lock:
+                catalog = self._catalogs.get(dataset)
+                if catalog is None:
+                    catalog = self._read_catalog(dataset)
+                    self._catalogs[dataset] = catalog
+        return catalog
+
+    def _read_catalog(self, dataset: str) -> Dict[str, Any]:
+        collection = self.client.get_collection(dataset)
+        metadatas = [metadata or {} for metadata in collection.get(include=["metadatas"])["metadatas"]]
+        dates = [metadata["date_ordinal"] for metadata in metadatas if "date_ordinal" in metadata]
+        return {
+            "version": (collection.metadata or {}).get("version"),
+            "categories": frozenset(metadata["category"] for metadata in metadatas
+                                    if metadata.get("category")),
+            "newest_date_ordinal": max(dates) if dates else None,
+        }
+
+    def lexical_search(self, dataset: str, query: str, k: int = 5,
+                       where: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """BM25 keyword search over a dataset; `where` filters the matches"""
+        return self._documents_by_id(dataset, self._lexical_ids(dataset, query, k, where), where)[:k]
+
+    def _lexical_ids(self, dataset: str, query: str, k: int,
+                     where: Optional[Dict[str, Any]] = None) -> List[str]:
+        """Ids of the BM25 matches of a query, best first"""
+        # Over-fetch when filtering, the filter is applied to the BM25 matches afterwards
+        return [doc_id for doc_id, _ in self.get_bm25(dataset).search(query, k * 4 if where else k)]
+
+    def _documents_by_id(self, dataset: str, ids: List[str],
+                         where: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """Documents for the given ids, in the same order, skipping ids the filter rejects"""
+        if not ids:
+            return []
+        if self.backend == "mmap":
+            index = self.get_index(dataset)
+            rows = [index.row(doc_id) for doc_id in ids]
+            return [_index_document(index, row) for row in rows
+                    if row is not None and matches_where(index.metadatas[row], where)]
+
+        get_kwargs = {"ids": ids, "include": ['documents', 'metadatas']}
+        if where:
+            get_kwargs["where"] = where
+        results = self.get_collection(dataset).get(**get_kwargs)
+        found = {}
+        for doc_id, content, metadata in zip(results['ids'], results['documents'], results['metadatas']):
+            metadata = dict(metadata or {})
+            metadata["id"] = doc_id
+            found[doc_id] = Document(page_content=content, metadata=metadata)
+        return [found[doc_id] for doc_id in ids if doc_id in found]
+
+    def search(self, dataset: str, query: Optional[str] = None,
+               embedding: Optional[List[float]] = None, k: int = 5,
+               where: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """Similarity search over a dataset with a query and/or a precomputed embedding.
+
+        The query text is needed for the lexical half of hybrid search; with an
+        embedding alone the search is dense only.
+        """
+        if embedding is None:
+            if query is None:
+                raise ValueError("search() needs either a query or an embedding")
+            embedding = self.embeddings.embed_query(query)
+
+        return self._query(dataset, [embedding], k, where,
+                           None if query is None else [query])[0]
+
+    def search_batch(self, dataset: str, queries: Optional[List[str]] = None,
+                     embeddings: Optional[List[List[float]]] = None, k: int = 5,
+                     where: Optional[Dict[str, Any]] = None) -> List[List[Document]]:
+        """Run several similarity searches in one embedding request and one vector query.
+
+        Returns one list of Documents per query, in input order.
+        """
+        if embeddings is None:
+            if queries is None:
+                raise ValueError(
+                    "search_batch() needs either queries or embeddings")
+            embeddings, _ = self.embeddings.embed_queries_with_status(queries)
+        if not embeddings:
+            return []
+
+        return self._query(dataset, embeddings, k, where, queries)
+
+    def _query(self, dataset: str, embeddings: List[List[float]], k: int,
+               where: Optional[Dict[str, Any]],
+               queries: Optional[List[str]] = None) -> List[List[Document]]:
+        """Top-k Documents per embedding, fused with BM25 matches in hybrid mode"""
+        if not self.hybrid or queries is None:
+            return self._dense_query(dataset, embeddings, k, where)
+
+        config = APP_CONFIG.hybrid_retrieval
+        candidates = max(k, config.candidates)
+        dense_results = self._dense_query(dataset, embeddings, candidates, where)
+
+        # The lexical candidates of all queries are fetched in one lookup
+        lexical_ids = [self._lexical_ids(dataset, query, candidates, where) for query in queries]
+        union = list(dict.fromkeys(doc_id for ids in lexical_ids for doc_id in ids))
+        found = {doc.metadata["id"]: doc for doc in self._documents_by_id(dataset, union, where)}
+
+        fused = []
+        for ids, dense in zip(lexical_ids, dense_results):
+            lexical = [found[doc_id] for doc_id in ids if doc_id in found][:candidates]
+            ranked = reciprocal_rank_fusion(
+                [dense, lexical], weights=[config.dense_weight, config.lexical_weight])
+            fused.append([doc for doc, _ in ranked[:k]])
+        return fused
+
+    def _dense_query(self, dataset: str, embeddings: List[List[float]], k: int,
+                     where: Optional[Dict[str, Any]]) -> List[List[Document]]:
+        """Top-k Documents per embedding from the configured vector backend"""
+        if self.backend == "mmap":
+            index = self.get_index(dataset)
+            hits = index.search(embeddings, k=k, where=where,
+                                n_probes=APP_CONFIG.vector_index.ivf_probes)
+            return [[_index_document(index, row) for row, _ in row_hits] for row_hits in hits]
+
+        query_kwargs = {
+            "query_embeddings": embeddings,
+            "n_results": k,
+            "include": ['documents', 'metadatas']
+        }
+        if where:
+            query_kwargs["where"] = where
+
+        results = self.get_collection(dataset).query(**query_kwargs)
+        return [_to_documents(results, row) for row in range(len(embeddings))]
+
+    def warm(self, dataset: str):
+        """Load a dataset's search structures ahead of its first request.
+
+        Opens the collection and runs one search with a stored embedding, so the
+        vector index is resident without an embeddings API call; the BM25 index
+        is loaded too in hybrid mode.
+        """
+        collection = self.get_collection(dataset)
+        sample = collection.get(limit=1, include=["embeddings"])
+        if len(sample["ids"]):
+            self._dense_query(dataset, [list(sample["embeddings"][0])], 1, None)
+        if self.hybrid:
+            self.get_bm25(dataset)
+
+    def stats(self) -> Dict[str, Any]:
+        """Resident clients and collections held by the service"""
+        return {
+            "clients": RetrievalService.clients_created,
+            "collections": len(self._collections),
+            "datasets": sorted(self._collections),
+            "backend": self.backend,
+            "hybrid": self.hybrid,
+            "indexes": sorted(self._indexes),
+            "embedding_cache": self.embeddings.cache.stats()
+        }
+
+
+def _to_documents(results: Dict, row: int) -> List[Document]:
+    """Convert one row of a Chroma query result into Documents.
+
+    The Chroma id is kept in metadata["id"] so downstream steps can identify
+    documents without comparing their content.
+    """
+    documents = []
+    if results['documents'] and results['documents'][row]:
+        ids = results['ids'][row]
+        metadatas = results['metadatas'][row] if results.get(
+            'metadatas') else None
+        for i, doc_content in enumerate(results['documents'][row]):
+            metadata = dict((metadatas[i] if metadatas else None) or {})
+            metadata["id"] = ids[i]
+            documents.append(
+                Document(page_content=doc_content, metadata=metadata))
+    return documents
+
+
+def _index_document(index: MmapVectorIndex, row: int) -> Document:
+    """Document of one MmapVectorIndex row, with the same metadata["id"] as _to_documents"""
+    metadata = dict(index.metadatas[row])
+    metadata["id"] = index.ids[row]
+    return Document(page_content=index.documents[row], metadata=metadata)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_retrieval_service() -> RetrievalService:
+    """Return the process-wide RetrievalService, creating it on first call"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = RetrievalService()
+    return _service
+
+
+def set_retrieval_service(service: RetrievalService):
+    """Replace the process-wide service, e.g. with one over an in-memory Chroma client"""
+    global _service
+    with _service_lock:
+        _service = service
+
+
+class DatasetRetriever:
+    """Per-dataset view on the shared service used by the technique pipelines"""
+
+    def __init__(self, service: RetrievalService, dataset: str, logger: Callable[[str], None]):
+        self.service = service
+        self.dataset = dataset
+        self.logger = logger
+
+    def get_relevant_documents(self, query: str, k: int = 5,
+                               where: Optional[Dict[str, Any]] = None) -> List[Document]:
+        with span("retrieve", dataset=self.dataset, k=k, hybrid=self.service.hybrid) as retrieval:
+            try:
+                with span("embed", texts=1) as embedding_span:
+                    embedding, cache_hit = self.service.embeddings.embed_query_with_status(
+                        query)
+                    embedding_span.set(cache_hits=int(cache_hit))
+                self.logger(
+                    f"Embedding cache {'hit' if cache_hit else 'miss'} ({self.service.embeddings.stats_line()})")
+                documents = self.service.search(
+                    self.dataset, query=query, embedding=embedding, k=k, where=where)
+                retrieval.set(documents=len(documents))
+                return documents
+            except Exception as e:
+                self.logger(f"Retrieval error: {str(e)}")
+                record_error(e)
+                return []
+
+    async def aget_relevant_documents(self, query: str, k: int = 5,
+                                      where: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """Async get_relevant_documents; the Chroma query runs in a worker thread"""
+        with span("retrieve", dataset=self.dataset, k=k, hybrid=self.service.hybrid) as retrieval:
+            try:
+                with span("embed", texts=1) as embedding_span:
+                    embedding, cache_hit = await self.service.embeddings.aembed_query_with_status(
+                        query)
+                    embedding_span.set(cache_hits=int(cache_hit))
+                self.logger(
+                    f"Embedding cache {'hit' if cache_hit else 'miss'} ({self.service.embeddings.stats_line()})")
+                documents = await asyncio.to_thread(
+                    self.service.search, self.dataset, query=query, embedding=embedding, k=k, where=where)
+                retrieval.set(documents=len(documents))
+                return documents
+            except Exception as e:
+                self.logger(f"Retrieval error: {str(e)}")
+                record_error(e)
+                return []
+
+    def get_relevant_documents_batch(self, queries: List[str], k: int = 5,
+                                     where: Optional[Dict[str, Any]] = None) -> List[List[Document]]:
+        """Retrieve for several queries with a single embedding call and a single vector search"""
+        with span("retrieve", dataset=self.dataset, k=k, queries=len(queries),
+                  hybrid=self.service.hybrid) as retrieval:
+            try:
+                with span("embed", texts=len(queries)) as embedding_span:
+                    embeddings, cache_hits = self.service.embeddings.embed_queries_with_status(
+                        queries)
+                    embedding_span.set(cache_hits=cache_hits)
+                self.logger(
+                    f"Embedding cache: {cache_hits}/{len(queries)} hits ({self.service.embeddings.stats_line()})")
+                results = self.service.search_batch(
+                    self.dataset, queries=queries, embeddings=embeddings, k=k, where=where)
+                retrieval.set(documents=sum(len(docs) for docs in results))
+                return results
+            except Exception as e:
+                self.logger(f"Batched retrieval error: {str(e)}")
+                record_error(e)
+                return [[] for _ in queries]
+
+    async def aget_relevant_documents_batch(self, queries: List[str], k: int = 5,
+                                            where: Optional[Dict[str, Any]] = None) -> List[List[Document]]:
+        with span("retrieve", dataset=self.dataset, k=k, queries=len(queries),
+                  hybrid=self.service.hybrid) as retrieval:
+            try:
+                with span("embed", texts=len(queries)) as embedding_span:
+                    embeddings, cache_hits = await self.service.embeddings.aembed_queries_with_status(
+                        queries)
+                    embedding_span.set(cache_hits=cache_hits)
+                self.logger(
+                    f"Embedding cache: {cache_hits}/{len(queries)} hits ({self.service.embeddings.stats_line()})")
+                results = await asyncio.to_thread(
+                    self.service.search_batch, self.dataset, queries=queries, embeddings=embeddings, k=k, where=where)
+                retrieval.set(documents=sum(len(docs) for docs in results))
+                return results
+            except Exception as e:
+                self.logger(f"Batched retrieval error: {str(e)}")
+                record_error(e)
+                return [[] for _ in queries]
+
+
+def build_retrievers(logger: Callable[[str], None],
+                     datasets: List[str] = DATASETS) -> Dict[str, DatasetRetriever]:
+    """Open every dataset on the shared service and wrap it in a DatasetRetriever"""
+    service = get_retrieval_service()
+    retrievers = {}
+    for dataset in datasets:
+        try:
+            service.get_collection(dataset)
+            retrievers[dataset] = DatasetRetriever(service, dataset, logger)
+        except Exception as e:
+            logger(f"Setup error for {dataset}: {str(e)}")
+    return retrievers
@@ -0,0 +1,181 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+from src.utils.tokens import clip_to_tokens, count_tokens
+
+
+@dataclass
+class SessionMemory:
+    """Conversation memory of one session: a running summary plus the newest exchanges"""
+    summary: str = ""
+    exchanges: List[Dict[str, str]] = field(default_factory=list)
+    updated_at: float = 0.0
+
+
+def exchange_text(exchange: Dict[str, str]) -> str:
+    """An exchange as it appears in the conversational prompt"""
+    return f"User: {exchange['user']}\nAssistant: {exchange['assistant']}"
+
+
+def memory_tokens(memory: SessionMemory) -> int:
+    return count_tokens(memory.summary) + sum(count_tokens(exchange_text(exchange))
+                                              for exchange in memory.exchanges)
+
+
+def _first_sentence(text: str) -> str:
+    match = re.match(r"(.+?[.!?])(\s|$)", " ".join(text.split()))
+    return match.group(1) if match else " ".join(text.split())
+
+
+class SessionStore:
+    """Conversation memory of every chat session, bounded in memory and on disk.
+
+    At most `max_sessions` sessions are kept in memory; the least recently used
+    ones are evicted and reloaded from SQLite (WAL mode, so readers never block
+    the writer) when they come back. Sessions idle longer than `idle_ttl_seconds`
+    are deleted from disk too.
+
+    Each session keeps at most `max_exchanges` exchanges, and summary plus
+    exchanges stay within `history_token_budget` tokens: older exchanges are
+    compacted into a running summary of one line per exchange, whose oldest
+    lines are dropped once it outgrows half the budget.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_sessions: int = 1000,
+                 max_exchanges: int = 5, history_token_budget: int = 1500,
+                 idle_ttl_seconds: Optional[float] = None):
+        self.max_sessions = max_sessions
+        self.max_exchanges = max_exchanges
+        self.history_token_budget = history_token_budget
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.evictions = 0
+        self.compactions = 0
+        self._last_prune = 0.0
+        self._sessions: "OrderedDict[str, SessionMemory]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, summary TEXT NOT NULL, "
+                "exchanges TEXT NOT NULL, updated_at REAL NOT NULL)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+            self._db.commit()
+            self._prune_idle()
+
+    def get(self, session_id: str) -> SessionMemory:
+        """A copy of the session's memory (empty for unknown sessions)"""
+        with self._lock:
+            memory = self._load(session_id)
+            if memory is None:
+                return SessionMemory()
+            return SessionMemory(memory.summary, list(memory.exchanges), memory.updated_at)
+
+    def has_history(self, session_id: str) -> bool:
+        memory = self.get(session_id)
+        return bool(memory.exchanges or memory.summary)
+
+    def append(self, session_id: str, user: str, assistant: str):
+        """Add an exchange, compacting older ones so the session stays within its caps"""
+        with self._lock:
+            memory = self._load(session_id) or SessionMemory()
+            memory.exchanges.append({"user": user, "assistant": assistant})
+            self._compact(memory)
+            memory.updated_at = time.time()
+            self._remember(session_id, memory)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                    (session_id, memory.summary, json.dumps(memory.exchanges), memory.updated_at))
+                self._db.commit()
+                if memory.updated_at - self._last_prune > 60:
+                    self._prune_idle()
+
+    def reset(self, session_id: str, user: str, assistant: str):
+        """Replace the session's memory with a single exchange"""
+        self.clear(session_id)
+        self.append(session_id, user, assistant)
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._db.commit()
+
+    def _expired(self, memory: SessionMemory) -> bool:
+        return bool(self.idle_ttl_seconds) and time.time() - memory.updated_at > self.idle_ttl_seconds
+
+    def _load(self, session_id: str) -> Optional[SessionMemory]:
+        memory = self._sessions.get(session_id)
+        if memory is not None and self._expired(memory):
+            del self._sessions[session_id]
+            memory = None
+        if memory is not None:
+            self._sessions.move_to_end(session_id)
+            return memory
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT summary, exchanges, updated_at FROM sessions WHERE session_id = ?",
+            (session_id,)).fetchone()
+        if row is None:
+            return None
+        memory = SessionMemory(row[0], json.loads(row[1]), row[2])
+        if self._expired(memory):
+            return None
+        self._remember(session_id, memory)
+        return memory
+
+    def _remember(self, session_id: str, memory: SessionMemory):
+        self._sessions[session_id] = memory
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            # Still on disk, reloaded if the session comes back
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def _compact(self, memory: SessionMemory):
+        """Fold the oldest exchanges into the summary until the caps hold"""
+        while len(memory.exchanges) > 1 and (
+                len(memory.exchanges) > self.max_exchanges
+                or memory_tokens(memory) > self.history_token_budget):
+            oldest = memory.exchanges.pop(0)
+            line = (f"- User asked: {clip_to_tokens(' '.join(oldest['user'].split()), 40)} | "
+                    f"Answer: {clip_to_tokens(_first_sentence(oldest['assistant']), 60)}")
+            memory.summary = self._trim_summary(
+                f"{memory.summary}\n{line}" if memory.summary else line)
+            self.compactions += 1
+
+    def _trim_summary(self, summary: str) -> str:
+        """Drop the oldest summary lines beyond half the history budget"""
+        lines = summary.split("\n")
+        while len(lines) > 1 and count_tokens("\n".join(lines)) > self.history_token_budget // 2:
+            lines.pop(0)
+        return clip_to_tokens("\n".join(lines), self.history_token_budget // 2)
+
+    def _prune_idle(self):
+        """Delete sessions idle longer than idle_ttl_seconds from disk"""
+        self._last_prune = time.time()
+        if self.idle_ttl_seconds:
+            self._db.execute("DELETE FROM sessions WHERE updated_at < ?",
+                             (time.time() - self.idle_ttl_seconds,))
+            self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stored = (self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+                      if self._db is not None else len(self._sessions))
+            return {"in_memory": len(self._sessions), "stored": stored,
+                    "evictions": self.evictions, "compactions": self.compactions}
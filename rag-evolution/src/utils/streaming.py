@@ -0,0 +1,87 @@
+import asyncio
+import queue
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Tuple
+from src.utils.async_runtime import submit
+from src.utils.request_context import _current_sink, current_request
+from src.utils.tracing import span
+
+_DONE = object()
+
+
+async def agenerate_answer(chain, inputs: Any) -> str:
+    """Run a final generation chain, streaming its tokens when a consumer is attached.
+
+    A "reset" event is sent before the tokens so consumers can discard the text
+    of an earlier attempt (e.g. a Self-RAG retry).
+    """
+    request = current_request()
+    with span("generate") as generation:
+        if request is None or request.sink is None:
+            answer = await chain.ainvoke(inputs)
+        else:
+            request.emit("reset")
+            chunks = []
+            async for chunk in chain.astream(inputs):
+                chunks.append(chunk)
+                request.emit("token", chunk)
+            answer = "".join(chunks)
+        generation.set(answer_chars=len(answer))
+    return answer
+
+
+def stream_pipeline(aprocess_query: Callable[..., Awaitable[Tuple[str, list]]], *args) -> Iterator[Tuple[str, Any]]:
+    """Run aprocess_query on the shared loop and yield its events from this thread.
+
+    Yields ("log", line), ("reset", None), ("token", text) while the pipeline
+    runs, and finally ("answer", (response, logs)) or ("error", exception).
+    """
+    events = queue.Queue()
+    token = _current_sink.set(events.put)
+    try:
+        future = submit(aprocess_query(*args))
+    finally:
+        _current_sink.reset(token)
+    future.add_done_callback(lambda _: events.put((_DONE, None)))
+
+    try:
+        while True:
+            event, payload = events.get()
+            if event is _DONE:
+                break
+            yield event, payload
+    finally:
+        if not future.done():
+            future.cancel()
+
+    try:
+        yield "answer", future.result()
+    except Exception as e:
+        yield "error", e
+
+
+async def astream_pipeline(aprocess_query: Callable[..., Awaitable[Tuple[str, list]]], *args) -> AsyncIterator[Tuple[str, Any]]:
+    """Async variant of stream_pipeline for consumers running on their own event loop"""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    token = _current_sink.set(
+        lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+    try:
+        task = asyncio.ensure_future(aprocess_query(*args))
+    finally:
+        _current_sink.reset(token)
+    task.add_done_callback(lambda _: events.put_nowait((_DONE, None)))
+
+    try:
+        while True:
+            event, payload = await events.get()
+            if event is _DONE:
+                break
+            yield event, payload
+    finally:
+        if not task.done():
+            task.cancel()
+
+    try:
+        yield "answer", task.result()
+    except Exception as e:
+        yield "error", e
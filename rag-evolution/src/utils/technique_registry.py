@@ -0,0 +1,110 @@
+import importlib
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class TechniqueRegistry:
+    """Constructs RAG techniques on first use instead of all at startup.
+
+    `specs` maps a display name to the (module, class) that implements it;
+    neither the module nor the technique is loaded until `get()` asks for it.
+    `warm_up()` builds a few techniques and loads their datasets on a background
+    thread, so the server can start answering before they are ready. Every
+    step is timed for `startup_report()`.
+    """
+
+    def __init__(self, specs: Dict[str, Tuple[str, str]], started_at: Optional[float] = None):
+        self.specs = specs
+        # perf_counter() value startup times are measured from (default: now)
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.ready_seconds: Optional[float] = None
+        self.construct_seconds: Dict[str, float] = {}
+        self.warm_seconds: Dict[str, float] = {}
+        self.warm_up_seconds: Optional[float] = None
+        self.warm_seconds_after_start: Optional[float] = None
+        self.warm_up_errors: Dict[str, str] = {}
+        self._instances: Dict[str, Any] = {}
+        self._locks = {name: threading.Lock() for name in specs}
+        self._warm_up_thread: Optional[threading.Thread] = None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.specs
+
+    def names(self) -> List[str]:
+        return list(self.specs)
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._instances
+
+    def mark_ready(self):
+        """Record when the app finished starting and could accept requests"""
+        self.ready_seconds = time.perf_counter() - self.started_at
+
+    def get(self, name: str):
+        """The technique instance, constructed on first call (blocking)"""
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._locks[name]:
+            instance = self._instances.get(name)
+            if instance is None:
+                start = time.perf_counter()
+                module_name, class_name = self.specs[name]
+                instance = getattr(importlib.import_module(module_name), class_name)()
+                self.construct_seconds[name] = time.perf_counter() - start
+                self._instances[name] = instance
+        return instance
+
+    def warm_up(self, names: List[str], datasets: List[str], warm_dataset):
+        """Construct `names` and call `warm_dataset(dataset)` for each dataset on a daemon thread"""
+        names = [name for name in names if name in self.specs]
+
+        def run():
+            start = time.perf_counter()
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    self.warm_up_errors[name] = str(e)
+            for dataset in datasets:
+                dataset_start = time.perf_counter()
+                try:
+                    warm_dataset(dataset)
+                    self.warm_seconds[dataset] = time.perf_counter() - dataset_start
+                except Exception as e:
+                    self.warm_up_errors[dataset] = str(e)
+            self.warm_up_seconds = time.perf_counter() - start
+            self.warm_seconds_after_start = time.perf_counter() - self.started_at
+            print("\n".join(self.startup_report()))
+
+        self._warm_up_thread = threading.Thread(target=run, name="technique-warm-up", daemon=True)
+        self._warm_up_thread.start()
+
+    def wait_for_warm_up(self, timeout: Optional[float] = None) -> bool:
+        if self._warm_up_thread is None:
+            return True
+        self._warm_up_thread.join(timeout)
+        return not self._warm_up_thread.is_alive()
+
+    def startup_report(self) -> List[str]:
+        lines = ["Startup report:"]
+        if self.ready_seconds is not None:
+            lines.append(f"  ready to serve after {self.ready_seconds:.2f}s")
+        if self._warm_up_thread is None:
+            lines.append("  warm-up: disabled")
+        elif self.warm_up_seconds is None:
+            lines.append("  warm-up: running")
+        else:
+            lines.append(f"  warm-up: finished {self.warm_seconds_after_start:.2f}s after start "
+                         f"(took {self.warm_up_seconds:.2f}s)")
+        for name, seconds in self.construct_seconds.items():
+            lines.append(f"  technique {name}: constructed in {seconds:.2f}s")
+        for dataset, seconds in self.warm_seconds.items():
+            lines.append(f"  dataset {dataset}: loaded in {seconds:.2f}s")
+        for item, error in self.warm_up_errors.items():
+            lines.append(f"  {item}: warm-up failed - {error}")
+        not_loaded = [name for name in self.specs if name not in self._instances]
+        if not_loaded:
+            lines.append(f"  not constructed yet: {', '.join(not_loaded)}")
+        return lines
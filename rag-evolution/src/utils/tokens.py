@@ -0,0 +1,42 @@
+import functools
+import re
+
+# Model whose tokenizer budgets are counted in; its siblings share the encoding
+DEFAULT_MODEL = "gpt-4o-mini"
+
+# ~4 characters per token, used when tiktoken cannot load its encoding files (offline)
+_APPROXIMATE_TOKEN = re.compile(r"\S{1,4}\s*|\s+")
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    """tiktoken encoding of a model (cl100k_base if unknown), or None if it cannot be loaded"""
+    try:
+        # Imported here so that importing a technique does not load tiktoken
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"tiktoken unavailable ({e}); estimating tokens from characters")
+        return None
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(_APPROXIMATE_TOKEN.findall(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def clip_to_tokens(text: str, max_tokens: int, model: str = DEFAULT_MODEL, suffix: str = "...") -> str:
+    """Cut text down to at most max_tokens tokens, marking the cut with suffix"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = _encoding(model)
+    if encoding is None:
+        return "".join(_APPROXIMATE_TOKEN.findall(text)[:max_tokens]).rstrip() + suffix
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]).rstrip() + suffix
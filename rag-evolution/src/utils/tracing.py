@@ -0,0 +1,410 @@
+import asyncio
+import bisect
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+_current_span = contextvars.ContextVar("rag_current_span", default=None)
+
+
+class Span:
+    """One timed step of a request, e.g. retrieve / embed / grade / generate / web_search.
+
+    Spans nest: the root span is the whole technique run. Each span keeps its
+    attributes (document counts, cache hits, ...), the tokens of the LLM calls
+    made directly inside it, its log events and its error, if any.
+    """
+
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None,
+                 parent: Optional["Span"] = None,
+                 sink: Optional[Callable[[Tuple[str, Any]], None]] = None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.sink = sink if parent is None else parent.sink
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.children: List["Span"] = []
+        self.events: List[Tuple[float, str]] = []
+        self.error: Optional[str] = None
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._end: Optional[float] = None
+        self._lock = threading.Lock()
+        if parent is not None:
+            with parent._lock:
+                parent.children.append(self)
+
+    @property
+    def duration(self) -> float:
+        return (self._end if self._end is not None else time.perf_counter()) - self._start
+
+    def set(self, **attributes: Any) -> "Span":
+        self.attributes.update(attributes)
+        return self
+
+    def add_event(self, message: str):
+        with self._lock:
+            self.events.append((time.perf_counter() - self._start, message))
+        self._emit("  " * (self.depth + 1) + f"• {message}")
+
+    def add_llm_usage(self, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            self.llm_calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def finish(self, error: Optional[str] = None):
+        if self._end is None:
+            self._end = time.perf_counter()
+        if error is not None:
+            self.error = error
+
+    def walk(self) -> Iterator["Span"]:
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def totals(self) -> Dict[str, int]:
+        """LLM calls and tokens of this span and everything below it"""
+        totals = {"llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        for span in self.walk():
+            totals["llm_calls"] += span.llm_calls
+            totals["prompt_tokens"] += span.prompt_tokens
+            totals["completion_tokens"] += span.completion_tokens
+        return totals
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "error": self.error,
+            "events": [{"offset_ms": round(offset * 1000, 3), "message": message}
+                       for offset, message in self.events],
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    def _emit(self, line: str):
+        if self.sink is not None:
+            self.sink(("log", line))
+
+
+class _SpanTokenUsage:
+    """Adds the token usage of every LLM call to the innermost open span"""
+
+    run_inline = True
+
+    def __init__(self, span: Span):
+        self.span = span
+
+    def on_llm_end(self, response, **kwargs):
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None),
+                                "usage_metadata", None) or {}
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+        if not prompt_tokens and not completion_tokens:
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+        self.span.add_llm_usage(prompt_tokens, completion_tokens)
+
+
+_token_counter = contextvars.ContextVar("rag_span_token_counter", default=None)
+_token_counter_class: Optional[type] = None
+_token_counter_lock = threading.Lock()
+
+
+def _make_token_counter(current: Span):
+    """A langchain callback handler counting LLM tokens into `current`.
+
+    langchain_core's tracer module pulls in langsmith (about half a second),
+    so the handler class is built and registered as a configure hook when the
+    first span opens rather than when tracing is imported.
+    """
+    global _token_counter_class
+    if _token_counter_class is None:
+        with _token_counter_lock:
+            if _token_counter_class is None:
+                from langchain_core.callbacks import BaseCallbackHandler
+                from langchain_core.tracers.context import register_configure_hook
+                register_configure_hook(_token_counter, inheritable=True)
+                _token_counter_class = type(
+                    "_SpanTokenCounter", (_SpanTokenUsage, BaseCallbackHandler), {})
+    return _token_counter_class(current)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def _activate(current: Span) -> Iterator[Span]:
+    """Make `current` the span that new spans, events and LLM token counts attach to"""
+    span_token = _current_span.set(current)
+    counter_token = _token_counter.set(_make_token_counter(current))
+    try:
+        yield current
+    except asyncio.CancelledError:
+        current.finish(error="cancelled")
+        raise
+    except BaseException as e:
+        current.finish(error=f"{type(e).__name__}: {e}")
+        raise
+    else:
+        current.finish()
+    finally:
+        _token_counter.reset(counter_token)
+        _current_span.reset(span_token)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """Open a child span of the current one for the duration of the block"""
+    child = Span(name, attributes, parent=_current_span.get())
+    child._emit("  " * child.depth + f"▸ {name}")
+    with _activate(child):
+        yield child
+
+
+@contextmanager
+def root_span(name: str, sink: Optional[Callable[[Tuple[str, Any]], None]] = None,
+              **attributes: Any) -> Iterator[Span]:
+    """Start a new trace; the finished root span is exported on exit"""
+    root = Span(name, attributes, sink=sink)
+    root._emit(f"▸ {name}")
+    try:
+        with _activate(root):
+            yield root
+    finally:
+        export_trace(root)
+
+
+def trace_event(message: str):
+    """Record a log event on the current span, or print it outside of a trace"""
+    current = _current_span.get()
+    if current is None:
+        print(message)
+    else:
+        current.add_event(message)
+
+
+def record_error(error: BaseException):
+    """Mark the current span as failed without raising"""
+    current = _current_span.get()
+    if current is not None:
+        current.error = f"{type(error).__name__}: {error}"
+
+
+def _format_attributes(span: Span) -> str:
+    parts = [f"{key}={value}" for key, value in span.attributes.items()]
+    totals = span.totals()
+    if totals["llm_calls"]:
+        parts.append(f"llm_calls={totals['llm_calls']}")
+    if totals["prompt_tokens"] or totals["completion_tokens"]:
+        parts.append(
+            f"tokens={totals['prompt_tokens']}+{totals['completion_tokens']}")
+    return f"  [{', '.join(parts)}]" if parts else ""
+
+
+def render_trace(root: Span) -> List[str]:
+    """Indented text lines of a trace for the logs panel: spans with timings, then their events"""
+    lines = []
+
+    def render(span: Span, depth: int):
+        indent = "  " * depth
+        marker = "✗" if span.error else "▸"
+        lines.append(
+            f"{indent}{marker} {span.name} {span.duration * 1000:.1f} ms{_format_attributes(span)}")
+
+        # Interleave events and child spans in the order they happened
+        items = [(offset, i, message) for i, (offset, message) in enumerate(span.events)]
+        items += [(child._start - span._start, len(items) + i, child)
+                  for i, child in enumerate(list(span.children))]
+        for _, _, item in sorted(items, key=lambda item: (item[0], item[1])):
+            if isinstance(item, Span):
+                render(item, depth + 1)
+            else:
+                lines.append(f"{indent}  • {item}")
+        if span.error:
+            lines.append(f"{indent}  ✗ {span.error}")
+
+    render(root, 0)
+    return lines
+
+
+class JsonlExporter:
+    """Appends every finished trace to a JSON Lines file"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def export(self, root: Span):
+        line = json.dumps(root.to_dict(), default=str)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Per-technique request/span latency histograms and counters in Prometheus text format"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._request_latency: Dict[Tuple[str], _Histogram] = {}
+        self._span_latency: Dict[Tuple[str, str], _Histogram] = {}
+        self._requests: Dict[Tuple[str, str], int] = {}
+        self._tokens: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def observe_trace(self, root: Span):
+        technique = root.name
+        status = "error" if any(span.error for span in root.walk()) else "ok"
+        totals = root.totals()
+        with self._lock:
+            self._histogram(self._request_latency,
+                            (technique,)).observe(root.duration)
+            for child in root.walk():
+                if child is not root:
+                    self._histogram(self._span_latency, (technique, child.name)).observe(
+                        child.duration)
+            self._requests[(technique, status)] = self._requests.get(
+                (technique, status), 0) + 1
+            for kind in ("prompt", "completion"):
+                key = (technique, kind)
+                self._tokens[key] = self._tokens.get(
+                    key, 0) + totals[f"{kind}_tokens"]
+
+    def _histogram(self, family: Dict, labels: Tuple) -> _Histogram:
+        if labels not in family:
+            family[labels] = _Histogram(self.buckets)
+        return family[labels]
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            lines += self._render_histogram(
+                "rag_request_duration_seconds", "End-to-end latency of a technique run",
+                ("technique",), self._request_latency)
+            lines += self._render_histogram(
+                "rag_span_duration_seconds", "Latency of a pipeline step (retrieve, embed, grade, generate, ...)",
+                ("technique", "span"), self._span_latency)
+            lines += self._render_counter(
+                "rag_requests_total", "Technique runs by outcome",
+                ("technique", "status"), self._requests)
+            lines += self._render_counter(
+                "rag_llm_tokens_total", "LLM tokens used by technique runs",
+                ("technique", "type"), self._tokens)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name,
+                 value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}"
+
+    def _render_histogram(self, name: str, help_text: str, label_names: Tuple[str, ...],
+                          family: Dict[Tuple, _Histogram]) -> List[str]:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for labels, histogram in sorted(family.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                bucket_labels = self._labels(label_names, labels, f'le="{bound}"')
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = self._labels(label_names, labels, 'le="+Inf"')
+            lines.append(f"{name}_bucket{bucket_labels} {histogram.count}")
+            lines.append(
+                f"{name}_sum{self._labels(label_names, labels)} {histogram.total}")
+            lines.append(
+                f"{name}_count{self._labels(label_names, labels)} {histogram.count}")
+        return lines
+
+    def _render_counter(self, name: str, help_text: str, label_names: Tuple[str, ...],
+                        family: Dict[Tuple, int]) -> List[str]:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for labels, value in sorted(family.items()):
+            lines.append(f"{name}{self._labels(label_names, labels)} {value}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+METRICS = MetricsRegistry()
+_exporters: List[Callable[[Span], None]] = [METRICS.observe_trace]
+
+
+def add_exporter(exporter: Callable[[Span], None]):
+    """Call `exporter(root_span)` for every finished trace"""
+    _exporters.append(exporter)
+
+
+def export_trace(root: Span):
+    for exporter in list(_exporters):
+        try:
+            exporter(root)
+        except Exception as e:
+            print(f"Trace export failed: {e}")
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve METRICS at http://host:port/metrics from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = METRICS.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever,
+                     name="rag-metrics-server", daemon=True).start()
+    return server
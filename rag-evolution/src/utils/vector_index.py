@@ -0,0 +1,250 @@
+import json
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+# Rows scored per matrix product, bounds the float32 copy made of a float16 index
+SCAN_BLOCK_ROWS = 65536
+
+
+def matches_where(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """Evaluate a Chroma `where` filter against one document's metadata"""
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if not _compare(value, operator, operand):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def _compare(value: Any, operator: str, operand: Any) -> bool:
+    if operator == "$eq":
+        return value == operand
+    if operator == "$ne":
+        return value != operand
+    if operator == "$in":
+        return value in operand
+    if operator == "$nin":
+        return value not in operand
+    if value is None:
+        return False
+    if operator == "$gt":
+        return value > operand
+    if operator == "$gte":
+        return value >= operand
+    if operator == "$lt":
+        return value < operand
+    if operator == "$lte":
+        return value <= operand
+    raise ValueError(f"Unsupported where operator: {operator}")
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Plain Lloyd's k-means on (a sample of) the vectors, returns the centroids"""
+    rng = np.random.default_rng(seed)
+    sample = vectors
+    if len(vectors) > n_lists * 256:
+        sample = vectors[rng.choice(len(vectors), n_lists * 256, replace=False)]
+    sample = np.asarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest(sample, centroids)
+        for i in range(n_lists):
+            members = sample[assignments == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+    return centroids
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the closest centroid (squared L2) for each vector"""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(vectors), SCAN_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + SCAN_BLOCK_ROWS], dtype=np.float32)
+        distances = centroid_norms[None, :] - 2 * block @ centroids.T
+        assignments[start:start + len(block)] = distances.argmin(axis=1)
+    return assignments
+
+
+class MmapVectorIndex:
+    """Exact (or IVF-pruned) top-k search over a memory-mapped embedding matrix.
+
+    Files of one collection, in its own directory:
+      vectors.npy    float32/float16 matrix, one row per document (memory-mapped)
+      sq_norms.npy   squared L2 norm of each row, for L2 distances via one matmul
+      meta.json      ids, documents, metadatas, distance space and source version
+      ivf_*.npy      optional coarse quantizer: centroids, row order, list offsets
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        with open(self.directory / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.version = meta["version"]
+        self.space = meta["space"]
+        self.ids: List[str] = meta["ids"]
+        self.documents: List[str] = meta["documents"]
+        self.metadatas: List[Dict[str, Any]] = meta["metadatas"]
+        self.vectors = np.load(self.directory / "vectors.npy", mmap_mode="r")
+        self.sq_norms = np.load(self.directory / "sq_norms.npy")
+        self.centroids = None
+        if (self.directory / "ivf_centroids.npy").exists():
+            self.centroids = np.load(self.directory / "ivf_centroids.npy")
+            self.list_rows = np.load(self.directory / "ivf_rows.npy")
+            self.list_offsets = np.load(self.directory / "ivf_offsets.npy")
+        self._where_masks: Dict[str, np.ndarray] = {}
+        self._rows: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, doc_id: str) -> Optional[int]:
+        """Row of a document id, or None if the index does not contain it"""
+        if self._rows is None:
+            self._rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        return self._rows.get(doc_id)
+
+    @classmethod
+    def export(cls, collection, directory: Path, version: Optional[str], dtype: str = "float32",
+               ivf_min_vectors: Optional[int] = None, ivf_lists: Optional[int] = None,
+               page_size: int = 1000) -> "MmapVectorIndex":
+        """Dump a Chroma collection into `directory` and open it"""
+        ids, documents, metadatas, embeddings = [], [], [], []
+        offset = 0
+        while True:
+            page = collection.get(include=["documents", "metadatas", "embeddings"],
+                                  limit=page_size, offset=offset)
+            ids += page["ids"]
+            documents += page["documents"]
+            metadatas += [dict(metadata or {}) for metadata in page["metadatas"]]
+            embeddings += list(page["embeddings"])
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+
+        # Write next to the target and swap in, so readers never see a partial index
+        directory = Path(directory)
+        staging = directory.with_name(directory.name + ".tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        np.save(staging / "vectors.npy", vectors.astype(dtype))
+        np.save(staging / "sq_norms.npy", (vectors ** 2).sum(axis=1))
+
+        if ivf_min_vectors is not None and len(ids) >= ivf_min_vectors:
+            n_lists = ivf_lists or max(1, int(np.sqrt(len(ids))))
+            centroids = _kmeans(vectors, n_lists)
+            assignments = _nearest(vectors, centroids)
+            rows = np.argsort(assignments, kind="stable").astype(np.int64)
+            offsets = np.searchsorted(assignments[rows], np.arange(n_lists + 1))
+            np.save(staging / "ivf_centroids.npy", centroids)
+            np.save(staging / "ivf_rows.npy", rows)
+            np.save(staging / "ivf_offsets.npy", offsets)
+
+        with open(staging / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"version": version, "space": space, "dtype": dtype,
+                       "ids": ids, "documents": documents, "metadatas": metadatas}, f)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        staging.rename(directory)
+        return cls(directory)
+
+    def search(self, embeddings: List[List[float]], k: int = 5,
+               where: Optional[Dict[str, Any]] = None,
+               n_probes: int = 8) -> List[List[Tuple[int, float]]]:
+        """Top-k (row, distance) pairs per query embedding, closest first"""
+        queries = np.asarray(embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if len(self) == 0 or k <= 0:
+            return [[] for _ in queries]
+        mask = self._where_mask(where)
+
+        # Full scans score every query against each block in one matrix product
+        ivf = self.centroids is not None and n_probes < len(self.centroids)
+        if mask is None and not ivf:
+            return self._scan(queries, k)
+
+        results = []
+        for query in queries:
+            candidates = self._probe(query, n_probes) if ivf else None
+            if mask is not None:
+                candidates = np.flatnonzero(mask) if candidates is None else candidates[mask[candidates]]
+            results.append(self._search_rows(query, k, np.sort(candidates)))
+        return results
+
+    def _probe(self, query: np.ndarray, n_probes: int) -> np.ndarray:
+        """Rows in the n_probes IVF lists whose centroids are closest to the query"""
+        distances = ((self.centroids - query) ** 2).sum(axis=1)
+        lists = np.argpartition(distances, n_probes)[:n_probes]
+        return np.concatenate([self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]]
+                               for i in lists])
+
+    def _scan(self, queries: np.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        """Exact top-k over all rows, keeping a running best-k per query across blocks"""
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_distances = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), SCAN_BLOCK_ROWS):
+            block = np.asarray(self.vectors[start:start + SCAN_BLOCK_ROWS])
+            distances = self._distances(queries, block, self.sq_norms[start:start + len(block)])
+            rows = np.broadcast_to(np.arange(start, start + len(block)), distances.shape)
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            best_distances = np.concatenate([best_distances, distances], axis=1)
+            if best_rows.shape[1] > k:
+                keep = np.argpartition(best_distances, k - 1, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_distances = np.take_along_axis(best_distances, keep, axis=1)
+
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        return [[(int(row), float(distance)) for row, distance in zip(rows, distances)]
+                for rows, distances in zip(best_rows, best_distances)]
+
+    def _search_rows(self, query: np.ndarray, k: int, rows: np.ndarray) -> List[Tuple[int, float]]:
+        """Exact top-k among the given rows only"""
+        if len(rows) == 0:
+            return []
+        distances = self._distances(query[None, :], np.asarray(self.vectors[rows]),
+                                    self.sq_norms[rows])[0]
+        k = min(k, len(rows))
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best], kind="stable")]
+        return [(int(rows[i]), float(distances[i])) for i in best]
+
+    def _distances(self, queries: np.ndarray, block: np.ndarray, sq_norms: np.ndarray) -> np.ndarray:
+        """(queries x rows) distances in the collection's space, matching Chroma's l2 / ip / cosine"""
+        dots = queries @ block.astype(np.float32, copy=False).T
+        if self.space == "ip":
+            return 1.0 - dots
+        if self.space == "cosine":
+            norms = np.linalg.norm(queries, axis=1)[:, None] * np.sqrt(sq_norms)[None, :]
+            return 1.0 - dots / np.maximum(norms, 1e-12)
+        return sq_norms[None, :] - 2 * dots + (queries ** 2).sum(axis=1)[:, None]
+
+    def _where_mask(self, where: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Boolean row mask of a metadata filter, computed once per distinct filter"""
+        if not where:
+            return None
+        key = json.dumps(where, sort_keys=True)
+        mask = self._where_masks.get(key)
+        if mask is None:
+            mask = np.fromiter((matches_where(metadata, where) for metadata in self.metadatas),
+                               dtype=bool, count=len(self.metadatas))
+            self._where_masks[key] = mask
+        return mask
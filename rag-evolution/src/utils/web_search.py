@@ -0,0 +1,87 @@
+import asyncio
+import re
+import threading
+from typing import Dict, Optional, Tuple
+from src.utils.lru_cache import LRUCache
+from src.utils.model_factory import get_web_search_client
+from src.utils.tracing import span
+
+
+def normalize_query(query: str) -> str:
+    """Case-, whitespace- and punctuation-insensitive cache key of a search query"""
+    return " ".join(re.sub(r"[^\w\s]", " ", query.casefold()).split())
+
+
+class CachedWebSearch:
+    """Responses API web search through the shared pooled client.
+
+    Results are cached per normalized query for `ttl_seconds` (LRU-bounded),
+    and a search that has not answered within `deadline_seconds` is abandoned
+    so the caller can continue with local documents only.
+    """
+
+    def __init__(self, model: str, deadline_seconds: float, ttl_seconds: Optional[float] = 3600,
+                 max_entries: int = 512):
+        self.model = model
+        self.deadline_seconds = deadline_seconds
+        self.deadline_fallbacks = 0
+        self.errors = 0
+        self._cache = LRUCache(max_entries, ttl_seconds)
+        self._lock = threading.Lock()
+
+    async def asearch(self, query: str, prompt: str) -> Tuple[Optional[str], str]:
+        """Return (text, outcome) with outcome "hit", "miss", "deadline" or "error".
+
+        `query` is the cache key before normalization; `prompt` is what is sent
+        to the model. text is None when the search missed its deadline or failed.
+        """
+        key = normalize_query(query)
+        with span("web_search", deadline_seconds=self.deadline_seconds) as search:
+            cached = self._cache.get(key)
+            search.set(cache_hit=cached is not None)
+            if cached is not None:
+                return cached, "hit"
+
+            try:
+                response = await asyncio.wait_for(
+                    get_web_search_client().responses.create(
+                        model=self.model,
+                        tools=[{
+                            "type": "web_search_preview",
+                            "search_context_size": "low"
+                        }],
+                        input=prompt,
+                        # A little longer than the deadline, so that wait_for
+                        # fires first and slow searches count as deadline fallbacks
+                        timeout=self.deadline_seconds + 1
+                    ),
+                    timeout=self.deadline_seconds
+                )
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self.deadline_fallbacks += 1
+                search.set(outcome="deadline")
+                return None, "deadline"
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                search.set(outcome="error", error=str(e))
+                return None, "error"
+
+            text = response.output_text
+            search.set(chars=len(text))
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                search.add_llm_usage(usage.input_tokens, usage.output_tokens)
+            self._cache.put(key, text)
+            return text, "miss"
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._cache.stats(), deadline_fallbacks=self.deadline_fallbacks,
+                        errors=self.errors)
+
+    def stats_line(self) -> str:
+        stats = self.stats()
+        return (f"cache hit rate {stats['hit_rate']:.0%} ({stats['hits']}/{stats['hits'] + stats['misses']}), "
+                f"{stats['deadline_fallbacks']} deadline fallbacks, {stats['errors']} errors")